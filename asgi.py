@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Asynchronous front end, serving the same legacy API than main.py as a raw
+# ASGI application.
+# Connector calls are blocking, they run in the worker lane of their request
+# class (see lanes.py) while requests wait on the event loop: many upstream
+# requests can wait for the cluster without holding a thread each, and /live
+# never waits for a thread.
+#
+# Usage (uvicorn is only needed for this mode):
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+# or
+#   python3 asgi.py
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import time
+import urllib.parse
+import zlib
+
+import lanes
+import main
+from connectors.metrics import metrics
+
+baremetal_connector = main.baremetal_connector
+log = logging.getLogger(__name__)
+
+# Calls waiting for a lane worker only hold a coroutine here, not a thread:
+# lanes queue many more calls than with waitress before answering 503
+asgi_lane_queue = os.getenv('JARVICE_ASGI_LANE_QUEUE', '4096')
+for lane in lanes.lanes:
+    lane.set_queue(int(os.getenv(f'JARVICE_ASGI_LANE_{lane.name.upper()}_QUEUE',
+                                 asgi_lane_queue)))
+
+# Lane of the request being processed
+current_lane = contextvars.ContextVar('current_lane')
+# Seconds spent running connector calls of the request being processed
+connector_seconds = contextvars.ContextVar('connector_seconds', default=0.0)
+
+
+async def call(function, *args, reject=True):
+    """ runs a blocking connector call in lane of current request """
+    timing = {}
+    try:
+        return await asyncio.wrap_future(current_lane.get().submit(
+            function, *args, reject=reject, timing=timing))
+    finally:
+        connector_seconds.set(connector_seconds.get() +
+                              timing.get('seconds', 0.0))
+
+
+# ################## RESPONSES
+
+class response(object):
+    """ response to send, content being bytes or an iterator of chunks """
+
+    def __init__(self, status, content=b'', content_type='text/html'):
+        self.status = status
+        self.content = content
+        self.content_type = content_type
+        self.headers = []
+
+    @classmethod
+    def json(cls, content, status=200):
+        return cls(status, json.dumps(content).encode(), 'application/json')
+
+    @property
+    def streamed(self):
+        return not isinstance(self.content, (str, bytes))
+
+
+def accepted_encoding(headers):
+    """ returns gzip or deflate if accepted by client, else None """
+    accepted = {}
+    for item in headers.get('accept-encoding', '').split(','):
+        parts = item.strip().split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            key, sep, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].strip().lower()] = quality
+    for encoding in ['gzip', 'deflate']:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+async def send_response(send, rsp, request_headers):
+    content = rsp.content
+    if isinstance(content, str):
+        content = content.encode()
+    headers = [(b'content-type', rsp.content_type.encode())] + rsp.headers
+
+    # Same compression settings than main.py
+    encoding = None
+    if main.http_compression and rsp.status >= 200 and \
+            rsp.status not in [204, 304] and \
+            (rsp.streamed or len(content) >= main.http_compression_min_size):
+        encoding = accepted_encoding(request_headers)
+    compressor = None
+    if encoding:
+        wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+        compressor = zlib.compressobj(main.http_compression_level,
+                                      zlib.DEFLATED, wbits)
+        headers += [(b'content-encoding', encoding.encode()),
+                    (b'vary', b'Accept-Encoding')]
+
+    if not rsp.streamed:
+        if compressor:
+            content = compressor.compress(content) + compressor.flush()
+        headers.append((b'content-length', str(len(content)).encode()))
+        await send({'type': 'http.response.start', 'status': rsp.status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+        return
+
+    await send({'type': 'http.response.start', 'status': rsp.status,
+                'headers': headers})
+    chunks = iter(content)
+    try:
+        while True:
+            # Chunks are produced by blocking reads from the cluster
+            chunk = await call(next, chunks, None, reject=False)
+            if chunk is None:
+                break
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if compressor:
+                chunk = compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+        body = compressor.flush() if compressor else b''
+        await send({'type': 'http.response.body', 'body': body})
+    finally:
+        if hasattr(chunks, 'close'):
+            await call(chunks.close, reject=False)
+
+
+# ################## END POINTS - LEGACY
+# See main.py for the description of each end point
+
+def job_args(args):
+    return args["name"], args["number"], args["jobid"]
+
+
+def jobs_args(args):
+    return [(job["name"], job["number"], job["jobid"])
+            for job in args["jobs"]]
+
+
+async def live(args, path):
+    return response.json({"status": "OK"})
+
+
+async def gc(args, path):
+    return_code = await call(baremetal_connector.gc)
+    if int(return_code) == 200:
+        return response.json({"status": "OK"})
+    return response.json({"status": "BAD"}, 500)
+
+
+async def submit(args, path):
+    rsp = response.json(await call(
+        baremetal_connector.submit, args["name"], args["number"],
+        args["nodes"], args['hpc_script'], args["bearer"]))
+    rsp.headers += [(key.lower().encode(), value.encode()) for key, value in
+                    main.submit_server_timing(args["name"]).items()]
+    return rsp
+
+
+async def nodes(args, path):
+    return response(200, b'true')
+
+
+async def running(args, path):
+    return response.json(await call(baremetal_connector.running))
+
+
+async def queued(args, path):
+    return response.json(await call(baremetal_connector.queued))
+
+
+async def exitstatus(args, path):
+    if getattr(baremetal_connector, 'stream_logs', False):
+        return response(200, await call(baremetal_connector.exitstatus_stream,
+                                        *job_args(args)), 'application/json')
+    return response.json(await call(baremetal_connector.exitstatus,
+                                    *job_args(args)))
+
+
+async def exitstatus_batch(args, path):
+    return response.json(await call(baremetal_connector.exitstatus_batch,
+                                    jobs_args(args)))
+
+
+async def runstatus(args, path):
+    return response.json(await call(baremetal_connector.runstatus,
+                                    *job_args(args)))
+
+
+async def runstatus_batch(args, path):
+    return response.json(await call(baremetal_connector.runstatus_batch,
+                                    jobs_args(args)))
+
+
+async def terminate(args, path):
+    return response.json(await call(baremetal_connector.terminate,
+                                    *job_args(args)))
+
+
+async def online(args, path):
+    return response.json(True)
+
+
+async def release(args, path):
+    return response.json(await call(baremetal_connector.release,
+                                    *job_args(args)))
+
+
+async def events(args, path):
+    return response.json(await call(baremetal_connector.events,
+                                    *job_args(args)))
+
+
+async def lanes_stats(args, path):
+    return response.json(lanes.stats())
+
+
+async def submit_timings(args, path):
+    timings = getattr(baremetal_connector, 'submit_timings', None)
+    return response.json(timings.entries() if timings else [])
+
+
+async def metrics_text(args, path):
+    return response(200, metrics.render(), main.metrics_content_type)
+
+
+async def requests(args, path):
+    code, content_type, content = await call(
+        baremetal_connector.request, path, args["qs"])
+    if content_type == 'application/json':
+        return response.json(json.loads(content))
+    if content is None:
+        return response(code)
+    return response(code, content, content_type if content_type
+                    else 'text/html')
+
+
+# (method, rule as in main.py, handler, needs args, lane)
+routes = [
+    ('GET', r'/live', live, False, None),
+    ('GET', r'/gc', gc, False, lanes.health),
+    ('POST', r'/submit', submit, True, lanes.mutation),
+    ('GET', r'/nodes', nodes, False, None),
+    ('GET', r'/running', running, False, lanes.status),
+    ('GET', r'/queued', queued, False, lanes.status),
+    ('POST', r'/exitstatus', exitstatus, True, lanes.logs),
+    ('POST', r'/batch/exitstatus', exitstatus_batch, True, lanes.logs),
+    ('POST', r'/runstatus', runstatus, True, lanes.status),
+    ('POST', r'/batch/runstatus', runstatus_batch, True, lanes.status),
+    ('POST', r'/terminate', terminate, True, lanes.mutation),
+    ('POST', r'/online', online, False, None),
+    ('POST', r'/release', release, True, lanes.mutation),
+    ('POST', r'/events', events, True, lanes.status),
+    ('POST', r'/request/<path:path>', requests, True, lanes.logs),
+    ('GET', r'/lanes', lanes_stats, False, None),
+    ('GET', r'/debug/submit_timings', submit_timings, False, None),
+    ('GET', r'/metrics', metrics_text, False, None)
+]
+routes = [(method, rule, re.compile(re.sub(r'<path:\w+>', '(.+)', rule) + '$'),
+           handler, needs_args, lane)
+          for method, rule, handler, needs_args, lane in routes]
+
+
+# ################## ASGI APPLICATION
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            return body
+
+
+def form_args(body):
+    """ returns decoded args field of an url encoded form """
+    form = urllib.parse.parse_qs(body.decode('utf-8'))
+    return json.loads(form['args'][0])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            for lane in lanes.lanes:
+                lane.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    start = time.monotonic()
+    headers = dict((k.decode('latin-1').lower(), v.decode('latin-1'))
+                   for k, v in scope.get('headers', []))
+    path = scope['path']
+    allowed = False
+    for method, rule, pattern, handler, needs_args, lane in routes:
+        match = pattern.match(path)
+        if not match:
+            continue
+        allowed = True
+        if method == scope['method'] or \
+                (method == 'GET' and scope['method'] == 'HEAD'):
+            break
+    else:
+        await read_body(receive)
+        rsp = response(405 if allowed else 404,
+                       b'Method Not Allowed' if allowed else b'Not Found')
+        observe(None, scope['method'], rsp.status, start)
+        await send_response(send, rsp, {})
+        return
+
+    body = await read_body(receive)
+    try:
+        args = form_args(body) if needs_args else None
+    except Exception as e:
+        log.info(f'Bad request on {path}: {e}')
+        observe(rule, scope['method'], 400, start)
+        await send_response(send, response(400, b'Bad Request'), {})
+        return
+    current_lane.set(lane)
+    connector_seconds.set(0.0)
+    try:
+        rsp = await handler(args, match.group(1) if match.groups() else None)
+    except lanes.lane_full as e:
+        rsp = response.json({"status": "BUSY", "lane": e.lane}, 503)
+        rsp.headers.append((b'retry-after', b'1'))
+    except Exception:
+        log.exception(f'Exception on {path} [{scope["method"]}]')
+        rsp = response(500, b'Internal Server Error')
+    observe(rule, scope['method'], rsp.status, start)
+    if main.trace_recorder and rule not in main.trace_excluded:
+        duration = time.monotonic() - start
+        main.trace_recorder.record(
+            time.time() - duration, scope['method'], rule, path, args,
+            rsp.status, duration, connector_seconds.get())
+    await send_response(send, rsp, headers)
+
+
+def observe(rule, method, status, start):
+    """ updates requests metrics, same as main.py """
+    route = rule if rule else 'unmatched'
+    main.http_requests.inc(route=route, method=method, status=status)
+    main.http_request_seconds.observe(time.monotonic() - start,
+                                      route=route, method=method)
+
+
+# ## RUNNING SERVER
+
+if __name__ == "__main__":
+
+    import uvicorn
+    uvicorn.run(app,
+                host=os.getenv('ASGI_BIND_ADDRESS', "0.0.0.0"),
+                port=int(os.getenv('ASGI_PORT', "5000")))
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Benchmark of the Slurm connector cli interface, against a fake Slurm
+# cluster (see fake_slurm.py) started in the same process.
+# The real baremetal_connector is driven through each end point in turn:
+# jobs are submitted, queried, tailed, released, terminated, and finally
+# garbage collected by exitstatus. Throughput and latency percentiles are
+# reported for each end point.
+# With --check-settings, jobs with differing settings are submitted one at a
+# time, then all at once, and scripts and sbatch arguments received by the
+# cluster must be the same, so that concurrent submissions do not leak
+# settings into each other.
+#
+# Usage, from repository root:
+#   python3 -m benchmarks.bench_connector --jobs 200 --concurrency 8 \
+#       --latency default=0.01 --latency sbatch=0.1
+#   python3 -m benchmarks.bench_connector --jobs 400 --concurrency 32 \
+#       --check-settings
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from base64 import b64encode
+
+import jwt
+import paramiko
+import yaml
+
+from benchmarks import fake_slurm
+
+# Upstream job script, with its KEY=value header
+hpc_script = """#!/bin/bash
+JOBOBJ_INTERACTIVE=False
+JOBOBJ_APPDEFVERSION=2
+JOBOBJ_ARCH=amd64
+JOBOBJ_NAE=app
+JOBOBJ_REPO=docker.io/org/app:1
+JOBOBJ_CTRSECRET=
+JOBOBJ_USER=bench
+JOBOBJ_DEVICES=["partition=bench"]
+JOBOBJ_GPUS=0
+JOBOBJ_RAM=4
+JOBOBJ_WALLTIME=01:00:00
+JARVICE_CPU_CORES=4
+JARVICE_CMD=/bin/echo hello
+{DOWNSTREAM_PARAMETERS}
+echo done
+"""
+
+
+def percentile(values, ratio):
+    """ returns nearest rank percentile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(int(ratio * len(values)), len(values) - 1)]
+
+
+def streamed(value):
+    """ returns True if value is a streamed answer, not a plain value """
+    return value is not None and \
+        not isinstance(value, (str, bytes, dict, list, tuple, int, float)) \
+        and hasattr(value, '__iter__')
+
+
+def drain(chunks):
+    """ reads and closes streamed chunks, returns their size """
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return size
+
+
+class results(object):
+    """ latencies and errors of each end point """
+
+    def __init__(self):
+        self.endpoints = []
+        self.latencies = {}
+        self.errors = {}
+        self.durations = {}
+
+    def run(self, endpoint, function, calls, concurrency):
+        """ runs function(*args) for each args of calls, concurrently """
+        def timed(args):
+            start = time.perf_counter()
+            try:
+                result = function(*args)
+                # Streamed answers, as is or as body of request() answers,
+                # are read entirely and closed so that their connection is
+                # released: only their size is kept
+                if isinstance(result, tuple) and len(result) == 3 and \
+                        streamed(result[2]):
+                    result = result[:2] + (drain(result[2]),)
+                elif streamed(result):
+                    result = drain(result)
+                return time.perf_counter() - start, None, result
+            except Exception as e:
+                return time.perf_counter() - start, e, None
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            outcomes = list(executor.map(timed, calls))
+        self.durations[endpoint] = time.perf_counter() - start
+        self.endpoints.append(endpoint)
+        self.latencies[endpoint] = sorted(i[0] for i in outcomes)
+        self.errors[endpoint] = [i[1] for i in outcomes if i[1]]
+        if self.errors[endpoint]:
+            logging.warning('%s: %d errors, first one: %s' % (
+                endpoint, len(self.errors[endpoint]),
+                self.errors[endpoint][0]))
+        return [i[2] for i in outcomes]
+
+    def report(self, out=sys.stdout):
+        out.write('%-18s %7s %7s %10s %10s %10s %10s\n' % (
+            'endpoint', 'calls', 'errors', 'calls/s', 'p50 ms', 'p99 ms',
+            'max ms'))
+        for endpoint in self.endpoints:
+            latencies = self.latencies[endpoint]
+            out.write('%-18s %7d %7d %10.1f %10.2f %10.2f %10.2f\n' % (
+                endpoint, len(latencies), len(self.errors[endpoint]),
+                len(latencies) / self.durations[endpoint]
+                if self.durations[endpoint] else 0,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000 if latencies else 0))
+
+    def as_dict(self):
+        return dict((endpoint, {
+            'calls': len(self.latencies[endpoint]),
+            'errors': len(self.errors[endpoint]),
+            'throughput': len(self.latencies[endpoint]) /
+            self.durations[endpoint] if self.durations[endpoint] else 0,
+            'p50': percentile(self.latencies[endpoint], 0.5),
+            'p99': percentile(self.latencies[endpoint], 0.99)
+        }) for endpoint in self.endpoints)
+
+
+def setup(cluster_port, workdir, users=4, environment=None):
+    """
+    configures connector environment in workdir, for a fake cluster on
+    cluster_port, returns (bearer tokens, connector module)
+    """
+    key = paramiko.RSAKey.generate(2048)
+    with open(os.path.join(workdir, 'key'), 'w') as file:
+        key.write_private_key(file)
+    with open(os.path.join(workdir, 'key'), 'r') as file:
+        material = file.read()
+
+    # Users id mapping, one mapped user per bearer token
+    mapping = {'users_id_mapping': [
+        {'mail': 'user%d@bench' % i, 'mapped_user': 'user%d' % i,
+         'ssh_private_key_b64': b64encode(material.encode()).decode()}
+        for i in range(users)]}
+    with open(os.path.join(workdir, 'users_id_mapping_configuration.yaml'),
+              'w') as file:
+        yaml.safe_dump(mapping, file)
+    bearers = [jwt.encode({'email': 'user%d@bench' % i}, 'bench' * 8,
+                          algorithm='HS256') for i in range(users)]
+
+    os.environ.update({
+        'JARVICE_BAREMETAL_CONNECTOR': 'connectors.slurm.connector',
+        'JARVICE_SLURM_INTERFACE': 'cli',
+        'JARVICE_SLURM_CLUSTER_ADDR': '127.0.0.1',
+        'JARVICE_SLURM_CLUSTER_PORT': str(cluster_port),
+        'JARVICE_SLURM_SSH_USER': 'jarvice',
+        'JARVICE_SLURM_SSH_PKEY': material,
+        'JARVICE_SLURM_USERS_DB': os.path.join(workdir, 'users.sqlite'),
+        'JARVICE_SYSTEM_REGISTRY': 'registry.bench',
+        'JARVICE_SYSTEM_REPO_BASE': 'jarvice',
+        'JARVICE_JOB_SCRATCH_DIR': '/scratch'
+    })
+    if environment:
+        os.environ.update(environment)
+    # Mapping file is read from working directory
+    os.chdir(workdir)
+    return bearers
+
+
+def bench(connector, bearers, jobs, concurrency, out=sys.stdout):
+    """ drives connector through every end point, returns results """
+    r = results()
+    script = {'singularity': b64encode(hpc_script.encode()).decode()}
+
+    # Job names carry the Jarvice user, mapped at submit time
+    names = ['jarvice-bench%d_%d' % (i % len(bearers), i)
+             for i in range(jobs)]
+    submitted = r.run('submit', connector.submit, [
+        (name, i, 1, script, bearers[i % len(bearers)])
+        for i, name in enumerate(names)], concurrency)
+    submitted = [(name, i, result[0]) for i, (name, result) in
+                 enumerate(zip(names, submitted)) if result]
+    if not submitted:
+        raise Exception('No job could be submitted')
+
+    def pick(count):
+        return [random.choice(submitted) for i in range(count)]
+
+    r.run('gc', connector.gc, [()] * jobs, concurrency)
+    r.run('running', connector.running, [()] * jobs, concurrency)
+    r.run('queued', connector.queued, [()] * jobs, concurrency)
+    r.run('runstatus', connector.runstatus, pick(jobs), concurrency)
+    r.run('runstatus_batch', connector.runstatus_batch,
+          [(pick(50),) for i in range(max(jobs // 10, 1))], concurrency)
+    r.run('events', connector.events, pick(jobs), concurrency)
+    r.run('tail', connector.request, [
+        ('%s/%d/%s/tail' % job, {'lines': ['100']})
+        for job in pick(jobs)], concurrency)
+    r.run('tail_offset', connector.request, [
+        ('%s/%d/%s/tail' % job, {'offset': ['0'], 'max_bytes': ['4096']})
+        for job in pick(jobs)], concurrency)
+    r.run('release', connector.release, pick(jobs), concurrency)
+    r.run('terminate', connector.terminate,
+          submitted[:len(submitted) // 2], concurrency)
+    r.run('exitstatus', connector.exitstatus, submitted, concurrency)
+    return r
+
+
+def settings_script(i):
+    """ returns job script i, its settings differing from its neighbours """
+    devices = ['partition=part%d' % (i % 3), 'overlay=%d' % (100 + i),
+               'exclusive=%s' % (i % 2 == 0), 'sbatch_comment=job%d' % i]
+    return hpc_script.replace(
+        'JOBOBJ_DEVICES=["partition=bench"]',
+        'JOBOBJ_DEVICES=' + json.dumps(devices)).replace(
+        'JOBOBJ_GPUS=0', 'JOBOBJ_GPUS=%d' % (i % 4 == 3)).replace(
+        'JOBOBJ_RAM=4', 'JOBOBJ_RAM=%d' % (1 + i % 8))
+
+
+def check_settings(connector, cluster, bearers, jobs, concurrency,
+                   out=sys.stdout):
+    """
+    submits jobs with differing settings serially, then concurrently,
+    returns results and count of jobs rendered differently
+    """
+    r = results()
+    names = ['jarvice-bench%d_%d' % (i % len(bearers), i)
+             for i in range(jobs)]
+    calls = [(name, i, 1,
+              {'singularity': b64encode(settings_script(i).encode()).decode()},
+              bearers[i % len(bearers)]) for i, name in enumerate(names)]
+
+    def rendered(submitted):
+        """ returns (script, sbatch args, cluster script) of submissions """
+        return [(result[1], cluster.jobs[int(result[0])]['args'],
+                 cluster.jobs[int(result[0])]['script'])
+                if result else None for result in submitted]
+
+    serial = rendered(r.run('submit_serial', connector.submit, calls, 1))
+    parallel = rendered(r.run('submit_parallel', connector.submit, calls,
+                              concurrency))
+    mismatches = 0
+    for name, expected, actual in zip(names, serial, parallel):
+        if expected is None or expected != actual:
+            mismatches += 1
+            if mismatches <= 10:
+                out.write('%s: rendered differently when submitted '
+                          'concurrently\n' % name)
+    out.write('%d jobs, %d rendered differently when submitted '
+              'concurrently\n' % (jobs, mismatches))
+    return r, mismatches
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Slurm connector benchmark, against a fake cluster')
+    parser.add_argument('--jobs', type=int, default=200,
+                        help='jobs submitted, and calls per end point')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--queued-time', type=float, default=1)
+    parser.add_argument('--running-time', type=float, default=5)
+    parser.add_argument('--output-lines', type=int, default=1000)
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='COMMAND=SECONDS',
+                        help='latency of a command type on fake cluster, '
+                        'or default=SECONDS for all')
+    parser.add_argument('--env', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='connector setting, like '
+                        'JARVICE_SLURM_SSH_POOL_SIZE=8')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check-settings', action='store_true',
+                        help='only check that concurrent submissions render '
+                        'the same scripts as serial ones')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    cluster = fake_slurm.serve(
+        port=0, queued_time=args.queued_time,
+        running_time=args.running_time,
+        latency=fake_slurm.parse_latency(args.latency),
+        output_lines=args.output_lines)
+    # Imported before leaving repository root
+    module = importlib.import_module('connectors.slurm.connector')
+    workdir = tempfile.mkdtemp(prefix='jarvice-bench-')
+    bearers = setup(cluster.port, workdir, args.users,
+                    dict(i.split('=', 1) for i in args.env))
+    connector = module.baremetal_connector()
+
+    if args.check_settings:
+        r, mismatches = check_settings(connector, cluster, bearers,
+                                       args.jobs, args.concurrency)
+        r.report()
+        sys.exit(1 if mismatches else 0)
+
+    r = bench(connector, bearers, args.jobs, args.concurrency)
+    r.report()
+    sys.stdout.write('remote commands: %s\n' % json.dumps(
+        dict(sorted(cluster.calls.items()))))
+    if json_path:
+        with open(json_path, 'w') as file:
+            json.dump({'endpoints': r.as_dict(),
+                       'remote_commands': cluster.calls}, file, indent=2)
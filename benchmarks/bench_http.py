@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# HTTP load generator for the DSSR API (main.py), replaying an upstream like
+# polling mix: /running, /queued, per job /runstatus, /request/.../tail,
+# /submit and /exitstatus.
+# A population of jobs is submitted first, then each concurrency level of
+# --concurrency is run in turn, for --duration seconds or --requests calls.
+# Latency histograms, error rates and throughput are reported per route and
+# per concurrency level, giving the saturation curve of each route.
+# Routes picked, job names and jobs picked only depend on --seed, so that
+# runs can be compared.
+#
+# The DSSR can be an already running one (--url), or be started by this tool
+# with waitress (--serve), with the dummy connector or the Slurm connector
+# against a fake Slurm cluster (see fake_slurm.py).
+#
+# Usage, from repository root:
+#   python3 -m benchmarks.bench_http --serve dummy --concurrency 1,4,16,64
+#   python3 -m benchmarks.bench_http --serve slurm --latency default=0.01 \
+#       --env WAITRESS_THREADS=16 --json waitress16.json
+#   python3 -m benchmarks.bench_http --url http://127.0.0.1:5000
+
+import argparse
+import gzip
+import http.client
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from base64 import b64encode
+
+from benchmarks import fake_slurm
+from benchmarks.bench_connector import hpc_script, percentile, setup
+
+# Upstream polling mix, as route=weight
+default_mix = {'running': 10, 'queued': 10, 'runstatus': 50, 'tail': 20,
+               'submit': 5, 'exitstatus': 5}
+
+# Latency histogram upper bounds, in ms
+buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class population(object):
+    """
+    jobs known by the load generator. Submissions add jobs, exitstatus
+    removes them, as upstream does once jobs completed.
+    """
+
+    def __init__(self, users, seed):
+        self.lock = threading.Lock()
+        self.users = users
+        self.numbers = itertools.count(seed * 1000000 + 1)
+        self.jobs = []
+
+    def new(self):
+        """ returns (name, number) of a new job """
+        with self.lock:
+            number = next(self.numbers)
+        # Job names carry the Jarvice user, mapped at submit time
+        return 'jarvice-bench%d_%d' % (number % self.users, number), number
+
+    def add(self, name, number, jobid):
+        with self.lock:
+            self.jobs.append((name, number, jobid))
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.jobs) if self.jobs else None
+
+    def take(self, rng):
+        """ removes and returns a job, None if there are none """
+        with self.lock:
+            if not self.jobs:
+                return None
+            return self.jobs.pop(rng.randrange(len(self.jobs)))
+
+    def __len__(self):
+        return len(self.jobs)
+
+
+class client(object):
+    """ upstream like client, with a persistent connection """
+
+    def __init__(self, url, bearers, jobs, compression=False, timeout=60):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip('/')
+        self.bearers = bearers
+        self.jobs = jobs
+        self.timeout = timeout
+        self.headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if compression:
+            self.headers['Accept-Encoding'] = 'gzip'
+        self.connection = None
+        self.script = {'singularity': b64encode(hpc_script.encode()).decode()}
+
+    def call(self, method, path, args=None):
+        """ returns status and decoded body of a request """
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        body = urllib.parse.urlencode({'args': json.dumps(args)}) \
+            if args is not None else None
+        try:
+            self.connection.request(method, self.prefix + path, body,
+                                    self.headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except Exception:
+            self.connection.close()
+            self.connection = None
+            raise
+        encoding = response.getheader('Content-Encoding')
+        if encoding == 'gzip':
+            data = gzip.decompress(data)
+        elif encoding == 'deflate':
+            data = zlib.decompress(data)
+        if response.getheader('Connection', '').lower() == 'close':
+            self.connection.close()
+            self.connection = None
+        return response.status, data
+
+    def submit(self):
+        name, number = self.jobs.new()
+        status, data = self.call('POST', '/submit', {
+            'name': name, 'number': number, 'nodes': 1,
+            'hpc_script': self.script,
+            'bearer': self.bearers[number % len(self.bearers)]})
+        if status == 200:
+            self.jobs.add(name, number, json.loads(data)[0])
+        return status
+
+    def route(self, route, rng):
+        """ runs route, returns its answer status """
+        if route == 'running':
+            return self.call('GET', '/running')[0]
+        if route == 'queued':
+            return self.call('GET', '/queued')[0]
+        if route == 'submit':
+            return self.submit()
+        if route == 'exitstatus':
+            job = self.jobs.take(rng)
+        else:
+            job = self.jobs.pick(rng)
+        if job is None:
+            raise Exception('No job left, submit weight too low')
+        name, number, jobid = job
+        if route == 'tail':
+            return self.call('POST', '/request/%s/%d/%s/tail' % job,
+                             {'qs': {'lines': ['100']}})[0]
+        if route == 'tail_offset':
+            return self.call('POST', '/request/%s/%d/%s/tail' % job,
+                             {'qs': {'offset': ['0'],
+                                     'max_bytes': ['4096']}})[0]
+        return self.call('POST', '/' + route, {
+            'name': name, 'number': number, 'jobid': jobid})[0]
+
+
+class route_stats(object):
+    """ latencies and answers of a route, during a step """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.busy = 0
+        self.first_error = None
+
+    def add(self, seconds, status, error=None):
+        self.latencies.append(seconds)
+        if status == 503:
+            # Lane full, the DSSR is saturated
+            self.busy += 1
+        elif error is not None or status >= 500:
+            self.errors += 1
+            if self.first_error is None:
+                self.first_error = error or 'HTTP %d' % status
+
+    def merge(self, other):
+        self.latencies += other.latencies
+        self.errors += other.errors
+        self.busy += other.busy
+        self.first_error = self.first_error or other.first_error
+
+    def histogram(self):
+        """ returns {upper bound in ms: count}, not cumulative """
+        counts = dict((str(bound), 0) for bound in buckets + ('+Inf',))
+        for seconds in self.latencies:
+            for bound in buckets:
+                if seconds * 1000 <= bound:
+                    counts[str(bound)] += 1
+                    break
+            else:
+                counts['+Inf'] += 1
+        return counts
+
+    def as_dict(self, duration):
+        latencies = sorted(self.latencies)
+        calls = len(latencies)
+        return {
+            'calls': calls, 'errors': self.errors, 'busy': self.busy,
+            'error_rate': self.errors / calls if calls else 0,
+            'throughput': calls / duration if duration else 0,
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0,
+            'histogram': self.histogram()}
+
+
+def run_step(url, bearers, jobs, mix, concurrency, duration, requests, seed,
+             compression=False):
+    """
+    runs concurrency clients for duration seconds, or until requests calls
+    were made, returns {route: route_stats} and step duration
+    """
+    routes = sorted(mix)
+    weights = [mix[route] for route in routes]
+    deadline = time.monotonic() + duration if duration else None
+    counter = itertools.count()
+    outcomes = []
+
+    def worker(index):
+        # One random sequence per client, for a given seed and level
+        rng = random.Random('%d-%d-%d' % (seed, concurrency, index))
+        c = client(url, bearers, jobs, compression)
+        stats = dict((route, route_stats()) for route in routes)
+        while True:
+            if deadline and time.monotonic() >= deadline:
+                break
+            if requests and next(counter) >= requests:
+                break
+            route = rng.choices(routes, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = c.route(route, rng)
+                stats[route].add(time.perf_counter() - start, status)
+            except Exception as e:
+                stats[route].add(time.perf_counter() - start, 0,
+                                 '%s: %s' % (type(e).__name__, e))
+        outcomes.append(stats)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    merged = dict((route, route_stats()) for route in routes)
+    for stats in outcomes:
+        for route in routes:
+            merged[route].merge(stats[route])
+    return merged, elapsed
+
+
+def populate(url, bearers, jobs, count, concurrency, compression=False):
+    """ submits count jobs, as initial population """
+    def worker(index):
+        c = client(url, bearers, jobs, compression)
+        for i in range(index, count, concurrency):
+            status = c.submit()
+            # Full lane, retried as upstream does
+            while status == 503:
+                time.sleep(0.1)
+                status = c.submit()
+            if status != 200:
+                logging.warning('Submission failed with HTTP %d' % status)
+                return
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(min(concurrency, count))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(jobs) < count:
+        raise Exception('Only %d of %d jobs could be submitted'
+                        % (len(jobs), count))
+
+
+def report_step(concurrency, stats, elapsed, out=sys.stdout,
+                histograms=False):
+    out.write('\nconcurrency %d, %.1f s\n' % (concurrency, elapsed))
+    return report_routes(stats, elapsed, out, histograms)
+
+
+def report_routes(stats, elapsed, out=sys.stdout, histograms=False):
+    """ writes latencies table of routes stats, returns their total """
+    width = max([12] + [len(route) for route in stats])
+    out.write('%-*s %7s %7s %7s %10s %9s %9s %9s %9s\n' % (
+        width, 'route', 'calls', 'errors', 'busy', 'calls/s', 'p50 ms',
+        'p90 ms', 'p99 ms', 'max ms'))
+    total = route_stats()
+    for route in sorted(stats):
+        total.merge(stats[route])
+    for route, s in sorted(stats.items()) + [('total', total)]:
+        d = s.as_dict(elapsed)
+        out.write('%-*s %7d %7d %7d %10.1f %9.2f %9.2f %9.2f %9.2f\n' % (
+            width, route, d['calls'], d['errors'], d['busy'], d['throughput'],
+            d['p50'] * 1000, d['p90'] * 1000, d['p99'] * 1000,
+            d['max'] * 1000))
+    for route, s in sorted(stats.items()):
+        if s.first_error:
+            logging.warning('%s: first error: %s' % (route, s.first_error))
+    if histograms:
+        for route, s in sorted(stats.items()):
+            counts = s.histogram()
+            top = max(counts.values()) or 1
+            out.write('%s latency histogram:\n' % route)
+            for bound, count in counts.items():
+                out.write('  <= %6s ms %7d %s\n' % (
+                    bound, count, '#' * int(40 * count / top)))
+    return total
+
+
+def report_curve(steps, out=sys.stdout):
+    """ writes throughput and p99 of each route, per concurrency level """
+    routes = sorted(steps[0]['routes']) + ['total']
+    out.write('\nsaturation curve (calls/s, p99 ms)\n')
+    out.write('%-12s' % 'route' + ''.join(
+        ' %18s' % ('c=%d' % step['concurrency']) for step in steps) + '\n')
+    for route in routes:
+        out.write('%-12s' % route)
+        for step in steps:
+            d = step['total'] if route == 'total' else step['routes'][route]
+            out.write(' %9.1f %8.2f' % (d['throughput'], d['p99'] * 1000))
+        out.write('\n')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workdir, timeout=60):
+    """
+    starts main.py with waitress in workdir, with current environment,
+    returns process and its url once it answers /live
+    """
+    port = free_port()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, WAITRESS_PORT=str(port),
+                       WAITRESS_BIND_ADDRESS='127.0.0.1',
+                       PYTHONPATH=root)
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(root, 'main.py'), 'waitress'],
+        cwd=workdir, env=environment, stdout=log, stderr=subprocess.STDOUT)
+    url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception('Server exited, see %s' % log.name)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=1)
+            connection.request('GET', '/live')
+            if connection.getresponse().status == 200:
+                connection.close()
+                return process, url
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise Exception('Server not answering, see %s' % log.name)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='DSSR HTTP load generator')
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+                        help='DSSR to load, if not started with --serve')
+    parser.add_argument('--serve', choices=['dummy', 'slurm'],
+                        help='start a DSSR with waitress, with the dummy '
+                        'connector or against a fake Slurm cluster')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per concurrency level')
+    parser.add_argument('--requests', type=int, default=0,
+                        help='calls per concurrency level, instead of '
+                        '--duration')
+    parser.add_argument('--jobs', type=int, default=100,
+                        help='initial jobs population')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--mix', action='append', default=[],
+                        metavar='ROUTE=WEIGHT',
+                        help='weight of a route: running, queued, '
+                        'runstatus, tail, tail_offset, events, submit, '
+                        'exitstatus. 0 removes it')
+    parser.add_argument('--compression', action='store_true',
+                        help='accept gzip compressed answers')
+    parser.add_argument('--histograms', action='store_true',
+                        help='also print latency histograms')
+    parser.add_argument('--queued-time', type=float, default=5)
+    parser.add_argument('--running-time', type=float, default=60)
+    parser.add_argument('--output-lines', type=int, default=1000,
+                        help='fake Slurm jobs output lines')
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='COMMAND=SECONDS',
+                        help='fake Slurm command latency, or '
+                        'default=SECONDS for all')
+    parser.add_argument('--env', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='started DSSR setting, like WAITRESS_THREADS=16')
+    parser.add_argument('--json', help='also write results to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    json_path = os.path.abspath(args.json) if args.json else None
+    levels = [int(i) for i in args.concurrency.split(',')]
+    mix = dict(default_mix)
+    for value in args.mix:
+        route, sep, weight = value.partition('=')
+        if not sep:
+            raise ValueError('Invalid mix %s, expecting route=weight' % value)
+        mix[route] = float(weight)
+    mix = dict((route, weight) for route, weight in mix.items() if weight > 0)
+    environment = dict(i.split('=', 1) for i in args.env)
+
+    process = None
+    cluster = None
+    url = args.url
+    bearers = ['bench']
+    if args.serve:
+        workdir = tempfile.mkdtemp(prefix='jarvice-bench-http-')
+        if args.serve == 'dummy':
+            os.environ.update({
+                'JARVICE_BAREMETAL_CONNECTOR': 'connectors.dummy.connector',
+                'JARVICE_DUMMY_JOB_QUEUED_TIME': str(int(args.queued_time)),
+                'JARVICE_DUMMY_JOB_RUNNING_TIME': str(int(args.running_time))
+            })
+            os.environ.update(environment)
+        else:
+            cluster = fake_slurm.serve(
+                port=0, queued_time=args.queued_time,
+                running_time=args.running_time,
+                latency=fake_slurm.parse_latency(args.latency),
+                output_lines=args.output_lines)
+            bearers = setup(cluster.port, workdir, args.users, environment)
+        process, url = start_server(workdir)
+        sys.stdout.write('DSSR started on %s, in %s\n' % (url, workdir))
+
+    try:
+        jobs = population(len(bearers), args.seed)
+        populate(url, bearers, jobs, args.jobs, max(levels),
+                 args.compression)
+        steps = []
+        for concurrency in levels:
+            stats, elapsed = run_step(
+                url, bearers, jobs, mix, concurrency,
+                0 if args.requests else args.duration, args.requests, args.seed, args.compression)
+            total = report_step(concurrency, stats, elapsed,
+                                histograms=args.histograms)
+            steps.append({
+                'concurrency': concurrency, 'duration': elapsed,
+                'routes': dict((route, s.as_dict(elapsed))
+                               for route, s in stats.items()),
+                'total': total.as_dict(elapsed)})
+        report_curve(steps)
+        if cluster:
+            sys.stdout.write('remote commands: %s\n' % json.dumps(
+                dict(sorted(cluster.calls.items()))))
+        if json_path:
+            with open(json_path, 'w') as file:
+                json.dump({'url': url, 'serve': args.serve, 'mix': mix,
+                           'seed': args.seed, 'jobs': args.jobs,
+                           'environment': environment, 'steps': steps},
+                          file, indent=2)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
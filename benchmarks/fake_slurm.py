@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Fake Slurm cluster behind a local SSH server, to test and benchmark the
+# Slurm connector cli interface without a cluster.
+# squeue, sacct, sbatch, scancel, scontrol and tail are simulated over an
+# in memory jobs table, each command taking an optional latency.
+# Jobs stay PENDING for --queued-time seconds (or until released if
+# submitted held), then RUNNING for --running-time seconds, then COMPLETED.
+# Any user and key is accepted.
+#
+# Usage:
+#   python3 -m benchmarks.fake_slurm --port 2222 --latency squeue=0.05
+
+import argparse
+import gzip
+import re
+import shlex
+import socket
+import threading
+import time
+
+import paramiko
+
+# squeue short state -> sacct state
+long_states = {'PD': 'PENDING', 'R': 'RUNNING', 'CD': 'COMPLETED',
+               'CA': 'CANCELLED', 'F': 'FAILED'}
+
+
+def squeue_elapsed(seconds):
+    """ returns elapsed time as squeue %M: m:ss, h:mm:ss or d-hh:mm:ss """
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return '%d-%02d:%02d:%02d' % (days, hours, minutes, seconds)
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds)
+    return '%d:%02d' % (minutes, seconds)
+
+
+def sacct_elapsed(seconds):
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+class fake_slurm(object):
+    """ in memory jobs, and commands run on them """
+
+    def __init__(self, queued_time=5, running_time=10, latency=None,
+                 output_lines=1000, min_job_age=300):
+        self.queued_time = queued_time
+        self.running_time = running_time
+        # command type -> seconds, 'default' for others
+        self.latency = dict(latency) if latency else {}
+        # Lines of output of each job
+        self.output_lines = output_lines
+        # Seconds ended jobs stay in squeue, as Slurm MinJobAge
+        self.min_job_age = min_job_age
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.next_jobid = 1000
+        # command type -> number of calls
+        self.calls = {}
+
+    # ################## JOBS
+
+    def state(self, job, now):
+        """ returns state of job at time now, updating its times """
+        if job['cancelled']:
+            return 'CA'
+        if job['start_time'] is None:
+            if job['held'] or now - job['submit_time'] < self.queued_time:
+                return 'PD'
+            job['start_time'] = job['submit_time'] + self.queued_time
+            job['end_time'] = job['start_time'] + self.running_time
+            job['nodes'] = 'node001'
+        if now < job['end_time']:
+            return 'R'
+        return 'CD'
+
+    def elapsed(self, job, now):
+        if job['start_time'] is None:
+            return 0
+        return max(min(job['end_time'], now) - job['start_time'], 0)
+
+    def job_output(self, name):
+        """ returns output of job name, None if job or file is unknown """
+        with self.lock:
+            for job in self.jobs.values():
+                if job['name'] == 'jarvice_' + name and job['output']:
+                    break
+            else:
+                return None
+        return b''.join(b'%s: line %d of job output\n' % (name.encode(), i)
+                        for i in range(self.output_lines))
+
+    # ################## COMMANDS
+
+    def sbatch(self, user, args, script):
+        held = '-H' in args
+        name = args[args.index('-J') + 1] if '-J' in args else 'sbatch'
+        with self.lock:
+            self.next_jobid += 1
+            jobid = self.next_jobid
+            self.jobs[jobid] = {
+                'jobid': jobid, 'name': name, 'user': user, 'nodes': '',
+                'submit_time': time.time(), 'start_time': None,
+                'end_time': None, 'held': held, 'cancelled': False,
+                'script': script, 'args': args, 'output': True
+            }
+        return '%d\n' % jobid, '', 0
+
+    def squeue(self, args):
+        fmt = '%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R'
+        jobids = None
+        states = None
+        for option, value in zip(args, args[1:]):
+            if option == '-o':
+                fmt = value
+            elif option == '-j':
+                jobids = set(int(i) for i in value.split(',') if i)
+            elif option == '-t':
+                states = None if value == 'all' else value.split(',')
+        if '-t' not in args:
+            states = ['PD', 'R']
+        now = time.time()
+        lines = []
+        with self.lock:
+            for job in self.jobs.values():
+                if jobids is not None and job['jobid'] not in jobids:
+                    continue
+                state = self.state(job, now)
+                if job['end_time'] and \
+                        now - job['end_time'] > self.min_job_age:
+                    continue
+                if states is not None and state not in states:
+                    continue
+                fields = {'j': job['name'], 'A': str(job['jobid']),
+                          'i': str(job['jobid']), 't': state,
+                          'M': squeue_elapsed(self.elapsed(job, now)),
+                          'N': job['nodes'], 'u': job['user']}
+                lines.append(re.sub(r'%\.?\d*([a-zA-Z])',
+                                    lambda m: fields.get(m.group(1), ''),
+                                    fmt))
+        return ''.join(line + '\n' for line in lines), '', 0
+
+    def sacct(self, args):
+        fields = ['jobid', 'jobname', 'state', 'elapsed']
+        jobids = None
+        states = None
+        window = None
+        for option, value in zip(args, args[1:]):
+            if option == '-o':
+                fields = value.lower().split(',')
+            elif option == '-s':
+                states = value.split(',')
+            elif option == '-S' and value.startswith('now-'):
+                window = int(value[4:])
+        for arg in args:
+            if arg.startswith('--jobs='):
+                jobids = set(int(i) for i in arg[7:].split(',') if i)
+        now = time.time()
+        lines = []
+        with self.lock:
+            for job in self.jobs.values():
+                state = self.state(job, now)
+                if jobids is not None:
+                    if job['jobid'] not in jobids:
+                        continue
+                elif job['end_time'] is None or job['end_time'] > now or \
+                        (window is not None and
+                         now - job['end_time'] > window) or \
+                        (states is not None and state not in states):
+                    continue
+                values = {'jobid': str(job['jobid']),
+                          'jobname': job['name'],
+                          'state': long_states.get(state, state),
+                          'elapsed': sacct_elapsed(self.elapsed(job, now))}
+                lines.append('|'.join(values.get(i, '') for i in fields))
+        return ''.join(line + '\n' for line in lines), '', 0
+
+    def scancel(self, args):
+        jobid = int(args[-1])
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if job is None:
+                return '', 'scancel: error: Invalid job id %d\n' % jobid, 1
+            if self.state(job, now) in ['PD', 'R']:
+                job['cancelled'] = True
+                job['end_time'] = now
+        return '', '', 0
+
+    def scontrol(self, args):
+        jobid = int(args[-1])
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if job is None:
+                return '', ('slurm_load_jobs error: Invalid job id '
+                            'specified\n'), 1
+            if args[0] == 'release':
+                if job['held']:
+                    job['held'] = False
+                    # Queued time starts at release
+                    job['submit_time'] = now
+                return '', '', 0
+            state = self.state(job, now)
+            return ('JobId=%d JobName=%s\n   UserId=%s JobState=%s '
+                    'Reason=None\n   RunTime=%s NodeList=%s\n' % (
+                        jobid, job['name'], job['user'],
+                        long_states.get(state, state),
+                        sacct_elapsed(self.elapsed(job, now)),
+                        job['nodes'] or '(null)')), '', 0
+
+    def tail(self, command):
+        """ output_cmd: tail -N file [| tail -c M] """
+        match = re.match(r'tail -(\d+) (\S*?)\.jarvice/(\S+)\.out'
+                         r'(?: \| tail -c (\d+))?$', command)
+        output = self.job_output(match.group(3))
+        if output is None:
+            return '', 'tail: cannot open file\n', 1
+        lines = int(match.group(1))
+        output = b''.join(output.splitlines(keepends=True)[-lines:])
+        if match.group(4):
+            output = output[-int(match.group(4)):]
+        return output, '', 0
+
+    def tail_bytes(self, command):
+        """ offset based tail, see connector tail_bytes """
+        match = re.match(r"f='?\S*?\.jarvice/(.+?)\.out'?; .* -lt (\d+) \]; "
+                         r'then head -c (\d+)', command)
+        output = self.job_output(match.group(1))
+        if output is None:
+            return '', '', 1
+        offset = int(match.group(2))
+        max_bytes = int(match.group(3))
+        start = offset if len(output) >= offset else 0
+        return b'%d\n' % len(output) + output[start:start + max_bytes], \
+            '', 0
+
+    def gc(self, command):
+        """ removal of job output and scripts """
+        for name in re.findall(r'\.jarvice/(\S+)\.out', command):
+            with self.lock:
+                for job in self.jobs.values():
+                    if job['name'] == 'jarvice_' + name:
+                        job['output'] = False
+        return '', '', 0
+
+    @staticmethod
+    def kind(command):
+        """ returns command type, as labelled in connector metrics """
+        if command.startswith('f='):
+            return 'tail'
+        if 'sbatch ' in command:
+            return 'sbatch'
+        if 'nohup rm' in command:
+            return 'rm'
+        if command.startswith('squeue') and ' -j ' in command and \
+                ',' not in command.split(' -j ')[1].split()[0]:
+            return 'squeue1'
+        words = command.split(None, 1)
+        return words[0].split('/')[-1] if words else 'none'
+
+    def run(self, user, command, stdin=b''):
+        """ runs command as user, returns stdout, stderr, exit status """
+        compressed = re.match(r'\{ (.*); \} \| gzip -c -1$', command,
+                              re.DOTALL)
+        if compressed:
+            stdout, stderr, status = self.run(user, compressed.group(1),
+                                              stdin)
+            if isinstance(stdout, str):
+                stdout = stdout.encode()
+            return gzip.compress(stdout, 1), stderr, status
+
+        kind = self.kind(command)
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        latency = self.latency.get(kind, self.latency.get('default', 0))
+        if latency > 0:
+            time.sleep(latency)
+
+        if kind == 'tail':
+            if command.startswith('f='):
+                return self.tail_bytes(command)
+            return self.tail(command)
+        if kind == 'sbatch':
+            # mkdir -p $HOME/.jarvice && sbatch ...
+            args = shlex.split(command.split('&&')[-1])
+            return self.sbatch(user, args, stdin.decode('utf-8', 'replace'))
+        if kind == 'rm':
+            return self.gc(command)
+        args = shlex.split(command)
+        if kind in ['squeue', 'squeue1']:
+            return self.squeue(args)
+        if kind == 'sacct':
+            return self.sacct(args)
+        if kind == 'scancel':
+            return self.scancel(args)
+        if kind == 'scontrol':
+            return self.scontrol(args[1:])
+        if kind in ['true', 'find']:
+            return '', '', 0
+        return '', '%s: command not found\n' % args[0], 127
+
+
+# ################## SSH SERVER
+
+class ssh_server(paramiko.ServerInterface):
+    """ accepts any user and key, runs exec requests on cluster """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.user = None
+        # Accepted channels, closed by paramiko once garbage collected
+        self.channels = set()
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        self.user = username
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.exec_command,
+                         args=(channel, command.decode()),
+                         daemon=True).start()
+        return True
+
+    def exec_command(self, channel, command):
+        try:
+            # Connector always closes stdin, even when not sending data
+            stdin = b''
+            while True:
+                data = channel.recv(65536)
+                if not data:
+                    break
+                stdin += data
+            stdout, stderr, status = self.cluster.run(self.user, command,
+                                                      stdin)
+            channel.sendall(stdout.encode() if isinstance(stdout, str)
+                            else stdout)
+            channel.sendall_stderr(stderr.encode())
+            channel.send_exit_status(status)
+        except Exception as e:
+            try:
+                channel.sendall_stderr(('fake_slurm: %s\n' % e).encode())
+                channel.send_exit_status(1)
+            except Exception:
+                pass
+        finally:
+            channel.close()
+            self.channels.discard(channel)
+
+
+def handle(connection, host_key, cluster):
+    # Small replies must not wait for delayed acknowledgements
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    transport = paramiko.Transport(connection)
+    transport.add_server_key(host_key)
+    server = ssh_server(cluster)
+    try:
+        transport.start_server(server=server)
+    except (paramiko.SSHException, EOFError):
+        transport.close()
+        return
+    # Channels are served by server callbacks, keep accepting them
+    while transport.is_active():
+        channel = transport.accept(1)
+        if channel is not None:
+            server.channels.add(channel)
+
+
+def serve(host='127.0.0.1', port=2222, queued_time=5, running_time=10,
+          latency=None, output_lines=1000):
+    """ starts fake cluster in a background thread, returns it """
+    cluster = fake_slurm(queued_time, running_time, latency, output_lines)
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    cluster.port = listener.getsockname()[1]
+
+    def accept():
+        while True:
+            connection, address = listener.accept()
+            threading.Thread(target=handle,
+                             args=(connection, host_key, cluster),
+                             daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return cluster
+
+
+def parse_latency(values):
+    """ returns {command: seconds} of command=seconds strings """
+    latency = {}
+    for value in values:
+        command, sep, seconds = value.partition('=')
+        if not sep:
+            raise ValueError('Invalid latency %s, expecting command=seconds'
+                             % value)
+        latency[command] = float(seconds)
+    return latency
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='fake Slurm cluster')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2222)
+    parser.add_argument('--queued-time', type=float, default=5)
+    parser.add_argument('--running-time', type=float, default=10)
+    parser.add_argument('--output-lines', type=int, default=1000)
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='COMMAND=SECONDS',
+                        help='latency of a command type (squeue, squeue1, '
+                        'sacct, sbatch, scancel, scontrol, tail, rm), or '
+                        'default=SECONDS for all')
+    args = parser.parse_args()
+
+    cluster = serve(args.host, args.port, args.queued_time,
+                    args.running_time, parse_latency(args.latency),
+                    args.output_lines)
+    print('fake Slurm cluster listening on %s:%d' % (args.host, cluster.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
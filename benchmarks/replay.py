@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Replay of a trace of upstream calls, recorded with JARVICE_TRACE_FILE (see
+# tracing.py), against a DSSR: calls are issued at their recorded pacing, or
+# --speed times faster, whatever the time answers take.
+# Jobs ids answered by replayed submissions replace recorded ones in later
+# calls of these jobs. Jobs used in the trace but submitted before recording
+# started are submitted first. Scrubbed bearer tokens and job scripts are
+# replaced by benchmark ones, of the same size for scripts.
+# Latencies of each route are reported along with recorded ones, and
+# answers differing from recorded ones are counted.
+#
+# Usage, from repository root:
+#   python3 -m benchmarks.replay trace.jsonl --serve dummy --speed 10
+#   python3 -m benchmarks.replay trace.jsonl --serve slurm \
+#       --latency default=0.01 --json replay.json
+#   python3 -m benchmarks.replay trace.jsonl --url http://127.0.0.1:5000 \
+#       --bearer $TOKEN
+
+import argparse
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from base64 import b64encode
+
+import tracing
+from benchmarks import fake_slurm
+from benchmarks.bench_connector import hpc_script, percentile, setup
+from benchmarks.bench_http import client, report_routes, route_stats, \
+    start_server
+
+
+def record_jobs(record):
+    """ returns [(name, number, jobid), ...] of jobs a record refers to """
+    args = record.get('args') or {}
+    if record['route'] == '/request/<path:path>':
+        parts = record['path'].split('/')
+        if len(parts) >= 5:
+            return [(parts[2], parts[3], parts[4])]
+        return []
+    if 'jobs' in args:
+        return [(job['name'], job['number'], job['jobid'])
+                for job in args['jobs']]
+    if 'jobid' in args:
+        return [(args['name'], args['number'], args['jobid'])]
+    return []
+
+
+def initial_jobs(records):
+    """ returns jobs used by records before being submitted in them """
+    submitted = set()
+    jobs = {}
+    for record in records:
+        if record['route'] == '/submit':
+            submitted.add((record.get('args') or {}).get('name'))
+            continue
+        for name, number, jobid in record_jobs(record):
+            if name not in submitted and name not in jobs:
+                jobs[name] = (name, int(number), jobid)
+    return list(jobs.values())
+
+
+class replayer(object):
+    """ replays records with a client per thread """
+
+    def __init__(self, url, bearers, compression=False):
+        self.url = url
+        self.bearers = bearers
+        self.compression = compression
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Job name -> job id answered by replayed submission
+        self.jobids = {}
+        self.stats = {}
+        self.mismatches = {}
+        self.lags = []
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = client(self.url, self.bearers, None,
+                                       self.compression)
+        return self.local.client
+
+    def bearer(self, name):
+        return self.bearers[zlib.crc32(name.encode()) % len(self.bearers)]
+
+    def script(self, scrubbed):
+        """ returns a benchmark job script of the size of scrubbed one """
+        script = {'singularity': b64encode(hpc_script.encode()).decode()}
+        size = scrubbed.get('scrubbed', 0) if isinstance(scrubbed, dict) \
+            else 0
+        padding = int((size - len(json.dumps(script))) * 3 / 4)
+        if padding > 0:
+            script['singularity'] = b64encode(
+                (hpc_script + '#' + 'x' * padding + '\n').encode()).decode()
+        return script
+
+    def jobid(self, name, jobid):
+        with self.lock:
+            return self.jobids.get(name, jobid)
+
+    def rewrite(self, record):
+        """ returns path and args of record, for target DSSR """
+        path = record['path']
+        args = copy.deepcopy(record.get('args'))
+        if record['route'] == '/submit':
+            args['bearer'] = self.bearer(args['name'])
+            args['hpc_script'] = self.script(args['hpc_script'])
+        elif record['route'] == '/request/<path:path>':
+            parts = path.split('/')
+            if len(parts) >= 5:
+                parts[4] = self.jobid(parts[2], parts[4])
+                path = '/'.join(parts)
+        elif args and 'jobs' in args:
+            for job in args['jobs']:
+                job['jobid'] = self.jobid(job['name'], job['jobid'])
+        elif args and 'jobid' in args:
+            args['jobid'] = self.jobid(args['name'], args['jobid'])
+        return path, args
+
+    def submit(self, name, number):
+        """ submits a job outside of replayed records """
+        status, data = self.client().call('POST', '/submit', {
+            'name': name, 'number': number, 'nodes': 1,
+            'hpc_script': self.script(None), 'bearer': self.bearer(name)})
+        if status != 200:
+            raise Exception('Submission of %s failed with HTTP %d'
+                            % (name, status))
+        with self.lock:
+            self.jobids[name] = json.loads(data)[0]
+
+    def play(self, record, due):
+        route = record['route']
+        start = time.perf_counter()
+        lag = time.monotonic() - due
+        status, error = 0, None
+        try:
+            path, args = self.rewrite(record)
+            status, data = self.client().call(record['method'], path, args)
+            if route == '/submit' and status == 200:
+                with self.lock:
+                    self.jobids[args['name']] = json.loads(data)[0]
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.lags.append(lag)
+            self.stats.setdefault(route, route_stats()).add(
+                seconds, status, error)
+            if status != record['status']:
+                self.mismatches[route] = self.mismatches.get(route, 0) + 1
+
+    def replay(self, records, speed, concurrency):
+        """ issues records at their pacing, divided by speed """
+        executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        origin = records[0]['t']
+        start = time.monotonic()
+        for record in records:
+            due = start + (record['t'] - origin) / speed if speed else start
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(self.play, record, due)
+        executor.shutdown(wait=True)
+        return time.monotonic() - start
+
+
+def recorded_stats(records):
+    """ returns route_stats of records, as answered when recorded """
+    stats = {}
+    for record in records:
+        stats.setdefault(record['route'], route_stats()).add(
+            record['duration'], record['status'])
+    return stats
+
+
+def report(records, r, elapsed, out=sys.stdout):
+    span = records[-1]['t'] - records[0]['t']
+    out.write('\nrecorded, %.1f s\n' % span)
+    report_routes(recorded_stats(records), span, out)
+    out.write('\nreplayed, %.1f s\n' % elapsed)
+    total = report_routes(r.stats, elapsed, out)
+    lags = sorted(r.lags)
+    out.write('\ndispatch lag p50 %.2f ms, p99 %.2f ms, max %.2f ms\n' % (
+        percentile(lags, 0.5) * 1000, percentile(lags, 0.99) * 1000,
+        lags[-1] * 1000 if lags else 0))
+    for route, count in sorted(r.mismatches.items()):
+        out.write('%s: %d answers differ from recorded ones\n'
+                  % (route, count))
+    return total
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description='Replay of a trace of upstream calls')
+    parser.add_argument('trace', help='trace file, see JARVICE_TRACE_FILE')
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+                        help='DSSR to replay against, if not started with '
+                        '--serve')
+    parser.add_argument('--serve', choices=['dummy', 'slurm'],
+                        help='start a DSSR with waitress, with the dummy '
+                        'connector or against a fake Slurm cluster')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='pacing multiple, 2 replays twice as fast. '
+                        '0 replays as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='maximum calls in flight')
+    parser.add_argument('--bearer', action='append', default=[],
+                        help='bearer token of submissions, with --url')
+    parser.add_argument('--users', type=int, default=4,
+                        help='fake Slurm mapped users')
+    parser.add_argument('--compression', action='store_true',
+                        help='accept gzip compressed answers')
+    parser.add_argument('--queued-time', type=float, default=5)
+    parser.add_argument('--running-time', type=float, default=60)
+    parser.add_argument('--output-lines', type=int, default=1000,
+                        help='fake Slurm jobs output lines')
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='COMMAND=SECONDS',
+                        help='fake Slurm command latency, or '
+                        'default=SECONDS for all')
+    parser.add_argument('--env', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='started DSSR setting, like WAITRESS_THREADS=16')
+    parser.add_argument('--json', help='also write results to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    json_path = os.path.abspath(args.json) if args.json else None
+    records = tracing.load(args.trace)
+    if not records:
+        raise Exception('No record in %s' % args.trace)
+    environment = dict(i.split('=', 1) for i in args.env)
+
+    process = None
+    cluster = None
+    url = args.url
+    bearers = args.bearer or ['replay']
+    if args.serve:
+        workdir = tempfile.mkdtemp(prefix='jarvice-replay-')
+        if args.serve == 'dummy':
+            os.environ.update({
+                'JARVICE_BAREMETAL_CONNECTOR': 'connectors.dummy.connector',
+                'JARVICE_DUMMY_JOB_QUEUED_TIME': str(int(args.queued_time)),
+                'JARVICE_DUMMY_JOB_RUNNING_TIME': str(int(args.running_time))
+            })
+            os.environ.update(environment)
+        else:
+            cluster = fake_slurm.serve(
+                port=0, queued_time=args.queued_time,
+                running_time=args.running_time,
+                latency=fake_slurm.parse_latency(args.latency),
+                output_lines=args.output_lines)
+            bearers = setup(cluster.port, workdir, args.users, environment)
+        process, url = start_server(workdir)
+        sys.stdout.write('DSSR started on %s, in %s\n' % (url, workdir))
+
+    try:
+        r = replayer(url, bearers, args.compression)
+        jobs = initial_jobs(records)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda job: r.submit(job[0], job[1]), jobs))
+        sys.stdout.write('%d records, %d jobs submitted before replay\n'
+                         % (len(records), len(jobs)))
+        elapsed = r.replay(records, args.speed, args.concurrency)
+        total = report(records, r, elapsed)
+        if cluster:
+            sys.stdout.write('remote commands: %s\n' % json.dumps(
+                dict(sorted(cluster.calls.items()))))
+        if json_path:
+            with open(json_path, 'w') as file:
+                json.dump({
+                    'trace': os.path.abspath(args.trace), 'url': url,
+                    'serve': args.serve, 'speed': args.speed,
+                    'environment': environment, 'duration': elapsed,
+                    'recorded': dict(
+                        (route, s.as_dict(records[-1]['t'] - records[0]['t']))
+                        for route, s in recorded_stats(records).items()),
+                    'routes': dict((route, s.as_dict(elapsed))
+                                   for route, s in r.stats.items()),
+                    'total': total.as_dict(elapsed),
+                    'mismatches': r.mismatches}, file, indent=2)
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
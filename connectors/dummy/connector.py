@@ -1,10 +1,13 @@
 import sqlite3
 import os
+import threading
 import time
 import random
 import datetime
 import json
-from contextlib import closing
+
+from . import simulation
+from ..metrics import metrics, flatten
 
 class baremetal_connector(object):
 
@@ -19,81 +22,121 @@ class baremetal_connector(object):
         self.job_failing_percent = int(os.getenv('JARVICE_DUMMY_JOB_FAILING_PERCENT', '50'))
         # Make jobs interactive and return a fake url
         self.jobs_are_interactive = os.getenv('JARVICE_DUMMY_JOBS_ARE_INTERACTIVE', 'False')
+        # Artificial latency of end points, as endpoint=seconds,... with default=seconds for all others
+        self.latency = {}
+        for item in os.getenv('JARVICE_DUMMY_LATENCY', '').split(','):
+            if item.strip():
+                endpoint, sep, seconds = item.partition('=')
+                if not sep:
+                    raise ValueError('Invalid JARVICE_DUMMY_LATENCY entry ' + item + ', expecting endpoint=seconds')
+                self.latency[endpoint.strip()] = float(seconds)
+
+        # Simulation mode: jobs are scheduled in memory on a simulated cluster,
+        # with lognormal queue waits and runtimes of given medians
+        self.simulation = None
+        if os.getenv('JARVICE_DUMMY_SIMULATION', 'false').lower() == 'true':
+            seed = os.getenv('JARVICE_DUMMY_SIM_SEED')
+            self.simulation = simulation.cluster(
+                nodes=int(os.getenv('JARVICE_DUMMY_SIM_NODES', '100')),
+                wait_median=self.job_queued_time,
+                wait_sigma=float(os.getenv('JARVICE_DUMMY_SIM_QUEUED_TIME_SIGMA', '1')),
+                runtime_median=self.job_running_time,
+                runtime_sigma=float(os.getenv('JARVICE_DUMMY_SIM_RUNNING_TIME_SIGMA', '1')),
+                failing_percent=self.job_failing_percent,
+                seed=int(seed) if seed else None)
+            metrics.collector(lambda: flatten(self.simulation.stats(), 'jarvice_dummy_simulation'))
+            print('Dummy init done, simulating ' + str(self.simulation.nodes) + ' nodes')
+            return
 
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                cursor.execute("CREATE TABLE IF NOT EXISTS jobs (name TEXT, number INTEGER, jobid TEXT, starttime INTEGER)")
+        # Single connection shared by all requests, serialized by lock, autocommit mode
+        # WAL mode so that writes do not rewrite the whole journal
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect("jobs.db", check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS jobs (name TEXT, number INTEGER, jobid TEXT, starttime INTEGER)")
+        # Jobs are looked up by name, and states are time windows on starttime
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_name ON jobs (name)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_starttime ON jobs (starttime)")
 
         print('Dummy init done, db created or exists')
 
+    def query(self, sql, parameters=()):
+        """ runs a statement on shared connection, returns all rows """
+        with self.lock:
+            try:
+                return self.connection.execute(sql, parameters).fetchall()
+            except sqlite3.Error as e:
+                raise Exception(e)
+
+    def delay(self, endpoint):
+        """ waits for artificial latency of endpoint, if any """
+        seconds = self.latency.get(endpoint, self.latency.get('default', 0))
+        if seconds > 0:
+            time.sleep(seconds)
+
     def gc(self):
         """ garbage collection endpoint; fail if cluster not reachable """
+        self.delay('gc')
+        if self.simulation:
+            return 200
         # Check we can dialogate with DB, since its our fake cluster
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                try:
-                    cursor.execute("PRAGMA integrity_check")
-                except sqlite3.DatabaseError:
-                    return 500
-                return 200
+        # A full integrity check would read every job at each call
+        with self.lock:
+            try:
+                self.connection.execute("SELECT 1 FROM jobs LIMIT 1").fetchall()
+            except sqlite3.DatabaseError:
+                return 500
+            return 200
 
     def submit(self, name, number, nodes, hpc_script, bearer, held=False):
         """ submits a job for scheduling """
+        self.delay('submit')
+        if self.simulation:
+            jobid = self.simulation.submit(name, number, nodes, held)
+            return jobid, "SIMULATED JOB " + jobid + " ON " + str(nodes) + " NODES"
         # For this dummy code, submitting a job is just adding it in the DB, with start time from epoch (time.time())
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                try:
-                    entry = "INSERT INTO jobs VALUES " + str((name, str(number), "dummy_" + str(number), str(int(time.time()))))
-                    cursor.execute(entry)
-                    connection.commit()
-                except sqlite3.Error as e:
-                    raise Exception(e) 
-                return "dummy_" + str(number), entry
+        jobid = "dummy_" + str(number)
+        starttime = int(time.time())
+        self.query("INSERT INTO jobs VALUES (?, ?, ?, ?)", (name, int(number), jobid, starttime))
+        # Script returned is the job entry, as text
+        return jobid, "INSERT INTO jobs VALUES " + str((name, str(number), jobid, str(starttime)))
 
     def queued(self):
         """ returns list of queued jobs as [(name, jobid), ...]"""
-        queueds = []
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                try:
-                    jobs = cursor.execute("SELECT name, number, jobid, starttime FROM jobs").fetchall()
-                    current_time = int(time.time())
-                    for job in jobs:
-                        job_starttime = int(job[3])
-                        if current_time - job_starttime < self.job_queued_time :
-                            queueds.append([job[0], job[2]])
-                except sqlite3.Error as e:
-                    raise Exception(e) 
-                return queueds
+        self.delay('queued')
+        if self.simulation:
+            # Held jobs included
+            return self.simulation.jobs_in('PENDING')
+        # Queued jobs started less than job_queued_time ago
+        current_time = int(time.time())
+        return [list(job) for job in self.query(
+            "SELECT name, jobid FROM jobs WHERE starttime > ?",
+            (current_time - self.job_queued_time,))]
 
     def running(self):
         """ returns list of running jobs as [(name, jobid), ...]"""
-        queueds = []
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                try:
-                    jobs = cursor.execute("SELECT name, number, jobid, starttime FROM jobs").fetchall()
-                    current_time = int(time.time())
-                    for job in jobs:
-                        job_starttime = int(job[3])
-                        if (current_time - job_starttime > self.job_queued_time ) and (current_time - job_starttime < self.job_queued_time + self.job_running_time) :
-                            queueds.append([job[0], job[2]])
-                except sqlite3.Error as e:
-                    raise Exception(e) 
-                return queueds
+        self.delay('running')
+        if self.simulation:
+            return self.simulation.jobs_in('RUNNING')
+        # Running jobs started more than job_queued_time ago, and less than job_queued_time + job_running_time ago
+        current_time = int(time.time())
+        return [list(job) for job in self.query(
+            "SELECT name, jobid FROM jobs WHERE starttime < ? AND starttime > ?",
+            (current_time - self.job_queued_time,
+             current_time - self.job_queued_time - self.job_running_time))]
 
     def exitstatus(self, name, number, jobid):
         """ returns exit status of a completed job """
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                try:
-                    # Grab job from database by name
-                    job = cursor.execute("SELECT name, number, jobid, starttime FROM jobs WHERE name = ?", (name,),).fetchall()
-                    # Now delete job from database, this is garbage collect step
-                    cursor.execute("DELETE FROM jobs WHERE name = ?", (name,))
-                    connection.commit()
-                except sqlite3.Error as e:
-                    raise Exception(e) 
+        self.delay('exitstatus')
+        if self.simulation:
+            return self.simulated_exitstatus(name)
+        # Delete job from database, this is garbage collect step
+        self.query("DELETE FROM jobs WHERE name = ?", (name,))
+        return self.job_exitstatus(name)
+
+    def job_exitstatus(self, name):
+        """ returns exit status of a garbage collected job """
         # Ok, should the job be considered COMPLETED or FAILED ?
         if random.randint(0, 100) < self.job_failing_percent :
             rc = 1
@@ -106,20 +149,77 @@ class baremetal_connector(object):
         state = '<< termination state: %s -- see STDOUT for job errors if any >>' % state
         return rc, totaltime, [stdout, state]
 
+    def simulated_exitstatus(self, name):
+        """ returns exit status of a simulated job, and garbage collects it """
+        state, runtime = self.simulation.collect(name)
+        # Exit codes as expected by upstream, -9 for anything else
+        rc = {'COMPLETED': 0, 'FAILED': 1, 'CANCELLED': -15}.get(state, -9)
+        totaltime = str(datetime.timedelta(seconds=int(runtime)))
+        stdout = "This is job " + str(name) + "\nAnd I runned for " + totaltime
+        state = '<< termination state: %s -- see STDOUT for job errors if any >>' % state
+        return rc, totaltime, [stdout, state]
+
+    def exitstatus_batch(self, jobs):
+        """ returns exit status of many completed jobs, as a list of exitstatus() results """
+        self.delay('exitstatus_batch')
+        if self.simulation:
+            return [self.simulated_exitstatus(name) for name, number, jobid in jobs]
+        # All jobs are garbage collected in a single transaction
+        with self.lock:
+            try:
+                self.connection.execute("BEGIN")
+                self.connection.executemany("DELETE FROM jobs WHERE name = ?",
+                                            [(name,) for name, number, jobid in jobs])
+                self.connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self.connection.in_transaction:
+                    self.connection.execute("ROLLBACK")
+                raise Exception(e)
+        return [self.job_exitstatus(name) for name, number, jobid in jobs]
+
     def runstatus(self, name=None, number=None, jobid=None, nc={}):
         """ returns running status of a single job """
-        with closing(sqlite3.connect("jobs.db")) as connection:
-            with closing(connection.cursor()) as cursor:
-                try:
-                    # Grab job from database by name
-                    job = cursor.execute("SELECT name, number, jobid, starttime FROM jobs WHERE name = ?", (name,),).fetchall()
-                except sqlite3.Error as e:
-                    raise Exception(e) 
-        elapsedtime = str(datetime.timedelta(seconds=(int(time.time()) - int(job[0][3]))))
+        self.delay('runstatus')
+        if self.simulation:
+            elapsedtime = str(datetime.timedelta(seconds=int(self.simulation.elapsed(name))))
+            return ("simulated", elapsedtime, name + '/' + str(number) + '/' + jobid, None)
+        # Grab job from database by name
+        job = self.query("SELECT starttime FROM jobs WHERE name = ? LIMIT 1", (name,))
+        if not job:
+            raise Exception("Job " + str(name) + " not found")
+        elapsedtime = str(datetime.timedelta(seconds=(int(time.time()) - int(job[0][0]))))
         return ("sqlite3_dummy", elapsedtime, name + '/' + str(number) + '/' + jobid, None)
 
+    def runstatus_batch(self, jobs):
+        """ returns running status of many jobs, as a list of runstatus() results """
+        self.delay('runstatus_batch')
+        if self.simulation:
+            return [("simulated", str(datetime.timedelta(seconds=int(self.simulation.elapsed(name)))),
+                     name + '/' + str(number) + '/' + jobid, None) for name, number, jobid in jobs]
+        # Start times of all jobs, by chunks to stay below SQLite variables limit
+        names = list(set(name for name, number, jobid in jobs))
+        starttimes = {}
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            starttimes.update(self.query(
+                "SELECT name, starttime FROM jobs WHERE name IN (%s)" % ', '.join('?' * len(chunk)),
+                chunk))
+        current_time = int(time.time())
+        statuses = []
+        for name, number, jobid in jobs:
+            if name not in starttimes:
+                raise Exception("Job " + str(name) + " not found")
+            elapsedtime = str(datetime.timedelta(seconds=(current_time - int(starttimes[name]))))
+            statuses.append(("sqlite3_dummy", elapsedtime, name + '/' + str(number) + '/' + jobid, None))
+        return statuses
+
     def terminate(self, name, number, jobid, force=False, nodes=[]):
         """ terminates a job """
+        self.delay('terminate')
+        if self.simulation:
+            # Unknown jobs were already garbage collected
+            self.simulation.terminate(name)
+            return True
         # We cannot terminate a job that do not run.
         # We could add a specific entry in the DB to state if a job is terminated or not, but not worth it here.
         # Best way is just to answer that it was terminated (so return True),
@@ -133,17 +233,24 @@ class baremetal_connector(object):
 
     def release(self, name, number, jobid):
         """ releases a held job """
+        self.delay('release')
+        if self.simulation:
+            return self.simulation.release(name)
         # We do not manage jobs held in this dummy code, lets just say "ok it was released"
         return True
 
     def events(self, name, number, jobid):
         """ returns list of events associated with job """
+        self.delay('events')
+        if self.simulation:
+            return "This is events for job " + name + " \n Job is " + self.simulation.state(name) + "."
         # In normal time, we return here events for the job running
         # But nothing here for this dummy code, so lets just answer something generic
         return "This is events for job " + name + " \n Nothing to say, everything is ok."
 
     def request(self, path, qs):
         """ handle arbitrary request to the scheduler """
+        self.delay('request')
 
         # response helpers
         def rsp(code, content_type=None, content=None):
@@ -186,6 +293,26 @@ Lorem ipsum dolor sit amet, consectetur adipiscing elit. Curabitur ac justo veli
 
 Pellentesque scelerisque nunc turpis, ac porta purus lobortis sit amet. Aliquam tincidunt sit amet ipsum ac finibus. Donec non enim non leo rhoncus auctor id vel metus. Class aptent taciti sociosqu ad litora torquent per conubia nostra, per inceptos himenaeos. Cras ligula lorem, condimentum scelerisque convallis sed, mattis quis odio. Aliquam tincidunt ullamcorper lorem, id lobortis diam varius at. Sed laoreet justo vel egestas pulvinar. Suspendisse quis nunc quis odio commodo suscipit. 
 """.format(name=jobname)
+            if 'offset' in qs:
+                # Incremental mode, same answer format as real connectors
+                data = stdout.encode()
+                try:
+                    offset = int(qs['offset'][0])
+                    assert (offset >= 0)
+                except Exception:
+                    return rsp(400)
+                try:
+                    max_bytes = int(qs['max_bytes'][0])
+                    assert (max_bytes > 0)
+                except Exception:
+                    max_bytes = 65536
+                chunk = data[offset:offset + max_bytes]
+                return rsp_json(200, {
+                    'offset': offset + len(chunk),
+                    'size': len(data),
+                    'content': chunk.decode(errors='replace'),
+                    'more': offset + len(chunk) < len(data)
+                })
             return rsp(200, content_type='text/plain',
                        content=stdout) if stdout else rsp(404)
         elif method == 'screenshot':
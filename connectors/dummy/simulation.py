@@ -0,0 +1,231 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Simulated cluster for the dummy connector, to load test upstream at
+# cluster scale without a scheduler.
+# Jobs wait a lognormal time before being eligible (scheduling, provisioning),
+# then start in submission order once enough nodes are free, and run for a
+# lognormal time. Held jobs are not eligible until released, terminated jobs
+# end right away. Jobs are kept in memory, and the simulation is advanced to
+# current time at each call, so that its cost only depends on state changes.
+
+import collections
+import heapq
+import math
+import random
+import threading
+import time
+
+
+class job(object):
+    """ simulated job """
+
+    def __init__(self, name, number, nodes, wait, runtime, failing, held):
+        self.name = name
+        self.number = number
+        self.jobid = 'dummy_' + str(number)
+        self.nodes = nodes
+        self.wait = wait
+        self.runtime = runtime
+        self.failing = failing
+        self.held = held
+        self.submitted = None
+        self.eligible = None
+        self.start = None
+        self.end = None
+        # PENDING, RUNNING, COMPLETED, FAILED, CANCELLED
+        self.state = 'PENDING'
+
+    @property
+    def active(self):
+        return self.state in ['PENDING', 'RUNNING']
+
+
+class cluster(object):
+    """
+    Simulated cluster of nodes. Queue waits and runtimes are lognormal,
+    given by their median and the sigma of their logarithm (0 for
+    constant values).
+    """
+
+    def __init__(self, nodes=100, wait_median=5, wait_sigma=1,
+                 runtime_median=60, runtime_sigma=1, failing_percent=0,
+                 seed=None, clock=time.time):
+        if nodes < 1:
+            raise ValueError('Simulated cluster needs at least one node')
+        self.nodes = nodes
+        self.free = nodes
+        self.wait = (math.log(max(wait_median, 1e-6)), wait_sigma)
+        self.runtime = (math.log(max(runtime_median, 1e-6)), runtime_sigma)
+        self.failing_percent = failing_percent
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.lock = threading.Lock()
+        # name -> job, until garbage collected by exitstatus
+        self.jobs = {}
+        # Submitted jobs not yet eligible, as (eligible, sequence, job)
+        self.waiting = []
+        # Eligible jobs waiting for nodes, in eligibility order
+        self.ready = collections.deque()
+        # Running jobs, as (end, sequence, job)
+        self.running_jobs = []
+        self.sequence = 0
+
+    def lognormal(self, parameters):
+        mu, sigma = parameters
+        return self.random.lognormvariate(mu, sigma) if sigma > 0 \
+            else math.exp(mu)
+
+    def advance(self, now):
+        """ runs simulation up to now, in events order """
+        while True:
+            eligible = self.waiting[0][0] if self.waiting else math.inf
+            end = self.running_jobs[0][0] if self.running_jobs else math.inf
+            t = min(eligible, end)
+            if t > now:
+                return
+            if end <= eligible:
+                j = heapq.heappop(self.running_jobs)[2]
+                if j.state == 'RUNNING':
+                    j.state = 'FAILED' if j.failing else 'COMPLETED'
+                    self.free += j.nodes
+            else:
+                j = heapq.heappop(self.waiting)[2]
+                if j.state == 'PENDING' and not j.held:
+                    self.ready.append(j)
+            self.schedule(t)
+
+    def schedule(self, now):
+        """ starts ready jobs, first come first served, while nodes fit """
+        while self.ready:
+            j = self.ready[0]
+            if j.state != 'PENDING':
+                # Terminated while waiting
+                self.ready.popleft()
+                continue
+            if j.nodes > self.free:
+                return
+            self.ready.popleft()
+            self.free -= j.nodes
+            j.state = 'RUNNING'
+            j.start = now
+            j.end = now + j.runtime
+            self.push(self.running_jobs, j.end, j)
+
+    def push(self, heap, t, j):
+        self.sequence += 1
+        heapq.heappush(heap, (t, self.sequence, j))
+
+    def enqueue(self, j, now):
+        j.eligible = now + j.wait
+        self.push(self.waiting, j.eligible, j)
+
+    def submit(self, name, number, nodes, held=False):
+        """ submits a job, returns its job id """
+        nodes = int(nodes)
+        if nodes < 1 or nodes > self.nodes:
+            raise Exception(f'Job {name} requests {nodes} nodes, simulated '
+                            f'cluster has {self.nodes}')
+        with self.lock:
+            now = self.clock()
+            self.advance(now)
+            previous = self.jobs.get(name)
+            if previous and previous.active:
+                self.stop(previous, 'CANCELLED', now)
+            j = job(name, number, nodes, self.lognormal(self.wait),
+                    self.lognormal(self.runtime),
+                    self.random.uniform(0, 100) < self.failing_percent, held)
+            j.submitted = now
+            self.jobs[name] = j
+            if not held:
+                self.enqueue(j, now)
+            return j.jobid
+
+    def stop(self, j, state, now):
+        if j.state == 'RUNNING':
+            self.free += j.nodes
+            j.end = now
+        elif j.state == 'PENDING':
+            j.start = j.end = now
+        j.state = state
+        self.schedule(now)
+
+    def release(self, name):
+        """ releases a held job, returns False if job is not held """
+        with self.lock:
+            now = self.clock()
+            self.advance(now)
+            j = self.jobs.get(name)
+            if j is None or j.state != 'PENDING' or not j.held:
+                return False
+            j.held = False
+            self.enqueue(j, now)
+            return True
+
+    def terminate(self, name):
+        """ terminates a job, returns False if job is unknown """
+        with self.lock:
+            now = self.clock()
+            self.advance(now)
+            j = self.jobs.get(name)
+            if j is None:
+                return False
+            if j.active:
+                self.stop(j, 'CANCELLED', now)
+            return True
+
+    def jobs_in(self, state):
+        """ returns [[name, jobid], ...] of jobs in state """
+        with self.lock:
+            self.advance(self.clock())
+            return [[j.name, j.jobid] for j in self.jobs.values()
+                    if j.state == state]
+
+    def find(self, name):
+        """ returns job of name and current time, raises if unknown """
+        now = self.clock()
+        self.advance(now)
+        j = self.jobs.get(name)
+        if j is None:
+            raise Exception(f'Job {name} not found')
+        return j, now
+
+    def elapsed(self, name):
+        """ returns seconds job has been running """
+        with self.lock:
+            j, now = self.find(name)
+            if j.start is None:
+                return 0
+            return (j.end if j.end is not None and j.end < now else now) - \
+                j.start
+
+    def state(self, name):
+        with self.lock:
+            return self.find(name)[0].state
+
+    def collect(self, name):
+        """
+        garbage collects job, returns its final state and runtime.
+        A job still active is cancelled.
+        """
+        with self.lock:
+            now = self.clock()
+            self.advance(now)
+            j = self.jobs.pop(name, None)
+            if j is None:
+                return 'UNKNOWN', 0
+            if j.active:
+                self.stop(j, 'CANCELLED', now)
+            return j.state, (j.end - j.start) if j.start is not None else 0
+
+    def stats(self):
+        with self.lock:
+            self.advance(self.clock())
+            states = collections.Counter(j.state.lower()
+                                         for j in self.jobs.values())
+            return {'nodes': self.nodes, 'free_nodes': self.free,
+                    'jobs': dict(states)}
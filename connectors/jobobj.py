@@ -0,0 +1,107 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Parser of the KEY=value header of upstream job scripts, shared by
+# connectors.
+
+import json
+
+
+class job_descriptor(object):
+    """
+    Job settings found in upstream hpc_script, as typed values.
+
+    The script is read once. For each key, the first KEY=value line wins,
+    and a value that is empty or starts with '=' counts as unset.
+    """
+
+    # attribute -> (script key, kind, default)
+    # kind is str, int, bool (unset or anything but False is True)
+    # or json (malformed or unset is default)
+    keys = {
+        'interactive': ('JOBOBJ_INTERACTIVE', 'bool', True),
+        'appdefversion': ('JOBOBJ_APPDEFVERSION', 'int', None),
+        'arch': ('JOBOBJ_ARCH', 'str', None),
+        'nae': ('JOBOBJ_NAE', 'str', None),
+        'repo': ('JOBOBJ_REPO', 'str', None),
+        'ctrsecret': ('JOBOBJ_CTRSECRET', 'str', None),
+        'user': ('JOBOBJ_USER', 'str', None),
+        'docker_secret': ('JOBOBJ_DOCKER_SECRET', 'json', {}),
+        'devices': ('JOBOBJ_DEVICES', 'json', {}),
+        'gpus': ('JOBOBJ_GPUS', 'int', 0),
+        'ram': ('JOBOBJ_RAM', 'int', 0),
+        'licenses': ('JOBOBJ_LICENSES', 'str', None),
+        'walltime': ('JOBOBJ_WALLTIME', 'str', None),
+        'cores': ('JARVICE_CPU_CORES', 'int', None),
+        'cmd': ('JARVICE_CMD', 'str', None)
+    }
+    # Keys that must be set
+    required = ['appdefversion', 'cores']
+
+    __slots__ = list(keys.keys()) + ['warnings']
+
+    # script key -> attribute
+    attributes = dict((key, attribute)
+                      for attribute, (key, kind, default) in keys.items())
+
+    def __init__(self, **values):
+        # Non fatal parsing issues, like malformed json values
+        self.warnings = []
+        for attribute, (key, kind, default) in self.keys.items():
+            setattr(self, attribute, values.get(attribute, self.copy(default)))
+
+    @staticmethod
+    def copy(default):
+        return dict(default) if isinstance(default, dict) else default
+
+    @classmethod
+    def find_keys(cls, script):
+        """ returns {script key: raw value or None} of known keys found """
+        found = {}
+        for line in script.splitlines():
+            key, sep, value = line.partition('=')
+            if not sep or key not in cls.attributes or key in found:
+                continue
+            found[key] = None if value == '' or value[0] == '=' else value
+            if len(found) == len(cls.attributes):
+                break
+        return found
+
+    @classmethod
+    def parse(cls, script):
+        """ returns job_descriptor of script, raises ValueError if invalid """
+        job = cls()
+        found = cls.find_keys(script)
+        for attribute, (key, kind, default) in cls.keys.items():
+            value = found.get(key)
+            if value is None:
+                if attribute in cls.required:
+                    raise ValueError(f'Missing {key} in job script')
+                continue
+            if kind == 'bool':
+                value = value != 'False'
+            elif kind == 'int':
+                try:
+                    value = int(value)
+                except ValueError:
+                    raise ValueError(
+                        f'Invalid {key} value "{value}": must be an integer')
+            elif kind == 'json':
+                try:
+                    value = json.loads(value)
+                except json.decoder.JSONDecodeError as e:
+                    job.warnings.append(f'Ignoring malformed {key}: {e}')
+                    value = cls.copy(default)
+            setattr(job, attribute, value)
+        return job
+
+    def __repr__(self):
+        # Secrets are not shown
+        return 'job_descriptor(%s)' % ', '.join(
+            '%s=%r' % (attribute, getattr(self, attribute))
+            for attribute in self.keys
+            if attribute not in ['ctrsecret', 'docker_secret'])
@@ -0,0 +1,198 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Minimal metrics registry, rendered in Prometheus text exposition format.
+# Counters and histograms are updated by the front end and connectors,
+# gauges are read from collector functions when metrics are rendered.
+
+import bisect
+import logging
+import math
+import threading
+
+log = logging.getLogger(__name__)
+
+# Seconds, from a local command to a slow submission
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+class counter(object):
+    """ monotonic counter, per set of label values """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[i]) for i in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name + format_labels(self.labels, key), value
+
+
+class histogram(object):
+    """ distribution of observed values, per set of label values """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # label values -> [count per bucket (not cumulative) + overflow,
+        #                  sum]
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[i]) for i in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self.values[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, list(counts), total)
+                            for key, (counts, total) in self.values.items())
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield self.name + '_bucket' + format_labels(
+                    self.labels, key, ('le', format_value(float(bound)))), \
+                    cumulative
+            yield self.name + '_sum' + format_labels(self.labels, key), total
+            yield self.name + '_count' + format_labels(self.labels, key), \
+                cumulative
+
+
+class registry(object):
+    """
+    Set of metrics. Collectors are functions returning a list of gauges,
+    as (name, help, {label: value}, value) tuples.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing:
+                if type(existing) is not type(metric) or \
+                        existing.labels != metric.labels:
+                    raise ValueError(
+                        f'Metric {metric.name} already registered')
+                return existing
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """ returns counter name, creating it if needed """
+        return self.register(counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        """ returns histogram name, creating it if needed """
+        return self.register(histogram(name, help, labels, buckets))
+
+    def collector(self, function):
+        """ adds a gauges collector """
+        with self.lock:
+            self.collectors.append(function)
+        return function
+
+    def render(self):
+        """ returns all metrics in Prometheus text format """
+        out = []
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda i: i.name)
+            collectors = list(self.collectors)
+        for metric in metrics:
+            out.append(f'# HELP {metric.name} {metric.help}')
+            out.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, value in metric.samples():
+                out.append(f'{name} {format_value(value)}')
+
+        gauges = {}
+        for function in collectors:
+            try:
+                for name, help, labels, value in function():
+                    gauges.setdefault(name, (help, []))[1].append(
+                        (labels, value))
+            except Exception as e:
+                # A broken collector must not hide other metrics
+                log.warning(f'Metrics collector failed: {e}')
+        for name in sorted(gauges):
+            help, values = gauges[name]
+            out.append(f'# HELP {name} {help}')
+            out.append(f'# TYPE {name} gauge')
+            for labels, value in values:
+                out.append(name + format_labels(
+                    list(labels.keys()), list(labels.values())) +
+                    ' ' + format_value(value))
+        return '\n'.join(out) + '\n'
+
+
+def flatten(stats, prefix, path=''):
+    """
+    returns gauges of numeric values of a nested stats dict, as expected
+    from collectors, named prefix_key_subkey
+    """
+    gauges = []
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        description = (path + ' ' + key.replace('_', ' ')).strip()
+        if isinstance(value, dict):
+            gauges += flatten(value, name, description)
+        elif isinstance(value, (int, float)) and \
+                not isinstance(value, bool):
+            gauges.append((name, description, {}, value))
+    return gauges
+
+
+# Registry of the process, shared by front end and connectors
+metrics = registry()
+
+# Content type of rendered metrics
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
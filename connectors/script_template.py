@@ -0,0 +1,182 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Job scripts templates, shared by connectors.
+# Templates use str.format syntax: {FIELD} is replaced by its value,
+# literal braces are doubled. They are compiled once, then rendered in a
+# single pass, optionally dropping sensitive lines on the fly.
+
+import string
+
+
+class script_template(object):
+    """
+    Compiled script template.
+
+    scrub is a list of line prefixes: lines starting with one of them are
+    dropped from the scrubbed render, for example to store a job script
+    without its credentials.
+    """
+
+    def __init__(self, text='', scrub=(), parts=None):
+        self.scrub = tuple(scrub)
+        # List of (literal, field, format_spec), field being None for
+        # trailing literal
+        if parts is None:
+            parts = []
+            for literal, field, spec, conversion in \
+                    string.Formatter().parse(text):
+                if conversion:
+                    raise ValueError(
+                        'Conversion not supported in template field ' +
+                        str(field))
+                if field == '':
+                    raise ValueError('Positional template fields are '
+                                     'not supported')
+                parts.append((literal, field, spec))
+        self.parts = self.merge(parts)
+        self.fields = set(field for literal, field, spec in self.parts
+                          if field is not None)
+
+    @staticmethod
+    def merge(parts):
+        """ joins consecutive literals """
+        merged = []
+        pending = ''
+        for literal, field, spec in parts:
+            pending += literal
+            if field is not None:
+                merged.append((pending, field, spec))
+                pending = ''
+        if pending or not merged:
+            merged.append((pending, None, None))
+        return merged
+
+    @staticmethod
+    def escape(text):
+        """ returns text as a template literal """
+        return text.replace('{', '{{').replace('}', '}}')
+
+    @staticmethod
+    def value(value, spec):
+        return format(value, spec) if spec else str(value)
+
+    def bind(self, **values):
+        """
+        returns a new template with given fields replaced by their values,
+        typically values that do not change between jobs
+        """
+        parts = []
+        for literal, field, spec in self.parts:
+            if field in values:
+                parts.append((literal + self.value(values[field], spec),
+                              None, None))
+            else:
+                parts.append((literal, field, spec))
+        return script_template(scrub=self.scrub, parts=parts)
+
+    def pieces(self, values):
+        """ yields rendered pieces of template """
+        for literal, field, spec in self.parts:
+            if literal:
+                yield literal
+            if field is not None:
+                try:
+                    yield self.value(values[field], spec)
+                except KeyError:
+                    raise KeyError('Missing template field ' + field)
+
+    def render(self, **values):
+        """ returns rendered template """
+        return ''.join(self.pieces(values))
+
+    def render_scrubbed(self, **values):
+        """
+        returns rendered template, and rendered template without lines
+        starting with a scrub prefix. Scrubbed lines are always terminated
+        by a newline.
+        """
+        out = []
+        scrubbed = []
+        # Fragments of current line, not terminated yet
+        line = []
+        for piece in self.pieces(values):
+            out.append(piece)
+            if not self.scrub:
+                continue
+            for fragment in piece.splitlines(keepends=True):
+                stripped = fragment.splitlines()[0] if fragment else ''
+                line.append(stripped)
+                if len(stripped) == len(fragment):
+                    # Line continues in next piece
+                    continue
+                text = ''.join(line)
+                line = []
+                if not text.startswith(self.scrub):
+                    scrubbed.append(text + '\n')
+        script = ''.join(out)
+        if not self.scrub:
+            return script, script
+        text = ''.join(line)
+        if text and not text.startswith(self.scrub):
+            scrubbed.append(text + '\n')
+        return script, ''.join(scrubbed)
+
+
+# Downstream parameters, injected in upstream script in place of
+# {DOWNSTREAM_PARAMETERS}, for singularity executor
+downstream_parameters = script_template("""
+# --------------------------------------------------------------------------
+# Main parameters from baremetal Dowstream
+# This part is dynamic
+# and can be adapted to any kind of bare metal job scheduler
+# See this section as a "connector"
+
+# Global parameters
+export JARVICE_JOB_SCRATCH_DIR={JARVICE_JOB_SCRATCH_DIR}
+export JARVICE_JOB_GLOBAL_SCRATCH_DIR={JARVICE_JOB_GLOBAL_SCRATCH_DIR}
+export JARVICE_JOB_APP_IS_IN_GLOBAL_REGISTRIES="{JARVICE_JOB_APP_IS_IN_GLOBAL_REGISTRIES}"
+export SINGULARITYENV_JARVICE_SERVICE_PORT={JARVICE_SERVICE_PORT}
+export SINGULARITYENV_JARVICE_SSH_PORT={JARVICE_SSH_PORT}
+export JARVICE_SINGULARITY_TMPDIR={JARVICE_SINGULARITY_TMPDIR}
+
+# User
+export JOB_LOCAL_USER=$USER
+
+# Singularity and images parameters
+export JARVICE_SINGULARITY_OVERLAY_SIZE={JARVICE_SINGULARITY_OVERLAY_SIZE}
+
+# Possible credentials
+export JARVICE_INIT_DOCKER_USERNAME="{JARVICE_INIT_DOCKER_USERNAME}"
+export JARVICE_INIT_DOCKER_PASSWORD="{JARVICE_INIT_DOCKER_PASSWORD}"
+export JARVICE_DOCKER_USERNAME="{JARVICE_DOCKER_USERNAME}"
+export JARVICE_DOCKER_PASSWORD="{JARVICE_DOCKER_PASSWORD}"
+
+# Images
+export JARVICE_APP_IMAGE={JARVICE_APP_IMAGE}
+export JARVICE_INIT_IMAGE={JARVICE_INIT_IMAGE}
+
+# Final CMD from downstream
+export JARVICE_CMD={JARVICE_CMD}
+
+# Enable or not verbosity in steps
+export SV_FLAG="-s"
+export SV={SINGULARITY_VERBOSE}
+[ "$SV" = "true" ] && export SV_FLAG="-v"
+
+# Proxy parameters
+export SCHTTP_PROXY={JARVICE_BAREMETAL_HTTP_PROXY}
+export SCHTTPS_PROXY={JARVICE_BAREMETAL_HTTPS_PROXY}
+export SCNO_PROXY={JARVICE_BAREMETAL_NO_PROXY}
+
+# --------------------------------------------------------------------------
+""")
+
+# Lines never stored along with submitted scripts
+sensitive_lines = [
+    'export SINGULARITY_DOCKER_USERNAME=',
+    'export SINGULARITY_DOCKER_PASSWORD=']
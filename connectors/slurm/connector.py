@@ -6,16 +6,113 @@
 #
 
 import os
+import codecs
+import re
 import json
-import io
 import shlex
+import threading
+import time
 import urllib.parse
-import paramiko
+import zlib
 import logging
-import yaml
 import jwt
 from base64 import b64encode, b64decode
-from pathlib import Path
+from collections import namedtuple
+from .sshpool import ssh_key_cache, ssh_pool, ssh_user_pools
+from .jobtable import job_entry, job_table
+from .usersdb import users_db, users_id_mapping_config
+from . import slurmrestd
+from ..jobobj import job_descriptor
+from ..metrics import metrics, flatten
+from ..timings import stage_timer, timings_log
+from ..script_template import script_template, downstream_parameters, \
+    sensitive_lines
+
+# Slurm job id, or job array element id, as put in squeue/sacct commands
+slurm_jobid = re.compile(r'\d+(_\d+)?')
+
+# Slurm settings of a single job, from its (pseudo)devices and limits.
+# Empty strings mean not set.
+slurm_job_settings = namedtuple('slurm_job_settings', [
+    'overlay_size', 'partition', 'exclusive', 'sbatch_params', 'gpus', 'mem',
+    'time', 'licenses'])
+
+# Slurm encapsulation of job scripts: a single srun starting the executor
+# on each node, followed by exit code analysis.
+# JOB_SCRIPT is the upstream script, with downstream parameters.
+srun_start = r"""#!/bin/bash
+echo "Hello from $(hostname)"
+echo "Entering parallel region"
+
+exec 5>&1
+FF=$(srun -K1 --export=ALL -N $SLURM_NNODES \
+-n $SLURM_NNODES --ntasks-per-node=1 /bin/bash -c '
+
+
+    """
+
+dynamic_scheduler_mapping = """
+# --------------------------------------------------------------------------
+# Dynamic/binding parameters, to connect to job scheduler
+export PROCESS_PROCID=$SLURM_PROCID
+export PROCESS_NODENAME=$SLURMD_NODENAME
+export JOB_JOBID=$SLURM_JOBID
+export JOB_JOB_NODELIST=$SLURM_JOB_NODELIST
+export JOB_JOB_FORMATED_NODELIST=$(scontrol show hostname $JOB_JOB_NODELIST | sed ":b;N;$!bb;s/\\n/ /g")
+export JOB_NNODES=$SLURM_NNODES
+export JOB_NTASKS=$SLURM_NTASKS
+export JOB_SUBMIT_DIR=$SLURM_SUBMIT_DIR
+export JOB_GPUS_PER_NODE=$SLURM_GPUS_PER_NODE
+# --------------------------------------------------------------------------
+    """
+
+srun_end = r"""
+
+' 2>&1 | tee >(cat - >&5) )
+
+############################################################################
+#############  EXIT CODE CHECKING
+####
+# srun commands return exit code of last instance exited,
+# which is not what we need.
+# We need to grab instance 0 exit code. To do so, we need to analyse output.
+# WARNING: any changes to verbosity level will break this mechanism.
+
+[ "$SV" = "true" ] && echo "[$SLURM_PROCID] Post scripts - exit code analysis"
+echo $FF\
+| grep -v 'GoTTY is starting with command'\
+| sed 's/\/bin\/echo\ JARVICE_CMD_SUCCESS//'\
+| sed 's/\/bin\/echo\ JARVICE_CMD_FAILURE//'\
+| grep --quiet 'JARVICE_CMD_SUCCESS'
+if [ $? -eq 0 ]; then
+    echo JARVICE Job completed OK
+    exit 0
+else
+    echo JARVICE Job failed, investigate logs
+    exit 1
+fi
+    """
+
+slurm_script = script_template(
+    script_template.escape(srun_start + dynamic_scheduler_mapping) +
+    '{JOB_SCRIPT}' + script_template.escape(srun_end),
+    scrub=sensitive_lines)
+
+# Remote commands metrics, labelled by command type (squeue, sbatch, etc.)
+ssh_connect_seconds = metrics.histogram(
+    'jarvice_slurm_ssh_connect_seconds',
+    'Time to get an SSH connection for a remote command, including waiting '
+    'for the pool', ['command'])
+ssh_exec_seconds = metrics.histogram(
+    'jarvice_slurm_ssh_exec_seconds',
+    'Time to run a remote command on its SSH connection', ['command'])
+ssh_errors = metrics.counter(
+    'jarvice_slurm_ssh_errors_total', 'Remote commands that failed',
+    ['command'])
+submit_stage_seconds = metrics.histogram(
+    'jarvice_slurm_submit_stage_seconds',
+    'Time spent in each stage of job submissions', ['stage'])
+
 
 class baremetal_connector(object):
 
@@ -27,13 +124,28 @@ class baremetal_connector(object):
         self.slurm_interface = os.getenv('JARVICE_SLURM_INTERFACE', 'cli')
         self.baremetal_executor = os.getenv('JARVICE_BAREMETAL_EXECUTOR', 'singularity')
 
+        # Parsed private keys, shared by all connections
+        self.ssh_keys = ssh_key_cache()
+
         if self.slurm_interface == 'cli':
             try:
-              # Load configuration from YAML file
-                with open('users_id_mapping_configuration.yaml', 'r') as file:
-                    self.users_id_mapping_configuration = yaml.safe_load(file)
+                # Load configuration from YAML file, reloaded when it changes
+                self.users_id_mapping_configuration = users_id_mapping_config(
+                    'users_id_mapping_configuration.yaml',
+                    reload_interval=float(os.getenv(
+                        'JARVICE_SLURM_USERS_ID_MAPPING_RELOAD_INTERVAL',
+                        '10')),
+                    on_reload=self.users_id_mapping_reloaded, log=self.log)
             except Exception as e:
                 raise Exception('Cloud not read users id mapping file:' + str(e))
+            # Jarvice users mapped at submit time, needed for later requests
+            self.users_db = users_db(
+                os.getenv('JARVICE_SLURM_USERS_DB',
+                          'users_mapping_db.sqlite'),
+                yaml_path='users_mapping_db.yaml', log=self.log)
+        else:
+            self.users_id_mapping_configuration = None
+            self.users_db = None
 
         # ############## Images handling ###############
         # Docker credentials to grab Jarvice images
@@ -85,17 +197,112 @@ class baremetal_connector(object):
         # Singularity overlay size
         self.overlay_size = os.getenv('JARVICE_SINGULARITY_OVERLAY_SIZE', 600)
 
-        # ############## Slurm REST API ##############
-        if self.slurm_interface == 'http':
-            self.slurmrestd_host = os.getenv('JARVICE_SLURMRESTD_ADDR')
-            self.slurmrestd_port = os.getenv('JARVICE_SLURMRESTD_PORT')
-            self.slurmrestd_api_version = os.getenv('JARVICE_SLURMRESTD_API_VERSION')
+        # ############## Job scripts ###############
+        # Port is hard-coded for this simple version
+        self.job_ssh_port = 2227
+        self.job_service_port = 2228
+        # Templates are compiled once, with values that do not change
+        # between jobs already in place
+        self.downstream_parameters = downstream_parameters.bind(
+            JARVICE_JOB_SCRATCH_DIR=self.job_scratch_dir,
+            JARVICE_JOB_GLOBAL_SCRATCH_DIR=self.job_global_scratch_dir,
+            JARVICE_SERVICE_PORT=self.job_service_port,
+            JARVICE_SSH_PORT=self.job_ssh_port,
+            JARVICE_SINGULARITY_TMPDIR=self.singularity_tmpdir,
+            JARVICE_BAREMETAL_HTTP_PROXY=self.baremetal_http_proxy,
+            JARVICE_BAREMETAL_HTTPS_PROXY=self.baremetal_https_proxy,
+            JARVICE_BAREMETAL_NO_PROXY=self.baremetal_no_proxy,
+            SINGULARITY_VERBOSE=self.singularity_verbose)
+        self.slurm_script = slurm_script
+
+        # ############## Slurm jobs ###############
+        # Job states are served from a single squeue snapshot,
+        # refreshed when older than this many seconds
+        self.squeue_ttl = float(os.getenv('JARVICE_SLURM_SQUEUE_TTL', '5'))
+        self.squeue_lock = threading.Lock()
+        self.jobs = job_table()
+        # Optional background poller keeping jobs table up to date,
+        # along with recently finished jobs from sacct
+        self.poller_interval = float(os.getenv(
+            'JARVICE_SLURM_POLLER_INTERVAL', '0'))
+        self.poller_sacct_window = int(os.getenv(
+            'JARVICE_SLURM_POLLER_SACCT_WINDOW', '600'))
+        self.poller_duration = 0.0
+        self.poller_live = {}
+        self.poller_sacct_disabled = False
+        self.poller_stop = threading.Event()
+        self.poller_thread = None
+
+        # ############## Jobs output ###############
+        # Maximum bytes returned by an offset based tail request
+        self.tail_max_bytes = int(os.getenv(
+            'JARVICE_SLURM_TAIL_MAX_BYTES', '65536'))
+        # Maximum bytes of output returned by exitstatus and tail requests
+        self.log_max_bytes = int(os.getenv(
+            'JARVICE_SLURM_LOG_MAX_BYTES', '8388608'))
+        # Stream output to client as it is read from cluster,
+        # instead of buffering it whole
+        self.stream_logs = os.getenv(
+            'JARVICE_SLURM_STREAM_LOGS', 'false').lower() == 'true'
+        # Compress output on cluster side, to save bandwidth
+        self.remote_compression = os.getenv(
+            'JARVICE_SLURM_REMOTE_COMPRESSION', 'false').lower() == 'true'
+
+        # Stage level timings of last submissions
+        self.submit_timings = timings_log(int(os.getenv(
+            'JARVICE_SLURM_SUBMIT_TIMINGS', '256')))
 
         # ############## SSH to slurm cluster ###############
         self.ssh_host = os.getenv('JARVICE_SLURM_CLUSTER_ADDR')
         self.ssh_port = os.getenv('JARVICE_SLURM_CLUSTER_PORT', default=22)
         self.ssh_user = os.getenv('JARVICE_SLURM_SSH_USER')
         self.ssh_pkey = os.getenv('JARVICE_SLURM_SSH_PKEY')
+        # Service account connections are pooled and kept alive
+        self.ssh_pool_size = int(os.getenv(
+            'JARVICE_SLURM_SSH_POOL_SIZE', '4'))
+        self.ssh_pool_idle_timeout = int(os.getenv(
+            'JARVICE_SLURM_SSH_POOL_IDLE_TIMEOUT', '300'))
+        self.ssh_keepalive = int(os.getenv(
+            'JARVICE_SLURM_SSH_KEEPALIVE', '30'))
+        self.ssh_pool_acquire_timeout = float(os.getenv(
+            'JARVICE_SLURM_SSH_POOL_ACQUIRE_TIMEOUT', '60'))
+        self.ssh_service_pool = None
+        self.ssh_pool_lock = threading.Lock()
+        # Mapped users connections are pooled per user and private key
+        self.ssh_user_pool_size = int(os.getenv(
+            'JARVICE_SLURM_SSH_USER_POOL_SIZE', '2'))
+        self.ssh_user_pool_max_users = int(os.getenv(
+            'JARVICE_SLURM_SSH_USER_POOL_MAX_USERS', '256'))
+        self.ssh_user_pool_idle_timeout = int(os.getenv(
+            'JARVICE_SLURM_SSH_USER_POOL_IDLE_TIMEOUT', '300'))
+        self.ssh_user_pools = ssh_user_pools(
+            self.ssh_host, self.ssh_port, self.ssh_key_load,
+            max_users=self.ssh_user_pool_max_users,
+            size=self.ssh_user_pool_size,
+            idle_timeout=self.ssh_user_pool_idle_timeout,
+            keepalive=self.ssh_keepalive,
+            acquire_timeout=self.ssh_pool_acquire_timeout,
+            log=self.log)
+
+        # ############## Slurm REST API ##############
+        self.slurmrestd = None
+        if self.slurm_interface == 'http':
+            self.slurmrestd_host = os.getenv('JARVICE_SLURMRESTD_ADDR')
+            self.slurmrestd_port = os.getenv('JARVICE_SLURMRESTD_PORT')
+            self.slurmrestd_api_version = os.getenv('JARVICE_SLURMRESTD_API_VERSION')
+            # Credentials used for everything but submission, which uses
+            # the bearer token of the job
+            self.slurmrestd_user = os.getenv(
+                'JARVICE_SLURMRESTD_USER', self.ssh_user)
+            self.slurmrestd_token = os.getenv(
+                'JARVICE_SLURMRESTD_TOKEN', os.getenv('SLURM_JWT'))
+            self.slurmrestd_pool_size = int(os.getenv(
+                'JARVICE_SLURMRESTD_POOL_SIZE', '4'))
+            self.slurmrestd = slurmrestd.slurmrestd_client(
+                self.slurmrestd_host, self.slurmrestd_port,
+                self.slurmrestd_api_version,
+                user=self.slurmrestd_user, token=self.slurmrestd_token,
+                size=self.slurmrestd_pool_size, log=self.log)
 
         self.log.info('')
         self.log.info(self.init_dockeruser)
@@ -104,11 +311,29 @@ class baremetal_connector(object):
         self.log.info(f'|     host: {self.ssh_host}')
         self.log.info(f'|     port: {self.ssh_port}')
         self.log.info(f'|     jarvice user: {self.ssh_user}')
+        self.log.info(f'|     pool size: {self.ssh_pool_size}')
+        self.log.info(f'|     pool idle timeout: {self.ssh_pool_idle_timeout}')
+        self.log.info(f'|     keepalive: {self.ssh_keepalive}')
+        self.log.info(f'|     users pool size: {self.ssh_user_pool_size}')
+        self.log.info(f'|     users pool max users: {self.ssh_user_pool_max_users}')
+        self.log.info(f'|     users pool idle timeout: {self.ssh_user_pool_idle_timeout}')
         if self.slurm_interface == 'http':
             self.log.info('|-- HTTP API connection to target slurmrestd (if relevant):')
             self.log.info(f'|     host: {self.slurmrestd_host}')
             self.log.info(f'|     port: {self.slurmrestd_port}')
             self.log.info(f'|     api_version: {self.slurmrestd_api_version}')
+            self.log.info(f'|     user: {self.slurmrestd_user}')
+            self.log.info(f'|     pool size: {self.slurmrestd_pool_size}')
+        self.log.info('|-- Slurm jobs:')
+        self.log.info(f'|     squeue snapshot ttl: {self.squeue_ttl}')
+        self.log.info(f'|     poller interval: {self.poller_interval}')
+        self.log.info(f'|     poller sacct window: {self.poller_sacct_window}')
+        self.log.info('|-- Jobs output:')
+        self.log.info(f'|     tail max bytes: {self.tail_max_bytes}')
+        self.log.info(f'|     log max bytes: {self.log_max_bytes}')
+        self.log.info(f'|     stream logs: {self.stream_logs}')
+        self.log.info(f'|     remote compression: {self.remote_compression}')
+        self.log.info(f'|     submit timings kept: {self.submit_timings.size}')
         self.log.info('|-- Script environment:')
         self.log.info(f'|     Jobs scratch dir: {self.job_scratch_dir}')
         self.log.info(f'|     http_proxy: {self.baremetal_http_proxy}')
@@ -128,17 +353,23 @@ class baremetal_connector(object):
             self.log.warning(' SSH failed: %s' % str(e))
             self.log.warning(' Could not connect to remote cluster! :(')
             self.log.warning(' Please check ssh parameters.')
-        self.log.info(' Now testing connectivity to target cluster slurmrestd...')
-        try:
-            stdout, stderr = self.ssh("curl " + self.slurmrestd_host + ":" + self.slurmrestd_port + "/")
-            if "Authentication failure" in stderr or "Authentication failure" in stdout:
+        if self.slurmrestd:
+            self.log.info(' Now testing connectivity to target cluster slurmrestd...')
+            try:
+                self.slurmrestd.ping()
                 self.log.info(' Success! :)')
-            else:
-                self.log.info(' Could ssh to cluster but could not reach slurmrestd :(')
-        except Exception as e:
-            self.log.warning(' SSH failed: %s' % str(e))
-            self.log.warning(' Could not connect to remote cluster! :(')
-            self.log.warning(' Please check ssh parameters.')
+            except Exception as e:
+                self.log.warning(' slurmrestd failed: %s' % str(e))
+                self.log.warning(' Could not reach slurmrestd! :(')
+                self.log.warning(' Please check slurmrestd parameters.')
+        if self.slurm_interface == 'cli':
+            self.users_id_mapping_configuration.start()
+        if self.poller_interval > 0:
+            self.log.info(' Starting jobs poller...')
+            self.poller_thread = threading.Thread(
+                target=self.poller, name='jobs-poller', daemon=True)
+            self.poller_thread.start()
+        metrics.collector(self.metrics_gauges)
         self.log.info('\n Init done. Entering main loop.')
 
 
@@ -148,15 +379,29 @@ class baremetal_connector(object):
         This is based on user email, not user name.
         None if not found.
         """
-        mapped_user = None
-        mapped_user_pkey = None
-        for user in self.users_id_mapping_configuration['users_id_mapping']:
-            if user["mail"] == user_mail:
-                mapped_user = user["mapped_user"]
-                mapped_user_pkey = user["ssh_private_key_b64"]
-                break
+        return self.users_id_mapping_configuration.lookup(user_mail)
 
-        return mapped_user, mapped_user_pkey
+    def bearer_slurm_user(self, bearer):
+        """
+        Returns Slurm user name of a bearer token, used with slurmrestd.
+        This is the sun (Slurm user name) claim of Slurm JWT tokens,
+        or the preferred_username claim of other tokens.
+        """
+        try:
+            claims = jwt.decode(bearer, options={"verify_signature": False})
+        except Exception as e:
+            raise Exception("Could not decode bearer token " + str(e))
+        user = claims.get('sun', claims.get('preferred_username'))
+        if not user:
+            raise Exception("Could not find Slurm user name in bearer token")
+        return user
+
+    def users_id_mapping_reloaded(self, previous, index):
+        """ drops keys removed from configuration from keys cache """
+        keys = set(pkey for mapped_user, pkey in index.values())
+        for mapped_user, pkey in previous.values():
+            if pkey not in keys:
+                self.ssh_keys.invalidate(pkey)
 
 
     def user_id_mapping_from_cache(self, jobname):
@@ -167,36 +412,74 @@ class baremetal_connector(object):
         jarvice_user = jobname.split('-')[-1].split('_')[0]
 
         # Obtain mapped user and ssh key from cache
-        with open('users_mapping_db.yaml', 'r') as file:
-            users_mapping_db = yaml.safe_load(file)
-
-        job_mapped_user_private_key = {}
+        mapping = self.users_db.get(jarvice_user) if self.users_db else None
+        if mapping is None:
+            raise Exception('No mapped user found for ' + jarvice_user)
 
-        job_mapped_user = users_mapping_db[jarvice_user]['mapped_user']
-        job_mapped_user_private_key = users_mapping_db[jarvice_user]['ssh_private_key_b64']
-        job_mapped_user_private_key = b64decode(job_mapped_user_private_key).decode('utf-8')
+        job_mapped_user = mapping['mapped_user']
+        job_mapped_user_private_key = self.ssh_keys.decode_b64(
+            mapping['ssh_private_key_b64'])
 
         return job_mapped_user, job_mapped_user_private_key
 
 
     def gc(self):
         """ garbage collection endpoint; fail if cluster not reachable """
+        # Called periodically by upstream, so that idle SSH connections
+        # are closed even when no other request comes
+        self.evict_connections()
         try:
-            self.ssh('/bin/true')
+            if self.slurmrestd:
+                self.slurmrestd.ping()
+            else:
+                self.ssh('/bin/true')
             return 200
         except Exception:
             return 500
 
+    # squeue states of jobs considered running or queued by upstream
+    running_states = ['R', 'RH', 'RS', 'SI', 'ST', 'S', 'CG', 'SO']
+    queued_states = ['CF', 'PD', 'RD', 'RF']
+    live_states = running_states + queued_states
+
     def running(self):
         """ returns list of running jobs as [(name, jobid), ...]"""
-        return self.squeue(user=self.ssh_user, states='R,RH,RS,SI,ST,S,CG,SO')
+        return self.squeue_snapshot().select(self.running_states)
 
     def queued(self):
         """ returns list of queued jobs as [(name, jobid), ...]"""
-        return self.squeue(user=self.ssh_user, states='CF,PD,RD,RF')
+        return self.squeue_snapshot().select(self.queued_states)
 
     def exitstatus(self, name, number, jobid):
         """ returns exit status of a completed job """
+        return self.exitstatus_job(name, number, jobid,
+                                   self.exitstatus_states([jobid]))
+
+    def exitstatus_batch(self, jobs):
+        """
+        returns exit status of many completed jobs, jobs being a list of
+        (name, number, jobid), as a list of exitstatus() results.
+        Job states are resolved all at once, jobs that could not be
+        processed are returned as None, so that they can be retried later.
+        """
+        states = self.exitstatus_states([jobid for name, number, jobid
+                                         in jobs])
+        statuses = []
+        for name, number, jobid in jobs:
+            try:
+                statuses.append(
+                    self.exitstatus_job(name, number, jobid, states))
+            except Exception as e:
+                self.log.warning(
+                    f'Could not get exit status of {jobid}: {str(e)}')
+                statuses.append(None)
+        return statuses
+
+    def exitstatus_states(self, jobids):
+        """
+        returns final states of jobs as {jobid: (source, state, elapsed)},
+        source being squeue or sacct. Jobs not found are not returned.
+        """
 
         # 2 ways to gather job status:
         # - squeue: fast, but prone to lose job data once job ended,
@@ -204,64 +487,62 @@ class baremetal_connector(object):
         # - sacct: slower, but always keep job data
         # Try squeue and fallback to sacct if failed.
         # If both failed, consider job canceled.
+        # Each way is a single call, whatever the number of jobs.
+
+        states = {}
+        missing = []
+
+        # When jobs poller is running, job state may already be known
+        for jobid in jobids:
+            job = self.jobs.get(jobid) if self.poller_thread else None
+            if job is not None and job.state not in self.live_states:
+                self.log.debug(
+                    f'Getting exit status via jobs table for {jobid}')
+                states[jobid] = (job.source, job.state, job.elapsed)
+            else:
+                missing.append(jobid)
 
         # Try squeue
-        self.log.debug(f'Getting exit status via squeue for {jobid}',
-                       exc_info=True)
-        state, elapsed, nodes = self.squeue1(jobid, self.ssh_user)
-        if state is not None:
-            if state in ['F', 'NF', 'OOM']:
-                # completed with error
-                rc = 1
-            elif state in ['DL', 'PR', 'CA']:
-                # explicitly canceled (TERMINATED in JARVICE terms)
-                rc = -15
-            elif state == 'CD':
-                # successful completion
-                rc = 0
-            else:
-                # some other termination - consider it canceled
-                # in JARVICE terms
-                rc = -9
+        if missing:
+            self.log.debug(f'Getting exit status via squeue for {missing}')
+            for jobid, (state, elapsed, nodes) in \
+                    self.squeue_jobs(missing).items():
+                states[jobid] = ('squeue', state, elapsed)
+            missing = [jobid for jobid in missing if jobid not in states]
+
         # Try sacct
-        else:
-            self.log.debug(f'Getting exit status via sacct for {jobid}',
-                           exc_info=True)
-            stdout, stderr = self.ssh(
-                'sacct --jobs=%s --format=state,elapsed | sed -n 3p | xargs'
-                % jobid)
-            if 'disabled' not in stderr and len(stderr) == 0:
-                state, elapsed = stdout.split(' ')
-                if state in ['FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY']:
-                    # completed with error
-                    rc = 1
-                elif state in ['DEADLINE', 'PREEMPTED', 'CANCELLED']:
-                    # explicitly canceled (TERMINATED in JARVICE terms)
-                    rc = -15
-                elif state == 'COMPLETED':
-                    # successful completion
-                    rc = 0
-                elif state == 'RUNNING':
-                    # We were too fast, job state hasnt reached db, retry later
-                    raise Exception('Job still running in DB')
-                else:
-                    # other termination - consider canceled in JARVICE terms
-                    rc = -9
-            else:
-                # Cannot grab data - job probably never ran
-                # or sacct not available and squeue lost it
-                return -9, '00:00:00', []
+        if missing:
+            self.log.debug(f'Getting exit status via sacct for {missing}')
+            for jobid, (state, elapsed) in self.sacct_jobs(missing).items():
+                states[jobid] = ('sacct', state, elapsed)
+
+        return states
+
+    def exitstatus_job(self, name, number, jobid, states):
+        """
+        returns exit status of a completed job from its resolved state,
+        along with its output, and garbage collects it
+        """
+        if jobid not in states:
+            # Cannot grab data - job probably never ran
+            # or sacct not available and squeue lost it
+            return -9, '00:00:00', []
+
+        rc, state, elapsed = self.exitstatus_rc(states[jobid])
 
         # If we reach that point, we got a state
         # fetch and clean output - last 10k lines only
+        # Output cannot be read with slurmrestd, no users are mapped
+        stdout = ''
+        if self.users_db is not None:
+            job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
 
-        job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
-
-        stdout, stderr = self.ssh_as_user(
-            job_mapped_user,
-            job_mapped_user_private_key,
-            'tail -10000 %s.out' % (self.job_scratch_dir + '.jarvice/' + name)
-        )
+            stdout, stderr = self.ssh_as_user(
+                job_mapped_user,
+                job_mapped_user_private_key,
+                self.output_cmd(name, 10000),
+                compress=self.remote_compression
+            )
         outs = [stdout,
                 '<< termination state: %s -- see STDOUT for job errors >>' %
                 state]
@@ -271,15 +552,153 @@ class baremetal_connector(object):
 
         return rc, elapsed, outs
 
+    def exitstatus_stream(self, name, number, jobid):
+        """
+        returns exit status of a completed job, as a generator of the
+        JSON encoded exitstatus() result. Job output is sent as it is read
+        from cluster, and job is garbage collected once it was all sent.
+        Errors before output starts being read are raised right away.
+        """
+        states = self.exitstatus_states([jobid])
+        if jobid not in states or self.users_db is None:
+            return iter([json.dumps(
+                self.exitstatus_job(name, number, jobid, states))])
+        rc, state, elapsed = self.exitstatus_rc(states[jobid])
+
+        job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
+        chunks = self.ssh_stream_as_user(
+            job_mapped_user,
+            job_mapped_user_private_key,
+            self.output_cmd(name, 10000),
+            compress=self.remote_compression
+        )
+        first = next(chunks, b'')
+
+        def stream():
+            yield '[%s, %s, ["' % (json.dumps(rc), json.dumps(elapsed))
+            # Trailing whitespace is held back, to strip it at the end
+            # as non streamed output is
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            pending = ''
+            for data in self.prepended(first, chunks):
+                text = pending + decoder.decode(data)
+                stripped = text.rstrip()
+                pending = text[len(stripped):]
+                if stripped:
+                    yield json.dumps(stripped)[1:-1]
+            text = (pending + decoder.decode(b'', final=True)).rstrip()
+            if text:
+                yield json.dumps(text)[1:-1]
+            yield '", %s]]' % json.dumps(
+                '<< termination state: %s -- see STDOUT for job errors >>' %
+                state)
+
+            # Kubernetes object cleanup (if applicable), only once output
+            # was entirely sent, so that an interrupted transfer is retried
+            self.gc_job(name, number, jobid)
+
+        return stream()
+
+    @staticmethod
+    def prepended(first, chunks):
+        """
+        generator yielding first, then chunks. chunks is closed when
+        generator ends or is closed, releasing its SSH connection.
+        """
+        try:
+            yield first
+            yield from chunks
+        finally:
+            chunks.close()
+
+    def exitstatus_rc(self, job_state):
+        """ returns rc, state, elapsed of a (source, state, elapsed) """
+        source, state, elapsed = job_state
+        if source == 'sacct':
+            rc = self.sacct_state_rc(state)
+        else:
+            rc = self.squeue_state_rc(state)
+        return rc, state, elapsed
+
+    def output_cmd(self, name, lines):
+        """ returns command printing last lines of output of job name """
+        cmd = 'tail -%d %s.jarvice/%s.out' % (
+            lines, self.job_scratch_dir, name)
+        if self.log_max_bytes > 0:
+            cmd += ' | tail -c %d' % self.log_max_bytes
+        return cmd
+
+    def squeue_state_rc(self, state):
+        """ returns exit code of a job from its squeue state """
+        if state in ['F', 'NF', 'OOM']:
+            # completed with error
+            return 1
+        elif state in ['DL', 'PR', 'CA']:
+            # explicitly canceled (TERMINATED in JARVICE terms)
+            return -15
+        elif state == 'CD':
+            # successful completion
+            return 0
+        # some other termination - consider it canceled
+        # in JARVICE terms
+        return -9
+
+    def sacct_state_rc(self, state):
+        """ returns exit code of a job from its sacct state """
+        if state in ['FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY']:
+            # completed with error
+            return 1
+        elif state in ['DEADLINE', 'PREEMPTED', 'CANCELLED']:
+            # explicitly canceled (TERMINATED in JARVICE terms)
+            return -15
+        elif state == 'COMPLETED':
+            # successful completion
+            return 0
+        elif state == 'RUNNING':
+            # We were too fast, job state hasnt reached db, retry later
+            raise Exception('Job still running in DB')
+        # other termination - consider canceled in JARVICE terms
+        return -9
+
     def runstatus(self, name=None, number=None, jobid=None, nc={}):
         """ returns running status of a single job """
-        state, elapsed, nodes = self.squeue1(jobid, self.ssh_user)
+        job = self.squeue_snapshot().get(jobid)
+        if job is not None:
+            state, elapsed, nodes = job.state, job.elapsed, job.nodes
+        else:
+            # Job may have been submitted after snapshot was taken
+            state, elapsed, nodes = self.squeue1(jobid, self.ssh_user)
         if state is None:
             return None, None, None, None
 
         return (nodes, elapsed, name + '/' + str(number) + '/' + jobid, None
                 ) if state else (None, None, None, None)
 
+    def runstatus_batch(self, jobs):
+        """
+        returns running status of many jobs, jobs being a list of
+        (name, number, jobid), as a list of runstatus() results
+        """
+        table = self.jobs if self.poller_thread else None
+        found = {}
+        missing = []
+        for name, number, jobid in jobs:
+            job = table.get(jobid) if table else None
+            if job is not None and job.source == 'squeue':
+                found[jobid] = (job.state, job.elapsed, job.nodes)
+            else:
+                missing.append(jobid)
+        if missing:
+            found.update(self.squeue_jobs(missing))
+
+        statuses = []
+        for name, number, jobid in jobs:
+            state, elapsed, nodes = found.get(jobid, (None, None, None))
+            statuses.append(
+                (nodes, elapsed, name + '/' + str(number) + '/' + jobid, None)
+                if state else (None, None, None, None))
+        return statuses
+
     def terminate(self, name, number, jobid, force=False, nodes=[]):
         """ terminates a job """
         # XXX: SIGTERM doesn't seem to work at all, so default to SIGKILL
@@ -287,27 +706,17 @@ class baremetal_connector(object):
         #    self.ssh('scancel -s %d %s' % (9 if force else 15, jobid))
         self.log.info(f'Terminating job: {jobid}')
 
-        job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
-
-        self.ssh_as_user(
-            job_mapped_user,
-            job_mapped_user_private_key,
-            'scancel -f ' + jobid
-        )
+        if self.slurmrestd:
+            self.slurmrestd.cancel(jobid)
+        else:
+            job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
 
-#         terminate_cmd = """
-# curl -X DEL {slurmrestd_host}:{slurmrestd_port}/slurm/{slurmrestd_api_version}/job/{jobid} \
-# -H "X-SLURM-USER-NAME:{username}" \
-# -H "X-SLURM-USER-TOKEN:{jwt_token}"
-# """.format(
-#         slurmrestd_host=self.slurmrestd_host,
-#         slurmrestd_port=self.slurmrestd_port,
-#         slurmrestd_api_version=self.slurmrestd_api_version,
-#         jobid=jobid,
-#         username=self.job_mapped_user,
-#         jwt_token=os.getenv('SLURM_JWT')
-#     )
-#         stdout, stderr = self.ssh(terminate_cmd)
+            self.ssh_as_user(
+                job_mapped_user,
+                job_mapped_user_private_key,
+                'scancel -f ' + jobid
+            )
+        self.jobs.invalidate()
 
         return True  # best effort
 
@@ -318,6 +727,14 @@ class baremetal_connector(object):
     def release(self, name, number, jobid):
         """ releases a held job """
 
+        if self.slurmrestd:
+            try:
+                self.slurmrestd.release(jobid)
+            except Exception as e:
+                raise Exception(f'Releasing job failed: {str(e)}')
+            self.jobs.invalidate()
+            return True
+
         job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
 
         stdout, stderr = self.ssh_as_user(
@@ -327,6 +744,7 @@ class baremetal_connector(object):
         )
         if stderr:
             raise Exception(f'Releasing job failed: {stderr}')
+        self.jobs.invalidate()
         return True  # Best effort
 
     def events(self, name, number, jobid):
@@ -334,6 +752,12 @@ class baremetal_connector(object):
         # what's most useful to the admin here is the scontrol job output;
         # while not exactly events, it can show what's happening with a job
 
+        if self.slurmrestd:
+            job = self.slurmrestd.job(jobid)
+            if job is None:
+                raise Exception(f'slurmrestd could not find job {jobid}')
+            return json.dumps(job, indent=2)
+
         job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
 
         stdout, stderr = self.ssh_as_user(
@@ -401,20 +825,51 @@ class baremetal_connector(object):
             return rsp_json(200, readyjson)
         elif method == 'tail':
 
+            # Output cannot be read with slurmrestd, no users are mapped
+            if self.users_db is None:
+                return rsp(404)
+
             job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(jobname)
 
+            # Incremental mode, only bytes written since offset are sent
+            if 'offset' in qs:
+                try:
+                    offset = int(qs['offset'][0])
+                    assert (offset >= 0)
+                except Exception:
+                    return rsp(400)
+                try:
+                    max_bytes = int(qs['max_bytes'][0])
+                    assert (max_bytes > 0)
+                except Exception:
+                    max_bytes = self.tail_max_bytes
+                tail = self.tail_bytes(
+                    job_mapped_user, job_mapped_user_private_key,
+                    '%s.jarvice/%s.out' % (self.job_scratch_dir, jobname),
+                    offset, min(max_bytes, self.tail_max_bytes))
+                return rsp_json(200, tail) if tail else rsp(404)
+
             try:
                 lines = int(qs['lines'][0])
                 assert (lines > 1)
             except Exception:
                 lines = 100
+            if self.stream_logs:
+                chunks = self.ssh_stream_as_user(
+                    job_mapped_user,
+                    job_mapped_user_private_key,
+                    self.output_cmd(jobname, lines),
+                    compress=self.remote_compression
+                )
+                first = next(chunks, b'')
+                return rsp(200, content_type='text/plain',
+                           content=self.prepended(first, chunks)) \
+                    if first else rsp(404)
             stdout, stderr = self.ssh_as_user(
                 job_mapped_user,
                 job_mapped_user_private_key,
-                'tail -%d %s.jarvice/%s.out' % (
-                    lines,
-                    self.job_scratch_dir, jobname
-                )
+                self.output_cmd(jobname, lines),
+                compress=self.remote_compression
             )
             return rsp(200, content_type='text/plain',
                        content=stdout) if stdout else rsp(404)
@@ -422,6 +877,118 @@ class baremetal_connector(object):
         # catch-all
         return rsp(200)
 
+    def tail_bytes(self, user, pkey, path, offset, max_bytes):
+        """
+        returns {offset, size, content, more} with content being at most
+        max_bytes of file path, from byte offset.
+        Returned offset is where next call should start from. It never
+        splits an UTF-8 character, incomplete ones are sent on next call.
+        If file shrunk below offset, it is read again from start.
+        None if file could not be read.
+        """
+        offset = int(offset)
+        # Room for at least one UTF-8 character
+        max_bytes = max(int(max_bytes), 4)
+        # First line of output is file size, then file content.
+        # File is read again from start if it was truncated or rotated.
+        # Path holds the job name sent by upstream, it must be quoted
+        cmd = ('f=%s; test -f "$f" && size=$(stat -c %%s "$f") && '
+               'echo $size && if [ $size -lt %d ]; then '
+               'head -c %d "$f"; else '
+               'tail -c +%d "$f" | head -c %d; fi') % (
+                   shlex.quote(path), offset, max_bytes, offset + 1,
+                   max_bytes)
+        stdout, stderr = self.ssh_as_user(
+            user, pkey, cmd, raw=True, compress=self.remote_compression,
+            kind='tail')
+        header, sep, data = stdout.partition(b'\n')
+        try:
+            size = int(header)
+        except ValueError:
+            return None
+        if size < offset:
+            offset = 0
+
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        content = decoder.decode(data, final=False)
+        pending = decoder.getstate()[0]
+        offset += len(data) - len(pending)
+        # File may have grown since size was read
+        size = max(size, offset)
+        return {'offset': offset, 'size': size, 'content': content,
+                'more': offset < size}
+
+    def slurm_settings(self, job):
+        """
+        returns slurm_job_settings of a job_descriptor, from its
+        (pseudo)devices and limits. Nothing is stored on the connector,
+        so that concurrent submissions do not interfere.
+        """
+
+        # devices/pseudo-devices...
+        # note that since most of this is not relevant in Slurm clusters,
+        # we'll use it for special functionality like container configuration
+        # and scheduler parameters
+        # also note that we want to fail job submission if there are parameter
+        # errors so that erroneous jobs don't run unintentionally
+        overlay_size = self.overlay_size
+        sbatch_add_params = ''
+        slurm_part = ''
+        slurm_exclusive = True
+        for i in job.devices:
+            try:
+                k, v = i.split('=')
+                k = k.strip()
+                v = v.strip()
+            except Exception:
+                raise Exception(f'Malformed (pseudo)device: {i}')
+
+            if k == 'overlay':
+                try:
+                    overlay_size = int(v)
+                    assert overlay_size >= 0
+                except Exception:
+                    raise Exception(
+                        f'Invalid overlay setting {v}: must be integer >=0')
+            elif k == 'partition':
+                slurm_part = v
+            elif k == 'exclusive':
+                if v == 'False':
+                    slurm_exclusive = False
+            elif k.startswith('sbatch_'):
+                sbatch_add_params = (
+                    sbatch_add_params +
+                    ' --' + k.replace('sbatch_', '') +
+                    '=' + str(v)
+                    )
+            else:
+                raise Exception(
+                    f'Unknown (pseudo)device specified: {k}')
+
+        # job other limits: mem and gpus
+        slurm_gpus = ''
+        slurm_mem = ''
+        if job.gpus > 0:
+            slurm_gpus = str(job.gpus)
+        if job.ram > 0:
+            slurm_mem = str(job.ram)
+
+        if (job.interactive or slurm_gpus) and not slurm_exclusive:
+            self.log.info(
+                'interactive or GPU job forcing the use of node exclusivity!')
+            slurm_exclusive = True
+
+        # optional walltime
+        slurm_time = job.walltime  # str(jobself.get('walltime', ''))
+        if str(slurm_time) == 'None':
+            slurm_time = ''
+
+        return slurm_job_settings(
+            overlay_size=overlay_size, partition=slurm_part,
+            exclusive=slurm_exclusive, sbatch_params=sbatch_add_params,
+            gpus=slurm_gpus, mem=slurm_mem, time=slurm_time,
+            licenses=job.licenses)
+
     # Submit a job
     def submit(self, name, number, nodes, hpc_script, bearer, held=False):
         """ submits a job for scheduling
@@ -435,7 +1002,26 @@ class baremetal_connector(object):
         Ouput:
         - job name (str): job name provided by bare metal scheduler
 
+        Time spent in each stage is recorded in submit_timings.
         """
+        timer = stage_timer(name)
+        try:
+            result = self.submit_stages(timer, name, number, nodes,
+                                        hpc_script, bearer, held)
+        except Exception as e:
+            timer.stop(e)
+            raise
+        else:
+            timer.stop()
+        finally:
+            self.submit_timings.record(timer)
+            for stage, seconds in timer.stages:
+                submit_stage_seconds.observe(seconds, stage=stage)
+        return result
+
+    def submit_stages(self, timer, name, number, nodes, hpc_script, bearer,
+                      held=False):
+        """ submits a job, marking each stage in timer """
         self.log.info(f'Job submittion request for {name}:{number}')
 
         # Grab executor script only, and decode it
@@ -444,117 +1030,25 @@ class baremetal_connector(object):
                 hpc_script[self.baremetal_executor]).decode('utf-8')
         except Exception as e:
             raise Exception("Could not decode hpc_script " + str(e))
-        connection_string = """
-# --------------------------------------------------------------------------
-# Main parameters from baremetal Dowstream
-# This part is dynamic
-# and can be adapted to any kind of bare metal job scheduler
-# See this section as a "connector"
-
-# Global parameters
-export JARVICE_JOB_SCRATCH_DIR={JARVICE_JOB_SCRATCH_DIR}
-export JARVICE_JOB_GLOBAL_SCRATCH_DIR={JARVICE_JOB_GLOBAL_SCRATCH_DIR}
-export JARVICE_JOB_APP_IS_IN_GLOBAL_REGISTRIES="{JARVICE_JOB_APP_IS_IN_GLOBAL_REGISTRIES}"
-export SINGULARITYENV_JARVICE_SERVICE_PORT={JARVICE_SERVICE_PORT}
-export SINGULARITYENV_JARVICE_SSH_PORT={JARVICE_SSH_PORT}
-export JARVICE_SINGULARITY_TMPDIR={JARVICE_SINGULARITY_TMPDIR}
-
-# User
-export JOB_LOCAL_USER=$USER
-
-# Singularity and images parameters
-export JARVICE_SINGULARITY_OVERLAY_SIZE={JARVICE_SINGULARITY_OVERLAY_SIZE}
-
-# Possible credentials
-export JARVICE_INIT_DOCKER_USERNAME="{JARVICE_INIT_DOCKER_USERNAME}"
-export JARVICE_INIT_DOCKER_PASSWORD="{JARVICE_INIT_DOCKER_PASSWORD}"
-export JARVICE_DOCKER_USERNAME="{JARVICE_DOCKER_USERNAME}"
-export JARVICE_DOCKER_PASSWORD="{JARVICE_DOCKER_PASSWORD}"
-
-# Images
-export JARVICE_APP_IMAGE={JARVICE_APP_IMAGE}
-export JARVICE_INIT_IMAGE={JARVICE_INIT_IMAGE}
-
-# Final CMD from downstream
-export JARVICE_CMD={JARVICE_CMD}
-
-# Enable or not verbosity in steps
-export SV_FLAG="-s"
-export SV={SINGULARITY_VERBOSE}
-[ "$SV" = "true" ] && export SV_FLAG="-v"
-
-# Proxy parameters
-export SCHTTP_PROXY={JARVICE_BAREMETAL_HTTP_PROXY}
-export SCHTTPS_PROXY={JARVICE_BAREMETAL_HTTPS_PROXY}
-export SCNO_PROXY={JARVICE_BAREMETAL_NO_PROXY}
-
-# --------------------------------------------------------------------------
-"""
-
-        def find_key(script2search, key2find):
-            """
-            Basic function to search in hpc_script a specific key
-            and extract its value
-            """
-            for line2search in script2search.splitlines():
-                if len(line2search.split("=")) >= 2 and \
-                line2search.split("=")[0] == key2find:
-                    if str(line2search.split("=")[1]) == "":
-                        return None
-                    return str(line2search.split("=", 1)[1])
-            return None
+        timer.mark('decode')
 
-        jobobj_interactive = find_key(hpc_script, "JOBOBJ_INTERACTIVE")
-        if jobobj_interactive == "False":
-            jobobj_interactive = bool(False)
-        else:
-            jobobj_interactive = bool(True)
-        jobobj_appdefversion = int(
-            find_key(hpc_script, "JOBOBJ_APPDEFVERSION"))
-        jobobj_arch = find_key(hpc_script, "JOBOBJ_ARCH")
-        jobobj_nae = find_key(hpc_script, "JOBOBJ_NAE")
-        jobobj_repo = find_key(hpc_script, "JOBOBJ_REPO")
-        jobobj_ctrsecret = find_key(hpc_script, "JOBOBJ_CTRSECRET")
-        jobobj_user = find_key(hpc_script, "JOBOBJ_USER")
-        jobobj_docker_secret = find_key(
-            hpc_script, "JOBOBJ_DOCKER_SECRET")
-        if jobobj_docker_secret is not None:
-            try:
-                jobobj_docker_secret = json.loads(
-                    jobobj_docker_secret)
-            except json.decoder.JSONDecodeError:
-                jobobj_docker_secret = {}
-        else:
-            jobobj_docker_secret = {}
-        jobobj_devices = find_key(hpc_script, "JOBOBJ_DEVICES")
-        if jobobj_devices is not None:
-            try:
-                jobobj_devices = json.loads(jobobj_devices)
-            except json.decoder.JSONDecodeError:
-                jobobj_devices = {}
-        else:
-            jobobj_devices = {}
-        jobobj_gpus = find_key(hpc_script, "JOBOBJ_GPUS")
-        if jobobj_gpus is not None:
-            jobobj_gpus = int(jobobj_gpus)
-        else:
-            jobobj_gpus = 0
-        jobobj_ram = find_key(hpc_script, "JOBOBJ_RAM")
-        if jobobj_ram is not None:
-            jobobj_ram = int(jobobj_ram)
-        else:
-            jobobj_ram = 0
-        jobobj_licenses = find_key(hpc_script, "JOBOBJ_LICENSES")
-        jobobj_walltime = find_key(hpc_script, "JOBOBJ_WALLTIME")
-        jobobj_cores = int(find_key(hpc_script, "JARVICE_CPU_CORES"))
-        jarvice_cmd = find_key(hpc_script, "JARVICE_CMD")
+        # Read all job settings at once
+        job = job_descriptor.parse(hpc_script)
+        for warning in job.warnings:
+            self.log.warning(f'Job {name}: {warning}')
+        timer.mark('parse')
 
-        if jobobj_appdefversion < 2:
+        if job.appdefversion < 2:
             return 'Appdef V2+ is required for this downstream', 400
 
-        if jobobj_interactive and not self.jobsdomain:
+        if job.interactive and not self.jobsdomain:
             return 'interactive jobs are not supported on this cluster', 400
 
+        # Per job Slurm settings, kept local to this request
+        self.log.info("Preparing slurm job settings")
+        settings = self.slurm_settings(job)
+        timer.mark('settings')
+
         # determine appropriate Docker secret
         def get_reg(url):
             scheme, netloc, path, query, fragment = urllib.parse.urlsplit(url)
@@ -625,8 +1119,8 @@ export SCNO_PROXY={JARVICE_BAREMETAL_NO_PROXY}
 
         # Grab init image, and related credentials (if any)
         init_image = (self.sysregistry + "/" + self.sysbase + "/initv" +
-                    str(jobobj_appdefversion) + ":" +
-                    imgtag(goarch(jobobj_arch)))
+                    str(job.appdefversion) + ":" +
+                    imgtag(goarch(job.arch)))
         jarvice_init_image = 'docker://' + init_image
         init_dockeruser = b64decode(self.init_dockeruser).decode('utf-8')
         init_dockerpasswd = b64decode(self.init_dockerpasswd).decode('utf-8')
@@ -637,19 +1131,19 @@ export SCNO_PROXY={JARVICE_BAREMETAL_NO_PROXY}
         if self.appregistry:
             # Caching mode deployment - image in local registry
             app_image = (self.appregistry + '/' + self.appbase + '/' +
-                        jobobj_nae + ':latest')
+                        job.nae + ':latest')
         elif self.appproxyport:
-            app_image = jobobj_repo
+            app_image = job.repo
             # override app repo with proxy if found
             for proxy in self.appproxybucket.split(','):
-                if jobobj_repo.startswith(proxy):
+                if job.repo.startswith(proxy):
                     app_proxy = 'localhost:' + self.appproxyport
-                    app_image = jobobj_repo.replace(proxy.split('/')[0],
+                    app_image = job.repo.replace(proxy.split('/')[0],
                                                         app_proxy, 1)
                     break
         else:
             # Remote mode deployment - image is in its original registry
-            app_image = jobobj_repo
+            app_image = job.repo
 
         jarvice_app_image = 'docker://' + app_image
 
@@ -658,20 +1152,21 @@ export SCNO_PROXY={JARVICE_BAREMETAL_NO_PROXY}
         for registry in self.job_global_registries:
             if registry in jarvice_app_image:
                 job_app_is_in_global_registries = "True"
+        timer.mark('images')
 
         # Grab app image credentials (if any)
-        if jobobj_ctrsecret is not None:
+        if job.ctrsecret is not None:
             auths = json.loads(b64decode(
-                jobobj_ctrsecret).decode('utf-8')).get('auths', {})
+                job.ctrsecret).decode('utf-8')).get('auths', {})
         else:
             auths = {}
         self.log.debug(
             f'Docker registry secrets available for: {list(auths.keys())}')
-        ds = jobobj_docker_secret
+        ds = job.docker_secret
         if ds:
             self.log.debug(
                 f'Docker registry secret for job container for {ds["server"]}')
-        parts = jobobj_repo.split('/')
+        parts = job.repo.split('/')
         reg = get_reg(parts[0]) if len(parts) > 2 else 'index.docker.io'
         dockeruser = ''
         dockerpasswd = ''
@@ -683,163 +1178,31 @@ export SCNO_PROXY={JARVICE_BAREMETAL_NO_PROXY}
             self.log.debug(f'Using job/app-specific Docker secret for {reg}')
         else:
             dockeruser, dockerpasswd = get_reg_auth(auths, reg)
+        timer.mark('credentials')
 
         self.log.info("JARVICE_CMD")
-        self.log.info(jarvice_cmd)
-
-        # Port is hard-coded for this simple version
-        ssh_port = 2227
-        svc_port = 2228
+        self.log.info(job.cmd)
 
         self.log.info("Building script")
-        script = hpc_script.format(
-            DOWNSTREAM_PARAMETERS=connection_string.format(
-                JARVICE_JOB_SCRATCH_DIR=self.job_scratch_dir,
-                JARVICE_JOB_GLOBAL_SCRATCH_DIR=self.job_global_scratch_dir,
-                JARVICE_JOB_APP_IS_IN_GLOBAL_REGISTRIES=job_app_is_in_global_registries,
-                JARVICE_SERVICE_PORT=svc_port,
-                JARVICE_SSH_PORT=ssh_port,
-                JARVICE_SINGULARITY_TMPDIR=self.singularity_tmpdir,
-                JARVICE_SINGULARITY_OVERLAY_SIZE=self.overlay_size,
-                JARVICE_APP_IMAGE=jarvice_app_image,
-                JARVICE_INIT_IMAGE=jarvice_init_image,
-                JARVICE_DOCKER_USERNAME=b64encode(
-                    bytes(dockeruser, 'utf-8')).decode('utf-8'),
-                JARVICE_DOCKER_PASSWORD=b64encode(
-                    bytes(dockerpasswd, 'utf-8')).decode('utf-8'),
-                JARVICE_INIT_DOCKER_USERNAME=b64encode(
-                    bytes(init_dockeruser, 'utf-8')).decode('utf-8'),
-                JARVICE_INIT_DOCKER_PASSWORD=b64encode(
-                    bytes(init_dockerpasswd, 'utf-8')).decode('utf-8'),
-                JARVICE_BAREMETAL_HTTP_PROXY=self.baremetal_http_proxy,
-                JARVICE_BAREMETAL_HTTPS_PROXY=self.baremetal_https_proxy,
-                JARVICE_BAREMETAL_NO_PROXY=self.baremetal_no_proxy,
-                JARVICE_CMD=jarvice_cmd,
-                SINGULARITY_VERBOSE=self.singularity_verbose            )
-        )
-
-        # Now enter slurm special part
-
-        # First encapsulate the script:
-
-        dynamic_scheduler_mapping = """
-# --------------------------------------------------------------------------
-# Dynamic/binding parameters, to connect to job scheduler
-export PROCESS_PROCID=$SLURM_PROCID
-export PROCESS_NODENAME=$SLURMD_NODENAME
-export JOB_JOBID=$SLURM_JOBID
-export JOB_JOB_NODELIST=$SLURM_JOB_NODELIST
-export JOB_JOB_FORMATED_NODELIST=$(scontrol show hostname $JOB_JOB_NODELIST | sed ":b;N;$!bb;s/\\n/ /g")
-export JOB_NNODES=$SLURM_NNODES
-export JOB_NTASKS=$SLURM_NTASKS
-export JOB_SUBMIT_DIR=$SLURM_SUBMIT_DIR
-export JOB_GPUS_PER_NODE=$SLURM_GPUS_PER_NODE
-# --------------------------------------------------------------------------
-    """
-
-        srun_start = r"""#!/bin/bash
-echo "Hello from $(hostname)"
-echo "Entering parallel region"
-
-exec 5>&1
-FF=$(srun -K1 --export=ALL -N $SLURM_NNODES \
--n $SLURM_NNODES --ntasks-per-node=1 /bin/bash -c '
-
-
-    """
-
-        srun_end = r"""
-
-' 2>&1 | tee >(cat - >&5) )
-
-############################################################################
-#############  EXIT CODE CHECKING
-####
-# srun commands return exit code of last instance exited,
-# which is not what we need.
-# We need to grab instance 0 exit code. To do so, we need to analyse output.
-# WARNING: any changes to verbosity level will break this mechanism.
-
-[ "$SV" = "true" ] && echo "[$SLURM_PROCID] Post scripts - exit code analysis"
-echo $FF\
-| grep -v 'GoTTY is starting with command'\
-| sed 's/\/bin\/echo\ JARVICE_CMD_SUCCESS//'\
-| sed 's/\/bin\/echo\ JARVICE_CMD_FAILURE//'\
-| grep --quiet 'JARVICE_CMD_SUCCESS'
-if [ $? -eq 0 ]; then
-    echo JARVICE Job completed OK
-    exit 0
-else
-    echo JARVICE Job failed, investigate logs
-    exit 1
-fi
-    """
-
-        script = srun_start + dynamic_scheduler_mapping + script + srun_end
-
-        self.log.info("Preparing slurm job settings")
-
-        # Now build sbatch parameters
-
-        # devices/pseudo-devices...
-        # note that since most of this is not relevant in Slurm clusters,
-        # we'll use it for special functionality like container configuration
-        # and scheduler parameters
-        # also note that we want to fail job submission if there are parameter
-        # errors so that erroneous jobs don't run unintentionally
-        sbatch_add_params = ''
-        slurm_part = ''
-        slurm_exclusive = True
-        for i in jobobj_devices:
-            try:
-                k, v = i.split('=')
-                k = k.strip()
-                v = v.strip()
-            except Exception:
-                raise Exception(f'Malformed (pseudo)device: {i}')
-
-            if k == 'overlay':
-                try:
-                    self.overlay_size = int(v)
-                    assert self.overlay_size >= 0
-                except Exception:
-                    raise Exception(
-                        f'Invalid overlay setting {v}: must be integer >=0')
-            elif k == 'partition':
-                slurm_part = v
-            elif k == 'exclusive':
-                if v == 'False':
-                    slurm_exclusive = False
-            elif k.startswith('sbatch_'):
-                sbatch_add_params = (
-                    sbatch_add_params +
-                    ' --' + k.replace('sbatch_', '') +
-                    '=' + str(v)
-                    )
-            else:
-                raise Exception(
-                    f'Unknown (pseudo)device specified: {k}')
-
-        # job other limits: mem and gpus
-        slurm_gpus = ''
-        slurm_mem = ''
-        if jobobj_gpus > 0:
-            slurm_gpus = str(jobobj_gpus)
-        if jobobj_ram > 0:
-            slurm_mem = str(jobobj_ram)
-
-        if (jobobj_interactive or slurm_gpus) and not slurm_exclusive:
-            self.log.info(
-                'interactive or GPU job forcing the use of node exclusivity!')
-            slurm_exclusive = True
-
-        # optional licenses
-        licenses = jobobj_licenses  # jobself.get('licenses', None)
-
-        # optional walltime
-        slurm_time = jobobj_walltime  # str(jobself.get('walltime', ''))
-        if str(slurm_time) == 'None':
-            slurm_time = ''
+        # Slurm encapsulation and sensitive lines removal, for the copy of
+        # the script returned to upstream, are done in a single pass
+        script, fscript = self.slurm_script.render_scrubbed(
+            JOB_SCRIPT=hpc_script.format(
+                DOWNSTREAM_PARAMETERS=self.downstream_parameters.render(
+                    JARVICE_JOB_APP_IS_IN_GLOBAL_REGISTRIES=job_app_is_in_global_registries,
+                    JARVICE_SINGULARITY_OVERLAY_SIZE=settings.overlay_size,
+                    JARVICE_APP_IMAGE=jarvice_app_image,
+                    JARVICE_INIT_IMAGE=jarvice_init_image,
+                    JARVICE_DOCKER_USERNAME=b64encode(
+                        bytes(dockeruser, 'utf-8')).decode('utf-8'),
+                    JARVICE_DOCKER_PASSWORD=b64encode(
+                        bytes(dockerpasswd, 'utf-8')).decode('utf-8'),
+                    JARVICE_INIT_DOCKER_USERNAME=b64encode(
+                        bytes(init_dockeruser, 'utf-8')).decode('utf-8'),
+                    JARVICE_INIT_DOCKER_PASSWORD=b64encode(
+                        bytes(init_dockerpasswd, 'utf-8')).decode('utf-8'),
+                    JARVICE_CMD=job.cmd)))
+        timer.mark('render')
 
         # Submit job
         # Note to developers:
@@ -864,77 +1227,54 @@ fi
         # Either ssh (and so cli sbatch), which requires id mapping to be properly configured with users encoded ssh private keys
         # HTTP WAY - THIS IS ONLY A POC !!!
         if self.slurm_interface == "http":
+            # Slurm user the bearer token was issued for
+            job_mapped_user = self.bearer_slurm_user(bearer)
+
             # Building HTTP request
-            try:
-            # "script": "#!/bin/bash\\necho 'ZWNobyBoZWxsbyAmJiBob3N0bmFtZSAmJiBlY2hvICRDT0xPUgo=' | base64 -d | srun -K1 --export=ALL -N 1 -n 1 --ntasks-per-node=1 /bin/bash && srun /bin/bash -c 'hostname && sleep 360'",
-
-                # Encoding script
-                encoded_script = b64encode(script.encode("utf8")).decode("utf8")
-
-                job_json = """
-{{
-    "script": "#!/bin/bash\\necho '{encoded_script}' | base64 -d | /bin/bash",
-    "job": {{
-        "time_limit": {{
-            "number": 5,
-            "set": True,
-            "infinite": False
-        }},
-        "exclusive": ["true","true"],
-        "nodes": "1",
-        "memory_per_node" : {{
-            "number" : 1,
-            "set" : True,
-            "infinite" : False
-        }},
-        "partition": "all",
-        "tasks": 2,
-        "current_working_directory": "{scratchdir}/{username}/",
-        "standard_output": "{scratchdir}/{username}/{job_name}.out",
-        "standard_error": "{scratchdir}/{username}/{job_name}.out",
-        "name": "jarvice_{job_name}",
-        "environment": [
-            "JARVICE=true"
-        ],
-        "hold": False
-    }}
-}}
-    """.format(
-            job_name=name,
-            encoded_script=encoded_script,
-            scratchdir=self.job_scratch_dir,
-            username=self.job_mapped_user
-        )
+            # Encoding script
+            encoded_script = b64encode(script.encode("utf8")).decode("utf8")
+
+            job_json = {
+                "script": "#!/bin/bash\necho '%s' | base64 -d | /bin/bash" %
+                encoded_script,
+                "job": {
+                    "time_limit": {
+                        "number": 5,
+                        "set": True,
+                        "infinite": False
+                    },
+                    "exclusive": ["true", "true"],
+                    "nodes": "1",
+                    "memory_per_node": {
+                        "number": 1,
+                        "set": True,
+                        "infinite": False
+                    },
+                    "partition": "all",
+                    "tasks": 2,
+                    "current_working_directory": "%s/%s/" % (
+                        self.job_scratch_dir, job_mapped_user),
+                    "standard_output": "%s/%s/%s.out" % (
+                        self.job_scratch_dir, job_mapped_user, name),
+                    "standard_error": "%s/%s/%s.out" % (
+                        self.job_scratch_dir, job_mapped_user, name),
+                    "name": "jarvice_" + name,
+                    "environment": [
+                        "JARVICE=true"
+                    ],
+                    "hold": False
+                }
+            }
+
+            #         "tres_per_node":"gres/gpu=1",
+            timer.mark('mapping')
 
-    #         "tres_per_node":"gres/gpu=1",
-
-                submit_cmd = """
-mkdir -p $HOME/.jarvice &&\
-curl -X POST {slurmrestd_host}:{slurmrestd_port}/slurm/{slurmrestd_api_version}/job/submit \
--H "X-SLURM-USER-NAME:{username}" \
--H "X-SLURM-USER-TOKEN:{jwt_token}" \
--H "Content-Type: application/json" \
--d @- <<- EOF
-{job_json}
-EOF
-    """.format(
-            slurmrestd_host=self.slurmrestd_host,
-            slurmrestd_port=self.slurmrestd_port,
-            slurmrestd_api_version=self.slurmrestd_api_version,
-            job_json=job_json,
-            username=self.job_mapped_user,
-            jwt_token=bearer # os.getenv('SLURM_JWT')
-        )
+            try:
+                job_id = self.slurmrestd.submit(
+                    job_json, user=job_mapped_user, token=bearer)
             except Exception as e:
-                raise Exception('Could not generate job json or cmd: ' + str(e))
-            stdout, stderr = self.ssh(submit_cmd)
-
-            if not stdout:
-                raise Exception(
-                    'submit(): sbatch: ' + stderr.replace('\n', ' -- '))
-
-            # HTTP ONLY
-            job_id = json.loads(stdout)['job_id']
+                raise Exception('submit(): ' + str(e))
+            timer.mark('slurmrestd')
 
         elif self.slurm_interface == "cli":
 
@@ -954,21 +1294,16 @@ EOF
             # Jarvice user is stored inside job name, extract it
             jarvice_user = name.split('-')[-1].split('_')[0]
             # Now update local cache
-            # We use YAML now, but a better approach would be to use sqlite DB.
             # Important note: in case of K8S, we should use a secret, so that this is shared between replicas.
-            if Path('users_mapping_db.yaml').is_file():
-                with open('users_mapping_db.yaml', 'r') as file:
-                    users_mapping_db = yaml.safe_load(file)
-            else:
-                users_mapping_db = {}
-            if not jarvice_user in users_mapping_db:
-                users_mapping_db[jarvice_user] = {}
-            users_mapping_db[jarvice_user]['email'] = user_mail
-            users_mapping_db[jarvice_user]['mapped_user'] = job_mapped_user
-            users_mapping_db[jarvice_user]['ssh_private_key_b64'] = job_mapped_user_private_key
-            with open('users_mapping_db.yaml', 'w') as file:
-                yaml.dump(users_mapping_db, file)
-            job_mapped_user_private_key = b64decode(job_mapped_user_private_key).decode('utf-8')
+            previous = self.users_db.set(jarvice_user, user_mail,
+                                         job_mapped_user,
+                                         job_mapped_user_private_key)
+            if previous and previous['ssh_private_key_b64'] != \
+                    job_mapped_user_private_key:
+                # Key changed, drop previous one from cache
+                self.ssh_keys.invalidate(previous['ssh_private_key_b64'])
+            job_mapped_user_private_key = self.ssh_keys.decode_b64(job_mapped_user_private_key)
+            timer.mark('mapping')
             # ssh to cluster and submit job
             stdout, stderr = self.ssh_as_user(
                 job_mapped_user,
@@ -977,36 +1312,39 @@ EOF
                     sbatch %s %s %s %s %s %s \
                     --parsable -J "jarvice_%s" -o "%s.jarvice/%s.out" \
                     -n %d -N %d %s %s' %
-                ('-p ' + slurm_part if slurm_part else '',
-                    '--mem=' + slurm_mem + 'G' if slurm_mem else '',
-                    '--gpus-per-node=' + slurm_gpus if slurm_gpus else '',
-                    '--exclusive' if slurm_exclusive else '',
-                    '--time=' + slurm_time if slurm_time else '',
-                    sbatch_add_params if sbatch_add_params else '',
+                ('-p ' + settings.partition if settings.partition else '',
+                    '--mem=' + settings.mem + 'G' if settings.mem else '',
+                    '--gpus-per-node=' + settings.gpus if settings.gpus else '',
+                    '--exclusive' if settings.exclusive else '',
+                    '--time=' + settings.time if settings.time else '',
+                    settings.sbatch_params if settings.sbatch_params else '',
                     name, self.job_scratch_dir,
-                    name, jobobj_cores * nodes, nodes, '-H' if held else '',
-                    f'-L {licenses}' if licenses else ''),
-                instr=script)
+                    name, job.cores * nodes, nodes, '-H' if held else '',
+                    f'-L {settings.licenses}' if settings.licenses else ''),
+                instr=script, kind='sbatch')
             if not stdout:
                 raise Exception(
                     'submit(): sbatch: ' + stderr.replace('\n', ' -- '))
+            timer.mark('sbatch')
             # job output is the job_id returned by slurm
             job_id = stdout
 
-        # remove sensitive lines from script before storing
-        slines = [
-            'export SINGULARITY_DOCKER_USERNAME=',
-            'export SINGULARITY_DOCKER_PASSWORD=']
-        fscript = ''
-        for i in script.splitlines():
-            if not [x for x in slines if x == i[:len(x)]]:
-                fscript += (i + '\n')
+        # New job must show up in next queued/running answers
+        self.jobs.invalidate()
 
+        # fscript is script without sensitive lines, for storing
         return job_id, fscript
 
     def gc_job(self, name, number, jobid, cancel=False):
         """ garbage collects slurm and k8s objects for a single job """
 
+        # No users are mapped with slurmrestd, output is left in place
+        if self.users_db is None:
+            if cancel:
+                self.log.info(f'Cancelling job: {jobid}')
+                self.slurmrestd.cancel(jobid)
+            return
+
         job_mapped_user, job_mapped_user_private_key = self.user_id_mapping_from_cache(name)
 
         # cancel Slurm job if asked
@@ -1026,59 +1364,262 @@ EOF
                 '/bin/sh -c "nohup rm -Rf %s.out %s >/dev/null 2>&1 &"' % (
                     self.job_scratch_dir + '.jarvice/' + name,
                     self.job_scratch_dir + '.jarvice/jobs/' + jobid
-                )
+                ),
+                kind='rm'
         )
 
-    def squeue(self, user=None, states=None):
-        """ runs squeue (with optional filters) and returns parsed list """
+    def squeue_snapshot(self, force=False):
+        """ returns jobs table, refreshed if older than squeue_ttl """
+
+        # When poller is running, readers only refresh the table if it
+        # was invalidated or if poller is late
+        ttl = self.squeue_ttl
+        if self.poller_thread is not None:
+            ttl = max(ttl, 2 * self.poller_interval)
+
+        age = self.jobs.age()
+        if not force and age is not None and age < ttl:
+            return self.jobs
+
+        # Only one refresh at a time, concurrent callers wait and
+        # share its result
+        with self.squeue_lock:
+            age = self.jobs.age()
+            if not force and age is not None and age < ttl:
+                return self.jobs
+            start = time.monotonic()
+            generation = self.jobs.current_generation()
+            if self.slurmrestd:
+                jobs = [self.slurmrestd_job_entry(job) for job in
+                        self.slurmrestd.jobs()
+                        if job.get('name', '').startswith('jarvice_')]
+                self.jobs.update(jobs, time.monotonic() - start, generation)
+                return self.jobs
+            stdout, stderr = self.ssh(
+                'squeue --noheader -t all -o "%j|%A|%t|%M|%N"')
+            if not stdout and stderr:
+                raise Exception('squeue failed: ' + stderr)
+            jobs = []
+            for line in stdout.splitlines():
+                if line.startswith('jarvice_'):
+                    try:
+                        name, jobid, state, elapsed, nodes = \
+                            line[8:].split('|')
+                        jobs.append(job_entry(
+                            jobid, name, state,
+                            self.normalize_elapsed(elapsed),
+                            nodes.split(',')))
+                    except Exception:
+                        self.log.warning(
+                            'failed to parse squeue line: %s' % line)
+            self.jobs.update(jobs, time.monotonic() - start, generation)
+        return self.jobs
+
+    def sacct_jobs(self, jobids):
+        """
+        returns {jobid: (state, elapsed)} of many jobs at once, from
+        accounting. Only parent job records are considered, not steps.
+        Empty if accounting is disabled.
+        """
+        if self.slurmrestd:
+            jobs = {}
+            for jobid in jobids:
+                job = self.slurmrestd.accounting_job(jobid)
+                if job is not None:
+                    jobs[jobid] = (
+                        slurmrestd.state(job),
+                        self.format_elapsed(
+                            slurmrestd.number(
+                                job.get('time', {}).get('elapsed'))))
+            return jobs
+        jobids = self.valid_jobids(jobids)
+        if not jobids:
+            return {}
+        stdout, stderr = self.ssh(
+            'sacct --parsable2 --noheader -X --jobs=%s -o jobid,state,elapsed'
+            % ','.join(jobids))
+        if 'disabled' in stderr:
+            return {}
+        jobs = {}
+        for line in stdout.splitlines():
+            try:
+                jobid, state, elapsed = line.split('|')
+                if jobid in jobids:
+                    # state can be suffixed, like CANCELLED by 1000
+                    jobs[jobid] = (state.split(' ')[0],
+                                   self.normalize_elapsed(elapsed))
+            except Exception:
+                self.log.warning('failed to parse sacct line: %s' % line)
+        return jobs
 
-        # TODO: filter only jobs that we have started
+    def sacct_recent(self, vanished=[]):
+        """
+        refreshes recently finished jobs of jobs table from sacct.
+        Jobs that vanished from squeue since last poll are queried too,
+        whatever their end time.
+        """
+        if self.poller_sacct_disabled:
+            return
+        if self.slurmrestd:
+            # Only jobs that vanished from slurmctld are fetched from
+            # slurmdbd, one by one over a kept alive connection
+            stdout, stderr = '', ''
+        else:
+            stdout, stderr = self.ssh(
+                'sacct -a -X --parsable2 --noheader -S now-%d -E now '
+                '-s CD,F,CA,NF,OOM,DL,PR,TO -o jobid,jobname,state,elapsed'
+                % self.poller_sacct_window)
+        if 'disabled' in stderr:
+            self.log.warning('sacct disabled on cluster, jobs poller will '
+                             'only rely on squeue')
+            self.poller_sacct_disabled = True
+            return
+        if not stdout and stderr:
+            raise Exception('sacct failed: ' + stderr)
+        jobs = []
+        for line in stdout.splitlines():
+            try:
+                jobid, name, state, elapsed = line.split('|')
+                if name.startswith('jarvice_'):
+                    # state can be suffixed, like CANCELLED by 1000
+                    jobs.append(job_entry(
+                        jobid, name[8:], state.split(' ')[0],
+                        self.normalize_elapsed(elapsed), [], 'sacct'))
+            except Exception:
+                self.log.warning('failed to parse sacct line: %s' % line)
+        known = set(job.jobid for job in jobs)
+        vanished = [jobid for jobid in vanished if jobid not in known]
+        if vanished:
+            for jobid, (state, elapsed) in self.sacct_jobs(vanished).items():
+                previous = self.poller_live.get(jobid)
+                jobs.append(job_entry(jobid, previous.name, state, elapsed,
+                                      [], 'sacct'))
+        self.jobs.update_finished(jobs)
+
+    def poll(self):
+        """ refreshes whole jobs table once """
+        start = time.monotonic()
+        live = self.squeue_snapshot(force=True).live()
+        if self.poller_sacct_window > 0:
+            self.sacct_recent([jobid for jobid in self.poller_live
+                               if jobid not in live])
+        self.poller_live = live
+        self.poller_duration = time.monotonic() - start
+
+    def evict_connections(self):
+        """ closes idle SSH connections past their idle timeout """
+        if self.ssh_service_pool is not None:
+            self.ssh_service_pool.evict()
+        self.ssh_user_pools.evict()
+
+    def poller(self):
+        """ jobs poller main loop """
+        while not self.poller_stop.is_set():
+            try:
+                self.poll()
+                self.evict_connections()
+            except Exception as e:
+                self.log.warning('jobs poller failed: %s' % str(e))
+            if self.poller_duration > self.poller_interval:
+                self.log.warning(
+                    'jobs poller falling behind, poll took %.2fs' %
+                    self.poller_duration)
+            self.poller_stop.wait(
+                max(self.poller_interval - self.poller_duration, 0))
+
+    def slurmrestd_job_entry(self, job):
+        """ returns job_entry of a slurmrestd job """
+        state = slurmrestd.state(job)
+        nodes = job.get('nodes', '')
+        return job_entry(
+            str(job['job_id']), job.get('name', '')[8:],
+            slurmrestd.job_states.get(state, state),
+            self.format_elapsed(slurmrestd.elapsed(job)),
+            nodes.split(',') if nodes else [''])
+
+    @staticmethod
+    def format_elapsed(seconds):
+        """ formats elapsed seconds into HH:MM:SS """
+        return '%02d:%02d:%02d' % (
+            seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+    @staticmethod
+    def normalize_elapsed(elapsed):
+        """ normalize Slurm elapsed time into HH:MM:SS """
+
+        # Time can be in multiple format:
+        # mm:ss
+        # hh:mm:ss
+        # dd-hh:mm:ss
+        # normalize elapsed time into HH:MM:SS regardless of what we get
+
+        if '-' in elapsed:  # Days are provided
+            days = int(elapsed.split('-')[0])
+            elapsed = elapsed.split('-')[1]
+        else:
+            days = 0
 
-        queue = []
-        fmt = '%j|%A'
-        cmd = 'squeue --noheader'
-        fmt += '|%u'
-        if states:
-            cmd += (' -t "%s"' % states)
+        if len(elapsed.split(':')) == 3:
+            hours = int(elapsed.split(':')[0]) + days * 24
+            mins = int(elapsed.split(':')[1])
+            secs = int(elapsed.split(':')[2])
         else:
-            fmt += '|%t'
-        cmd += (' -o "%s"' % fmt)
+            hours = 0
+            mins = int(elapsed.split(':')[0])
+            secs = int(elapsed.split(':')[1])
+
+        return '%02d:%02d:%02d' % (hours, mins, secs)
+
+    def valid_jobids(self, jobids):
+        """ returns jobids that are Slurm job ids, skipping others """
+        valid = []
+        for jobid in jobids:
+            if slurm_jobid.fullmatch(str(jobid)):
+                valid.append(jobid)
+            else:
+                self.log.warning('skipping invalid job id: %r' % (jobid,))
+        return valid
+
+    def squeue_jobs(self, jobids):
+        """ returns {jobid: (state, elapsed, nodes)} of many jobs at once """
+        if self.slurmrestd:
+            jobs = {}
+            for job in self.slurmrestd.jobs():
+                if str(job.get('job_id')) in jobids:
+                    job = self.slurmrestd_job_entry(job)
+                    jobs[job.jobid] = (job.state, job.elapsed, job.nodes)
+            return jobs
+        jobids = self.valid_jobids(jobids)
+        if not jobids:
+            return {}
+        cmd = 'squeue --noheader -o "%%A|%%t|%%M|%%N" -j %s -t all' % \
+            ','.join(jobids)
         stdout, stderr = self.ssh(cmd)
+        jobs = {}
         for line in stdout.splitlines():
-            if line.startswith('jarvice_'):
-                queue.append(line[8:].split('|')[0:2])
-        return queue
+            try:
+                jobid, state, elapsed, nodes = line.split('|')
+                jobs[jobid] = (state, self.normalize_elapsed(elapsed),
+                               nodes.split(','))
+            except Exception:
+                logging.warning('failed to parse squeue line: %s' % line)
+        return jobs
 
     def squeue1(self, jobid, user=None):
         """ returns job info on a single job """
+        if self.slurmrestd:
+            job = self.slurmrestd.job(jobid)
+            if job is None:
+                logging.warning('failed to fetch job info for %s' % jobid)
+                return None, None, None
+            job = self.slurmrestd_job_entry(job)
+            return job.state, job.elapsed, job.nodes
         cmd = 'squeue --noheader -o "%%t|%%M|%%N" -j %s -t all' % jobid
-        stdout, stderr = self.ssh(cmd)
+        stdout, stderr = self.ssh(cmd, kind='squeue1')
         try:
             state, elapsed, nodes = stdout.split('|')
             nodes = nodes.split(',')
-
-            # Time can be in multiple format:
-            # mm:ss
-            # hh:mm:ss
-            # dd-hh:mm:ss
-            # normalize elapsed time into HH:MM:SS regardless of what we get
-
-            if '-' in elapsed:  # Days are provided
-                days = int(elapsed.split('-')[0])
-                elapsed = elapsed.split('-')[1]
-            else:
-                days = 0
-
-            if len(elapsed.split(':')) == 3:
-                hours = int(elapsed.split(':')[0]) + days * 24
-                mins = int(elapsed.split(':')[1])
-                secs = int(elapsed.split(':')[2])
-            else:
-                hours = 0
-                mins = int(elapsed.split(':')[0])
-                secs = int(elapsed.split(':')[1])
-
-            elapsed = '%02d:%02d:%02d' % (hours, mins, secs)
+            elapsed = self.normalize_elapsed(elapsed)
 
             return state, elapsed, nodes
 
@@ -1088,64 +1629,163 @@ EOF
 
     def ssh_key_load(self, ssh_pkey):
         """ returns private key, either RSA or ED25519 """
+        return self.ssh_keys.load(ssh_pkey)
+
+    def stats(self):
+        """ returns internal counters of connections and caches """
+        stats = {
+            'ssh_pool': self.ssh_service_pool.stats()
+            if self.ssh_service_pool else {},
+            'ssh_user_pools': self.ssh_user_pools.stats(),
+            'ssh_keys': self.ssh_keys.stats(),
+            'jobs': {
+                'jobs': len(self.jobs),
+                'snapshot_age': self.jobs.age(),
+                'squeue_duration': self.jobs.duration,
+                'poll_duration': self.poller_duration
+            }
+        }
+        if self.users_db is not None:
+            stats['users'] = {
+                'mapped': len(self.users_db),
+                'id_mapping': len(self.users_id_mapping_configuration),
+                'id_mapping_reloads':
+                    self.users_id_mapping_configuration.reloads
+            }
+        return stats
+
+    def metrics_gauges(self):
+        """ returns stats as gauges, for metrics """
+        return flatten(self.stats(), 'jarvice_slurm')
+
+    @staticmethod
+    def command_kind(cmd):
+        """ returns type of a remote command, its program name """
+        words = cmd.split(None, 1)
+        return os.path.basename(words[0]) if words else 'none'
+
+    def observe_ssh(self, kind, timings, failed=False):
+        if 'connect' in timings:
+            ssh_connect_seconds.observe(timings['connect'], command=kind)
+        if 'exec' in timings:
+            ssh_exec_seconds.observe(timings['exec'], command=kind)
+        if failed:
+            ssh_errors.inc(command=kind)
+
+    def observed_stream(self, chunks, kind, timings):
+        """ generator passing chunks through, observing them at end """
+        failed = False
         try:
-            pkey = paramiko.RSAKey.from_private_key(io.StringIO(ssh_pkey))
-            return pkey
-        except paramiko.SSHException:
-            pass
-        try:
-            pkey = paramiko.Ed25519Key.from_private_key(io.StringIO(ssh_pkey))
-            return pkey
-        except paramiko.SSHException:
-            pass
-        raise ValueError("Unsupported key type")
+            yield from chunks
+        except Exception:
+            failed = True
+            raise
+        finally:
+            chunks.close()
+            self.observe_ssh(kind, timings, failed)
 
-    def ssh(self, cmd, instr=None):
-        """ SSH's to slurm cluster and returns stdout/stderr """
+    def ssh(self, cmd, instr=None, kind=None):
+        """
+        SSH's to slurm cluster and returns stdout/stderr.
+        kind is the command type in metrics, default is program name.
+        """
 
-        with paramiko.client.SSHClient() as client:
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                self.ssh_host, username=self.ssh_user,
-                port=self.ssh_port,
-                pkey=self.ssh_key_load(self.ssh_pkey))
+        # Pool is created on first use, so that a bad key does not
+        # prevent the service from starting
+        if self.ssh_service_pool is None:
+            with self.ssh_pool_lock:
+                if self.ssh_service_pool is None:
+                    self.ssh_service_pool = ssh_pool(
+                        self.ssh_host, self.ssh_port, self.ssh_user,
+                        self.ssh_key_load(self.ssh_pkey),
+                        size=self.ssh_pool_size,
+                        idle_timeout=self.ssh_pool_idle_timeout,
+                        keepalive=self.ssh_keepalive,
+                        acquire_timeout=self.ssh_pool_acquire_timeout,
+                        log=self.log)
+
+        self.log.info(
+            'ssh -p %s %s@%s %s' % (str(self.ssh_port),
+                                    self.ssh_user, self.ssh_host, cmd))
+        kind = kind if kind else self.command_kind(cmd)
+        timings = {}
+        try:
+            stdout, stderr = self.ssh_service_pool.exec_command(
+                cmd, instr, timings=timings)
+        except Exception:
+            self.observe_ssh(kind, timings, True)
+            raise
+        self.observe_ssh(kind, timings)
+        if len(stdout) > 1:
+            self.log.debug('stdout: %s' % stdout)
+        if len(stderr) > 1:
+            self.log.debug('stderr: %s' % stderr)
+        return stdout, stderr
+
+    def ssh_stream_as_user(self, user, pkey, cmd, compress=False, kind=None):
+        """
+        SSH's to slurm cluster as specific user and returns a generator
+        of stdout chunks, at most log_max_bytes in total.
+        If compress, stdout is gzipped on cluster side.
+        """
 
-            self.log.info(
-                'ssh -p %s %s@%s %s' % (str(self.ssh_port),
-                                        self.ssh_user, self.ssh_host, cmd))
-            stdin, stdout, stderr = client.exec_command(cmd)
-            if instr:
-                stdin.write(instr.encode())
-            stdin.close()
-            stdout = stdout.read().decode().rstrip()
-            stderr = stderr.read().decode().rstrip()
-            if len(stdout) > 1:
-                self.log.debug('stdout: %s' % stdout)
-            if len(stderr) > 1:
-                self.log.debug('stderr: %s' % stderr)
-            return stdout, stderr
-
-    def ssh_as_user(self, user, pkey, cmd, instr=None):
-        """ SSH's to slurm cluster as specific user and returns stdout/stderr """
-
-        with paramiko.client.SSHClient() as client:
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(
-                self.ssh_host, username=user,
-                port=self.ssh_port,
-                pkey=self.ssh_key_load(pkey))
+        kind = kind if kind else self.command_kind(cmd)
+        if compress:
+            cmd = '{ %s; } | gzip -c -1' % cmd
+        self.log.info(
+            'ssh -p %s %s@%s %s (streamed)' % (str(self.ssh_port),
+                                               user, self.ssh_host, cmd))
+        timings = {}
+        chunks = self.observed_stream(self.ssh_user_pools.stream_command(
+            user, pkey, cmd, max_bytes=self.log_max_bytes, timings=timings),
+            kind, timings)
+        return self.gunzip_stream(chunks) if compress else chunks
+
+    @staticmethod
+    def gunzip_stream(chunks):
+        """ generator decompressing a stream of gzip chunks """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            for data in chunks:
+                data = decompressor.decompress(data)
+                if data:
+                    yield data
+            data = decompressor.flush()
+            if data:
+                yield data
+        finally:
+            chunks.close()
+
+    def ssh_as_user(self, user, pkey, cmd, instr=None, raw=False,
+                    compress=False, kind=None):
+        """
+        SSH's to slurm cluster as specific user and returns stdout/stderr.
+        If raw, stdout is returned as bytes.
+        If compress, stdout is gzipped on cluster side.
+        kind is the command type in metrics, default is program name.
+        """
 
-            self.log.info(
-                'ssh -p %s %s@%s %s' % (str(self.ssh_port),
-                                        user, self.ssh_host, cmd))
-            stdin, stdout, stderr = client.exec_command(cmd)
-            if instr:
-                stdin.write(instr.encode())
-            stdin.close()
-            stdout = stdout.read().decode().rstrip()
-            stderr = stderr.read().decode().rstrip()
-            if len(stdout) > 1:
-                self.log.debug('stdout: %s' % stdout)
-            if len(stderr) > 1:
-                self.log.debug('stderr: %s' % stderr)
-            return stdout, stderr
+        kind = kind if kind else self.command_kind(cmd)
+        if compress:
+            cmd = '{ %s; } | gzip -c -1' % cmd
+        self.log.info(
+            'ssh -p %s %s@%s %s' % (str(self.ssh_port),
+                                    user, self.ssh_host, cmd))
+        timings = {}
+        try:
+            stdout, stderr = self.ssh_user_pools.exec_command(
+                user, pkey, cmd, instr, raw or compress, timings=timings)
+        except Exception:
+            self.observe_ssh(kind, timings, True)
+            raise
+        self.observe_ssh(kind, timings)
+        if compress:
+            stdout = zlib.decompress(stdout, 16 + zlib.MAX_WBITS) \
+                if stdout else b''
+            if not raw:
+                stdout = stdout.decode().rstrip()
+        if len(stdout) > 1:
+            self.log.debug('stdout: %s' % stdout)
+        if len(stderr) > 1:
+            self.log.debug('stderr: %s' % stderr)
+        return stdout, stderr
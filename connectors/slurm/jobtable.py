@@ -0,0 +1,97 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+import threading
+import time
+from collections import namedtuple
+
+# A job as seen by Slurm. name is without the jarvice_ prefix,
+# elapsed is normalized as HH:MM:SS, nodes is a list of node names.
+# source is the command the state comes from, squeue (compact state codes,
+# like CD) or sacct (full state names, like COMPLETED)
+job_entry = namedtuple('job_entry', ['jobid', 'name', 'state', 'elapsed',
+                                     'nodes', 'source'],
+                       defaults=['squeue'])
+
+
+class job_table(object):
+    """
+    In memory snapshot of cluster jobs, indexed by jobid.
+
+    Live jobs (from squeue) and recently finished jobs (from sacct) are kept
+    apart, live ones taking precedence. Each set is replaced as a whole on
+    update, so readers always see a consistent snapshot.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.finished = {}
+        # monotonic time of last update, None if never updated
+        self.updated = None
+        # time spent to gather last snapshot, in seconds
+        self.duration = 0.0
+        # bumped on each invalidation
+        self.generation = 0
+
+    def update(self, jobs, duration=0.0, generation=None):
+        """
+        replaces table content with jobs, a list of job_entry.
+        If generation is given and table was invalidated since it was
+        obtained, snapshot is stored but stays outdated.
+        """
+        table = dict((job.jobid, job) for job in jobs)
+        with self.lock:
+            self.jobs = table
+            if generation is None or generation == self.generation:
+                self.updated = time.monotonic()
+            self.duration = duration
+
+    def update_finished(self, jobs):
+        """ replaces recently finished jobs with jobs, a list of job_entry """
+        table = dict((job.jobid, job) for job in jobs)
+        with self.lock:
+            self.finished = table
+
+    def invalidate(self):
+        """ marks snapshot as outdated, so next reader refreshes it """
+        with self.lock:
+            self.generation += 1
+            self.updated = None
+
+    def current_generation(self):
+        """ returns generation to pass to update() """
+        with self.lock:
+            return self.generation
+
+    def age(self):
+        """ returns age of snapshot in seconds, None if never updated """
+        with self.lock:
+            updated = self.updated
+        return None if updated is None else time.monotonic() - updated
+
+    def get(self, jobid):
+        """ returns job_entry of jobid, None if not in snapshot """
+        with self.lock:
+            job = self.jobs.get(jobid)
+            return job if job else self.finished.get(jobid)
+
+    def live(self):
+        """ returns {jobid: job_entry} of jobs seen by squeue """
+        with self.lock:
+            return self.jobs
+
+    def __len__(self):
+        with self.lock:
+            return len(self.jobs) + len(self.finished)
+
+    def select(self, states):
+        """ returns [[name, jobid], ...] of jobs in one of states """
+        with self.lock:
+            jobs = self.jobs
+        return [[job.name, job.jobid] for job in jobs.values()
+                if job.state in states]
@@ -0,0 +1,224 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+import http.client
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+# slurmrestd job states, mapped to squeue compact state codes
+job_states = {
+    'BOOT_FAIL': 'BF',
+    'CANCELLED': 'CA',
+    'COMPLETED': 'CD',
+    'COMPLETING': 'CG',
+    'CONFIGURING': 'CF',
+    'DEADLINE': 'DL',
+    'FAILED': 'F',
+    'NODE_FAIL': 'NF',
+    'OUT_OF_MEMORY': 'OOM',
+    'PENDING': 'PD',
+    'PREEMPTED': 'PR',
+    'REQUEUED': 'RQ',
+    'REQUEUE_FED': 'RF',
+    'REQUEUE_HOLD': 'RH',
+    'RESIZING': 'RS',
+    'RESV_DEL_HOLD': 'RD',
+    'REVOKED': 'RV',
+    'RUNNING': 'R',
+    'SIGNALING': 'SI',
+    'SPECIAL_EXIT': 'SE',
+    'STAGE_OUT': 'SO',
+    'STOPPED': 'ST',
+    'SUSPENDED': 'S',
+    'TIMEOUT': 'TO'
+}
+
+
+def number(value):
+    """
+    returns integer value of a slurmrestd number, which can be a plain
+    integer or, since v0.0.40, {"set": true, "infinite": false, "number": 1}
+    """
+    if isinstance(value, dict):
+        return int(value.get('number', 0)) if value.get('set', True) else 0
+    return int(value) if value else 0
+
+
+def state(job):
+    """ returns job state name, from a slurmrestd or slurmdbd job """
+    value = job.get('job_state', job.get('state'))
+    if isinstance(value, dict):
+        # slurmdbd jobs
+        value = value.get('current')
+    if isinstance(value, list):
+        # since v0.0.40 state is a list, base state first then flags
+        value = value[0] if value else ''
+    return str(value)
+
+
+def elapsed(job, now=None):
+    """ returns elapsed seconds of a slurmrestd job """
+    start = number(job.get('start_time'))
+    if start <= 0 or state(job) == 'PENDING':
+        return 0
+    end = number(job.get('end_time'))
+    if end <= 0 or end < start:
+        end = int(now if now else time.time())
+    return max(end - start, 0)
+
+
+class slurmrestd_client(object):
+    """
+    Minimal slurmrestd client, over persistent HTTP connections.
+
+    Connections are kept alive and reused between requests, at most
+    size of them being open at the same time. Requests are authenticated
+    with user and token, unless other credentials are given for a call.
+    """
+
+    def __init__(self, addr, port, api_version, user=None, token=None,
+                 size=4, timeout=30, log=None):
+        # addr includes scheme, like http://mg1
+        url = urllib.parse.urlsplit(addr if '//' in addr else '//' + addr)
+        self.scheme = url.scheme if url.scheme else 'http'
+        self.host = url.hostname
+        self.port = int(port if port else (url.port if url.port else 6820))
+        self.api_version = api_version
+        self.user = user
+        self.token = token
+        self.timeout = timeout
+        self.log = log if log else logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(int(size), 1))
+        self.idle = []
+
+    def connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(
+            self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, user=None, token=None):
+        """ sends request, returns decoded json answer """
+        headers = {
+            'X-SLURM-USER-NAME': user if user else self.user,
+            'X-SLURM-USER-TOKEN': token if token else self.token,
+            'Accept': 'application/json'
+        }
+        headers = dict((k, v) for k, v in headers.items() if v)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        self.log.info('slurmrestd %s %s' % (method, path))
+
+        self.slots.acquire()
+        try:
+            # A kept alive connection may have been closed by server
+            # meanwhile, request is then retried once on a new connection
+            for attempt in range(2):
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                reused = conn is not None
+                if not reused:
+                    conn = self.connect()
+                try:
+                    conn.request(method, path, body=body, headers=headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.RemoteDisconnected,
+                        ConnectionResetError, BrokenPipeError) as e:
+                    conn.close()
+                    if reused and attempt == 0:
+                        self.log.debug('slurmrestd: stale connection, '
+                                       'reconnecting: %s' % str(e))
+                        continue
+                    raise
+                except Exception:
+                    conn.close()
+                    raise
+                if response.will_close:
+                    conn.close()
+                else:
+                    with self.lock:
+                        self.idle.append(conn)
+                break
+        finally:
+            self.slots.release()
+
+        try:
+            answer = json.loads(data) if data else {}
+        except ValueError:
+            raise Exception('slurmrestd: %s %s returned %d: %s' % (
+                method, path, response.status, data[:200]))
+        errors = answer.get('errors', [])
+        if response.status >= 400 or errors:
+            raise Exception('slurmrestd: %s %s returned %d: %s' % (
+                method, path, response.status, json.dumps(errors)))
+        return answer
+
+    def url(self, path, api='slurm'):
+        return '/%s/%s/%s' % (api, self.api_version, path)
+
+    def ping(self):
+        """ returns ping answer of slurmrestd """
+        return self.request('GET', self.url('ping'))
+
+    def submit(self, job, user=None, token=None):
+        """ submits job, a dict with script and job keys, returns job id """
+        answer = self.request('POST', self.url('job/submit'), body=job,
+                              user=user, token=token)
+        return str(answer['job_id'])
+
+    def job(self, jobid):
+        """ returns a single job, None if unknown """
+        try:
+            jobs = self.request('GET', self.url('job/%s' % jobid)).get(
+                'jobs', [])
+        except Exception as e:
+            self.log.debug('slurmrestd: could not get job %s: %s' % (
+                jobid, str(e)))
+            return None
+        return jobs[0] if jobs else None
+
+    def jobs(self):
+        """ returns list of all jobs known by slurmctld """
+        return self.request('GET', self.url('jobs')).get('jobs', [])
+
+    def cancel(self, jobid, user=None, token=None):
+        """ kills a job """
+        return self.request('DELETE',
+                            self.url('job/%s?signal=KILL' % jobid),
+                            user=user, token=token)
+
+    def release(self, jobid, user=None, token=None):
+        """ releases a held job """
+        return self.request('POST', self.url('job/%s' % jobid),
+                            body={'hold': False}, user=user, token=token)
+
+    def accounting_job(self, jobid):
+        """ returns a single job from slurmdbd, None if unknown """
+        try:
+            jobs = self.request(
+                'GET', self.url('job/%s' % jobid, api='slurmdb')).get(
+                    'jobs', [])
+        except Exception as e:
+            self.log.debug('slurmrestd: could not get job %s: %s' % (
+                jobid, str(e)))
+            return None
+        return jobs[0] if jobs else None
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Local stand-in for slurmrestd, to test and benchmark the Slurm connector
+# http interface without a Slurm cluster.
+# Jobs are kept in memory: they stay PENDING for --queued-time seconds
+# (or until released if submitted held), then RUNNING for --running-time
+# seconds, then COMPLETED.
+#
+# Usage:
+#   python3 -m connectors.slurm.slurmrestd_stub --port 6820
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class slurmrestd_stub(object):
+    """ in memory jobs of the stub """
+
+    def __init__(self, queued_time=5, running_time=10):
+        self.queued_time = queued_time
+        self.running_time = running_time
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.next_jobid = 1000
+
+    def submit(self, desc):
+        job = desc.get('job', {})
+        with self.lock:
+            self.next_jobid += 1
+            jobid = self.next_jobid
+            self.jobs[jobid] = {
+                'job_id': jobid,
+                'name': job.get('name', ''),
+                'nodes': '',
+                'submit_time': time.time(),
+                'start_time': None,
+                'end_time': None,
+                'held': bool(job.get('hold', False)),
+                'cancelled': False
+            }
+        return jobid
+
+    def state(self, job, now):
+        """ returns state of job at time now, updating its times """
+        if job['cancelled']:
+            return 'CANCELLED'
+        if job['start_time'] is None:
+            if job['held'] or now - job['submit_time'] < self.queued_time:
+                return 'PENDING'
+            job['start_time'] = job['submit_time'] + self.queued_time
+            job['end_time'] = job['start_time'] + self.running_time
+            job['nodes'] = 'node001'
+        if now < job['end_time']:
+            return 'RUNNING'
+        return 'COMPLETED'
+
+    def render(self, job, now):
+        state = self.state(job, now)
+        start = int(job['start_time']) if job['start_time'] else 0
+        end = int(min(job['end_time'], now)) if job['end_time'] else 0
+        return {
+            'job_id': job['job_id'],
+            'name': job['name'],
+            'job_state': [state],
+            'nodes': job['nodes'],
+            'start_time': {'set': True, 'infinite': False, 'number': start},
+            'end_time': {'set': True, 'infinite': False, 'number': end}
+        }
+
+    def get(self, jobid):
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(jobid)
+            return [self.render(job, now)] if job else []
+
+    def all(self):
+        now = time.time()
+        with self.lock:
+            return [self.render(job, now) for job in self.jobs.values()]
+
+    def accounting(self, jobid):
+        now = time.time()
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if not job:
+                return []
+            rendered = self.render(job, now)
+        start = rendered['start_time']['number']
+        end = rendered['end_time']['number']
+        return [{
+            'job_id': jobid,
+            'name': rendered['name'],
+            'state': {'current': rendered['job_state'], 'reason': 'None'},
+            'time': {'start': start, 'end': end,
+                     'elapsed': max(end - start, 0)}
+        }]
+
+    def cancel(self, jobid):
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if not job:
+                return False
+            if job['end_time'] is None or job['end_time'] > time.time():
+                job['cancelled'] = True
+                job['end_time'] = time.time()
+            return True
+
+    def update(self, jobid, desc):
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if not job:
+                return False
+            if 'hold' in desc:
+                job['held'] = bool(desc['hold'])
+                if not job['held']:
+                    # Queued time starts at release
+                    job['submit_time'] = time.time() - self.queued_time
+            return True
+
+
+class handler(BaseHTTPRequestHandler):
+
+    # Keep connections alive, as real slurmrestd does
+    protocol_version = 'HTTP/1.1'
+    routes = [
+        ('GET', r'^/slurm/[^/]+/ping$', 'ping'),
+        ('POST', r'^/slurm/[^/]+/job/submit$', 'submit'),
+        ('GET', r'^/slurm/[^/]+/jobs$', 'jobs'),
+        ('GET', r'^/slurm/[^/]+/job/(\d+)$', 'job'),
+        ('POST', r'^/slurm/[^/]+/job/(\d+)$', 'update'),
+        ('DELETE', r'^/slurm/[^/]+/job/(\d+)$', 'cancel'),
+        ('GET', r'^/slurmdb/[^/]+/job/(\d+)$', 'accounting')
+    ]
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def answer(self, code, content):
+        data = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self, method):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else {}
+        path = self.path.split('?')[0]
+        if not self.headers.get('X-SLURM-USER-TOKEN'):
+            return self.answer(401, {'errors': [
+                {'error': 'Authentication failure'}]})
+        stub = self.server.stub
+        for route_method, pattern, action in self.routes:
+            match = re.match(pattern, path)
+            if route_method != method or not match:
+                continue
+            jobid = int(match.group(1)) if match.groups() else None
+            if action == 'ping':
+                return self.answer(200, {'pings': [{'pinged': 'UP'}],
+                                         'errors': []})
+            elif action == 'submit':
+                return self.answer(200, {'job_id': stub.submit(body),
+                                         'errors': []})
+            elif action == 'jobs':
+                return self.answer(200, {'jobs': stub.all(), 'errors': []})
+            elif action == 'job':
+                jobs = stub.get(jobid)
+                if not jobs:
+                    break
+                return self.answer(200, {'jobs': jobs, 'errors': []})
+            elif action == 'accounting':
+                jobs = stub.accounting(jobid)
+                if not jobs:
+                    break
+                return self.answer(200, {'jobs': jobs, 'errors': []})
+            elif action == 'cancel':
+                if not stub.cancel(jobid):
+                    break
+                return self.answer(200, {'errors': []})
+            elif action == 'update':
+                if not stub.update(jobid, body):
+                    break
+                return self.answer(200, {'errors': []})
+        self.answer(404, {'errors': [{'error': 'Not found: ' + path}]})
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+
+def serve(host='127.0.0.1', port=6820, queued_time=5, running_time=10,
+          verbose=False):
+    """ starts stub in a background thread, returns server """
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stub = slurmrestd_stub(queued_time, running_time)
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='slurmrestd stub')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6820)
+    parser.add_argument('--queued-time', type=float, default=5)
+    parser.add_argument('--running-time', type=float, default=10)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.queued_time, args.running_time,
+                   args.verbose)
+    print('slurmrestd stub listening on %s:%d' % (args.host, args.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
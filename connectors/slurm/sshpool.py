@@ -0,0 +1,458 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+import hashlib
+import io
+import socket
+import threading
+import time
+import logging
+import paramiko
+from base64 import b64decode
+from collections import OrderedDict
+
+
+class ssh_key_cache(object):
+    """
+    Cache of parsed private keys, indexed by a hash of the key material.
+
+    Keys are parsed once, trying each supported type, and base64 encoded
+    keys decoded once.
+    """
+
+    # Supported key types, in the order they are tried
+    key_classes = [paramiko.RSAKey, paramiko.Ed25519Key]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # hash -> paramiko key
+        self.keys = {}
+        # base64 encoded key -> decoded key
+        self.decoded = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(material):
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    @classmethod
+    def parse(cls, material):
+        """ returns private key, either RSA or ED25519 """
+        for key_class in cls.key_classes:
+            try:
+                return key_class.from_private_key(io.StringIO(material))
+            except paramiko.SSHException:
+                pass
+        raise ValueError("Unsupported key type")
+
+    def load(self, material):
+        """ returns private key, parsing it only if not cached """
+        digest = self.digest(material)
+        with self.lock:
+            key = self.keys.get(digest)
+            if key:
+                self.hits += 1
+                return key
+            self.misses += 1
+        key = self.parse(material)
+        with self.lock:
+            self.keys[digest] = key
+        return key
+
+    def decode_b64(self, b64_material):
+        """ returns base64 decoded key material """
+        with self.lock:
+            material = self.decoded.get(b64_material)
+        if material is None:
+            material = b64decode(b64_material).decode('utf-8')
+            with self.lock:
+                self.decoded[b64_material] = material
+        return material
+
+    def invalidate(self, b64_material):
+        """ drops a base64 encoded key, and its parsed key, from cache """
+        with self.lock:
+            material = self.decoded.pop(b64_material, None)
+            if material is not None:
+                self.keys.pop(self.digest(material), None)
+
+    def stats(self):
+        """ returns hits and misses counters """
+        with self.lock:
+            return {'keys': len(self.keys), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+class ssh_pool(object):
+    """
+    Pool of long lived SSH connections to a single host, for a single user.
+
+    Each pooled connection is an authenticated paramiko Transport, and every
+    command runs on a new channel opened on it, so the TCP + key exchange +
+    auth handshake is only paid when a connection is created.
+    A connection runs a single command at a time: concurrent commands use
+    distinct connections, opened on demand and then reused. Channels are not
+    multiplexed on one Transport, so that sshd MaxSessions (10 by default)
+    does not limit pool size, and a slow command (like a streamed job
+    output) does not share a transport and its window with other ones.
+    At most size connections exist at a time, which also bounds the number
+    of concurrent commands. Idle connections are closed after idle_timeout
+    seconds, checked on each acquire and release and on evict() calls, and
+    dead ones are replaced transparently. Getting a connection
+    fails after waiting acquire_timeout seconds for one, 0 waits forever.
+    """
+
+    def __init__(self, host, port, user, pkey, size=4, idle_timeout=300,
+                 keepalive=30, acquire_timeout=60, log=None):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.pkey = pkey
+        self.size = max(int(size), 1)
+        self.idle_timeout = int(idle_timeout)
+        self.keepalive = int(keepalive)
+        self.acquire_timeout = float(acquire_timeout)
+        self.log = log if log else logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+        # Idle connections, as [client, last_used], most recent last
+        self.idle = []
+        self.busy = 0
+        self.closed = False
+
+    def connect(self):
+        """ opens and authenticates a new connection """
+        client = paramiko.client.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(
+                self.host, username=self.user,
+                port=self.port,
+                pkey=self.pkey)
+        except Exception:
+            client.close()
+            raise
+        if self.keepalive > 0:
+            client.get_transport().set_keepalive(self.keepalive)
+        self.log.debug('ssh pool: new connection to %s@%s:%d' %
+                       (self.user, self.host, self.port))
+        return client
+
+    def evict(self, now=None):
+        """ closes idle connections past idle_timeout or not active anymore """
+        now = now if now else time.monotonic()
+        evicted = []
+        with self.lock:
+            kept = []
+            for client, last_used in self.idle:
+                if not self.alive(client) or \
+                        (self.idle_timeout > 0 and
+                         now - last_used > self.idle_timeout):
+                    evicted.append(client)
+                else:
+                    kept.append([client, last_used])
+            self.idle = kept
+        for client in evicted:
+            client.close()
+        return len(evicted)
+
+    @staticmethod
+    def alive(client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def acquire(self):
+        """
+        returns (client, reused), blocking if pool is fully busy, at most
+        acquire_timeout seconds
+        """
+        if not self.slots.acquire(timeout=self.acquire_timeout
+                                  if self.acquire_timeout > 0 else None):
+            raise paramiko.SSHException(
+                'ssh pool: no connection to %s@%s:%d available after %g '
+                'seconds' % (self.user, self.host, self.port,
+                             self.acquire_timeout))
+        try:
+            self.evict()
+            with self.lock:
+                if self.closed:
+                    raise paramiko.SSHException('ssh pool is closed')
+                entry = self.idle.pop() if self.idle else None
+                self.busy += 1
+            if entry:
+                return entry[0], True
+            try:
+                return self.connect(), False
+            except Exception:
+                with self.lock:
+                    self.busy -= 1
+                raise
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, client, discard=False):
+        """ gives back a client to the pool, closing it if discarded """
+        with self.lock:
+            self.busy -= 1
+            if not discard and not self.closed and self.alive(client):
+                self.idle.append([client, time.monotonic()])
+                client = None
+        if client:
+            client.close()
+        self.slots.release()
+        self.evict()
+
+    def exec_command(self, cmd, instr=None, raw=False, timings=None):
+        """
+        runs cmd on a pooled connection, returns stdout, stderr.
+        If raw, stdout is returned as bytes, as received.
+        If timings is a dict, seconds spent getting a connection (waiting
+        for the pool, connecting) and running the command are added to its
+        connect and exec keys.
+        """
+        # A reused connection may have silently died since last use.
+        # Opening the channel is the only step retried on a new connection,
+        # so a command is never executed twice.
+        start = time.monotonic()
+        for attempt in range(2):
+            client, reused = self.acquire()
+            acquired = time.monotonic()
+            try:
+                stdin, stdout, stderr = client.exec_command(cmd)
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                # Connection is dropped, so that retry does not get it
+                # back from the idle list
+                self.release(client, discard=True)
+                if reused and attempt == 0:
+                    self.log.debug('ssh pool: stale connection, '
+                                   'reconnecting: %s' % str(e))
+                    continue
+                raise
+            try:
+                if instr:
+                    stdin.write(instr.encode())
+                stdin.close()
+                out = stdout.read()
+                if not raw:
+                    out = out.decode().rstrip()
+                err = stderr.read().decode().rstrip()
+                stdout.channel.close()
+            except Exception:
+                self.release(client, discard=True)
+                raise
+            finally:
+                self.add_timings(timings, start, acquired)
+            self.release(client)
+            return out, err
+
+    @staticmethod
+    def add_timings(timings, start, acquired):
+        if timings is not None:
+            now = time.monotonic()
+            timings['connect'] = timings.get('connect', 0) + acquired - start
+            timings['exec'] = timings.get('exec', 0) + now - acquired
+
+    def stream_command(self, cmd, chunk_size=65536, max_bytes=0,
+                       timings=None):
+        """
+        generator running cmd on a pooled connection, yielding its stdout
+        as bytes chunks, as they are received. Reading stops after
+        max_bytes, if not 0. Connection is held until generator is
+        exhausted or closed. timings is filled as with exec_command,
+        when generator ends.
+        """
+        start = time.monotonic()
+        for attempt in range(2):
+            client, reused = self.acquire()
+            acquired = time.monotonic()
+            try:
+                channel = client.get_transport().open_session()
+                channel.exec_command(cmd)
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                self.release(client, discard=True)
+                if reused and attempt == 0:
+                    self.log.debug('ssh pool: stale connection, '
+                                   'reconnecting: %s' % str(e))
+                    continue
+                raise
+            break
+
+        discard = False
+        try:
+            channel.shutdown_write()
+            sent = 0
+            while max_bytes <= 0 or sent < max_bytes:
+                size = chunk_size
+                if max_bytes > 0:
+                    size = min(size, max_bytes - sent)
+                data = channel.recv(size)
+                if not data:
+                    break
+                sent += len(data)
+                yield data
+        except Exception:
+            discard = True
+            raise
+        finally:
+            # Closing the channel also stops the remote command
+            # if output was not read entirely
+            channel.close()
+            self.release(client, discard=discard)
+            self.add_timings(timings, start, acquired)
+
+    def stats(self):
+        """ returns pool occupancy """
+        with self.lock:
+            return {'idle': len(self.idle), 'busy': self.busy,
+                    'size': self.size}
+
+    def close(self):
+        """ closes all idle connections, busy ones are closed on release """
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+        for client, last_used in idle:
+            client.close()
+
+
+class ssh_user_pools(object):
+    """
+    Bounded set of ssh_pool, one per (user, private key fingerprint).
+
+    Pools are kept in least recently used order. When more than max_users
+    pools exist, or when a pool was not used for idle_timeout seconds, it is
+    closed and dropped. Each pool holds at most size connections, which is
+    also the number of commands that can run at the same time for a user.
+    """
+
+    def __init__(self, host, port, key_loader, max_users=256, size=2,
+                 idle_timeout=300, keepalive=30, acquire_timeout=60,
+                 log=None):
+        self.host = host
+        self.port = port
+        self.key_loader = key_loader
+        self.max_users = max(int(max_users), 1)
+        self.size = int(size)
+        self.idle_timeout = int(idle_timeout)
+        self.keepalive = int(keepalive)
+        self.acquire_timeout = acquire_timeout
+        self.log = log if log else logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        # (user, fingerprint) -> [pool, last_used], least recent first
+        self.pools = OrderedDict()
+
+    @staticmethod
+    def fingerprint(pkey):
+        """ returns a fingerprint of private key material """
+        return hashlib.sha256(pkey.encode()).hexdigest()
+
+    def get(self, user, pkey):
+        """ returns the pool of user, creating it if needed """
+        key = (user, self.fingerprint(pkey))
+        with self.lock:
+            entry = self.pools.get(key)
+            if entry:
+                entry[1] = time.monotonic()
+                self.pools.move_to_end(key)
+                return entry[0]
+
+        # Key parsing and pool creation are done outside of the lock,
+        # another thread may have won the race meanwhile
+        pool = ssh_pool(self.host, self.port, user, self.key_loader(pkey),
+                        size=self.size, idle_timeout=self.idle_timeout,
+                        keepalive=self.keepalive,
+                        acquire_timeout=self.acquire_timeout, log=self.log)
+        with self.lock:
+            entry = self.pools.get(key)
+            if entry:
+                entry[1] = time.monotonic()
+                self.pools.move_to_end(key)
+            else:
+                entry = [pool, time.monotonic()]
+                self.pools[key] = entry
+                pool = None
+            evicted = self.evict_locked()
+        if pool:
+            pool.close()
+        for i in evicted:
+            i.close()
+        return entry[0]
+
+    def evict_locked(self):
+        """ drops pools over capacity or idle, caller must hold lock """
+        evicted = []
+        now = time.monotonic()
+        for key in list(self.pools.keys())[:-1]:
+            pool, last_used = self.pools[key]
+            if len(self.pools) > self.max_users or \
+                    (self.idle_timeout > 0 and
+                     now - last_used > self.idle_timeout and
+                     not pool.stats()['busy']):
+                del self.pools[key]
+                evicted.append(pool)
+        if evicted:
+            self.log.debug('ssh user pools: evicted %d pools' % len(evicted))
+        return evicted
+
+    def evict(self):
+        """
+        drops pools over capacity or idle, and closes idle connections of
+        kept ones, returns number of pools dropped
+        """
+        with self.lock:
+            evicted = self.evict_locked()
+            kept = [pool for pool, last_used in self.pools.values()]
+        for pool in evicted:
+            pool.close()
+        for pool in kept:
+            pool.evict()
+        return len(evicted)
+
+    def get_timed(self, user, pkey, timings):
+        """ returns pool of user, adding time spent to connect timing """
+        start = time.monotonic()
+        pool = self.get(user, pkey)
+        if timings is not None:
+            timings['connect'] = timings.get('connect', 0) + \
+                time.monotonic() - start
+        return pool
+
+    def exec_command(self, user, pkey, cmd, instr=None, raw=False,
+                     timings=None):
+        """ runs cmd as user, returns stdout, stderr """
+        return self.get_timed(user, pkey, timings).exec_command(
+            cmd, instr, raw, timings)
+
+    def stream_command(self, user, pkey, cmd, chunk_size=65536,
+                       max_bytes=0, timings=None):
+        """ generator running cmd as user, yielding stdout chunks """
+        return self.get_timed(user, pkey, timings).stream_command(
+            cmd, chunk_size, max_bytes, timings)
+
+    def stats(self):
+        """ returns number of pools and connections """
+        with self.lock:
+            pools = [entry[0] for entry in self.pools.values()]
+        stats = {'users': len(pools), 'idle': 0, 'busy': 0}
+        for pool in pools:
+            pool_stats = pool.stats()
+            stats['idle'] += pool_stats['idle']
+            stats['busy'] += pool_stats['busy']
+        return stats
+
+    def close(self):
+        """ closes all pools """
+        with self.lock:
+            pools = [entry[0] for entry in self.pools.values()]
+            self.pools.clear()
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,195 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+import logging
+import os
+import sqlite3
+import threading
+import yaml
+
+
+class users_db(object):
+    """
+    Persistent mapping of Jarvice users to cluster users, with their
+    base64 encoded SSH private key.
+
+    Stored in SQLite, in WAL mode, and indexed in memory so that lookups do
+    not touch the disk. Writes go through to the database before updating
+    the index, and are skipped when a mapping did not change.
+    A legacy YAML cache is imported on first start.
+    """
+
+    fields = ['email', 'mapped_user', 'ssh_private_key_b64']
+
+    def __init__(self, path='users_mapping_db.sqlite',
+                 yaml_path='users_mapping_db.yaml', log=None):
+        self.path = path
+        self.log = log if log else logging.getLogger(__name__)
+
+        self.lock = threading.Lock()
+        # Single connection, serialized by lock, autocommit mode
+        self.connection = sqlite3.connect(path, check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'jarvice_user TEXT PRIMARY KEY, email TEXT, mapped_user TEXT, '
+            'ssh_private_key_b64 TEXT)')
+
+        # jarvice user -> {email, mapped_user, ssh_private_key_b64}
+        self.users = {}
+        for row in self.connection.execute(
+                'SELECT jarvice_user, email, mapped_user, '
+                'ssh_private_key_b64 FROM users'):
+            self.users[row[0]] = dict(zip(self.fields, row[1:]))
+
+        if not self.users and yaml_path and os.path.isfile(yaml_path):
+            self.migrate(yaml_path)
+
+    def migrate(self, yaml_path):
+        """ imports users of a legacy YAML cache """
+        with open(yaml_path, 'r') as file:
+            users = yaml.safe_load(file)
+        if not users:
+            return
+        rows = [(jarvice_user,) + tuple(entry.get(i) for i in self.fields)
+                for jarvice_user, entry in users.items()]
+        with self.lock:
+            with self.connection:
+                self.connection.execute('BEGIN')
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)', rows)
+            for row in rows:
+                self.users[row[0]] = dict(zip(self.fields, row[1:]))
+        self.log.info('users db: migrated %d users from %s' %
+                      (len(rows), yaml_path))
+
+    def get(self, jarvice_user):
+        """ returns mapping of jarvice_user as a dict, None if unknown """
+        with self.lock:
+            entry = self.users.get(jarvice_user)
+            if entry is None:
+                # May have been written by another process
+                row = self.connection.execute(
+                    'SELECT email, mapped_user, ssh_private_key_b64 '
+                    'FROM users WHERE jarvice_user = ?',
+                    (jarvice_user,)).fetchone()
+                if row is None:
+                    return None
+                entry = dict(zip(self.fields, row))
+                self.users[jarvice_user] = entry
+            return dict(entry)
+
+    def set(self, jarvice_user, email, mapped_user, ssh_private_key_b64):
+        """ stores mapping of jarvice_user, returns previous one or None """
+        entry = {'email': email, 'mapped_user': mapped_user,
+                 'ssh_private_key_b64': ssh_private_key_b64}
+        with self.lock:
+            previous = self.users.get(jarvice_user)
+            if previous == entry:
+                return dict(previous)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+                (jarvice_user, email, mapped_user, ssh_private_key_b64))
+            self.users[jarvice_user] = entry
+        return dict(previous) if previous else None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.users)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class users_id_mapping_config(object):
+    """
+    Users id mapping configuration file, indexed by mail.
+
+    The index is rebuilt as a whole and swapped when the file changes on
+    disk, checked every reload_interval seconds by a background thread,
+    so that users can be added without restarting the service.
+    on_reload, if set, is called with the previous and new indexes.
+    """
+
+    def __init__(self, path, reload_interval=10, on_reload=None, log=None):
+        self.path = path
+        self.reload_interval = float(reload_interval)
+        self.on_reload = on_reload
+        self.log = log if log else logging.getLogger(__name__)
+
+        # mail -> (mapped_user, ssh_private_key_b64)
+        self.index = {}
+        self.signature = None
+        self.reloads = 0
+        self.stop = threading.Event()
+        self.thread = None
+        self.load()
+
+    def file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def load(self):
+        """ reads and indexes configuration file, raises on error """
+        # Signature is taken first, so that a change while reading
+        # triggers another reload
+        signature = self.file_signature()
+        with open(self.path, 'r') as file:
+            configuration = yaml.safe_load(file)
+        index = {}
+        for user in configuration['users_id_mapping']:
+            # First entry wins for duplicated mails, as with a linear scan
+            index.setdefault(user['mail'], (user['mapped_user'],
+                                            user['ssh_private_key_b64']))
+        previous = self.index
+        self.index = index
+        self.signature = signature
+        self.reloads += 1
+        if self.on_reload:
+            self.on_reload(previous, index)
+
+    def reload_if_changed(self):
+        """ reloads configuration if file changed, returns True if so """
+        try:
+            signature = self.file_signature()
+        except OSError as e:
+            self.log.warning('Could not stat %s: %s' % (self.path, str(e)))
+            return False
+        if signature == self.signature:
+            return False
+        try:
+            self.load()
+        except Exception as e:
+            # Keep current index, and do not retry until file changes again
+            self.signature = signature
+            self.log.warning('Could not reload %s, keeping previous '
+                             'mapping: %s' % (self.path, str(e)))
+            return False
+        self.log.info('Reloaded %s: %d users' % (self.path, len(self.index)))
+        return True
+
+    def watch(self):
+        while not self.stop.wait(self.reload_interval):
+            self.reload_if_changed()
+
+    def start(self):
+        """ starts watching file for changes, if reload_interval > 0 """
+        if self.reload_interval > 0 and self.thread is None:
+            self.thread = threading.Thread(
+                target=self.watch, name='users-id-mapping-watcher',
+                daemon=True)
+            self.thread.start()
+
+    def lookup(self, mail):
+        """ returns (mapped_user, ssh_private_key_b64) of mail """
+        return self.index.get(mail, (None, None))
+
+    def __len__(self):
+        return len(self.index)
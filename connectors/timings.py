@@ -0,0 +1,84 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Stage level timings of connector operations, like job submission, kept in
+# a bounded in memory log to look for slow stages and outliers.
+
+import collections
+import threading
+import time
+
+
+class stage_timer(object):
+    """
+    Durations of the consecutive stages of an operation.
+
+    mark(stage) closes current stage: time since previous mark, or since
+    timer creation, is attributed to stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.start = self.last = time.perf_counter()
+        self.end = None
+        # List of (stage, seconds), in order
+        self.stages = []
+        self.error = None
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def stop(self, error=None):
+        """ ends operation, error being its exception if it failed """
+        self.end = time.perf_counter()
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+
+    def total(self):
+        return (self.end if self.end else time.perf_counter()) - self.start
+
+    def as_dict(self):
+        return {'name': self.name, 'started': self.started,
+                'total': self.total(), 'stages': dict(self.stages),
+                'error': self.error}
+
+    def server_timing(self):
+        """ returns stages as a Server-Timing header value, in ms """
+        return ', '.join('%s;dur=%.3f' % (stage, seconds * 1000)
+                         for stage, seconds in self.stages +
+                         [('total', self.total())])
+
+
+class timings_log(object):
+    """ ring buffer of the last size stage timers """
+
+    def __init__(self, size=256):
+        self.size = int(size)
+        self.lock = threading.Lock()
+        self.timers = collections.deque(maxlen=max(self.size, 1))
+
+    def record(self, timer):
+        if self.size > 0:
+            with self.lock:
+                self.timers.append(timer)
+
+    def entries(self):
+        """ returns recorded timers as dicts, oldest first """
+        with self.lock:
+            timers = list(self.timers)
+        return [timer.as_dict() for timer in timers]
+
+    def find(self, name):
+        """ returns last recorded timer of name, None if not found """
+        with self.lock:
+            for timer in reversed(self.timers):
+                if timer.name == name:
+                    return timer
+        return None
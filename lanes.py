@@ -0,0 +1,227 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Worker lanes: each class of requests runs connector calls in its own
+# bounded executor, so that a burst of slow requests of one class (for
+# example submits) cannot use every server thread and delay other classes.
+# A lane accepts up to workers running calls plus queue waiting ones, and
+# rejects further calls right away, answered as 503 by the front ends.
+#
+# Lanes are configured with JARVICE_LANE_<NAME>_WORKERS and
+# JARVICE_LANE_<NAME>_QUEUE environment variables.
+
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Seconds spent by the calling thread waiting on call(), see call_seconds()
+calling = threading.local()
+
+
+class lane_full(Exception):
+    """ raised when a lane cannot accept more calls """
+
+    def __init__(self, lane):
+        self.lane = lane
+        super().__init__(f'Lane {lane} is full')
+
+
+class lane(object):
+    """
+    Bounded executor for a class of requests, with queue depth statistics.
+    """
+
+    def __init__(self, name, workers, queue):
+        self.name = name
+        self.workers = int(os.getenv(f'JARVICE_LANE_{name.upper()}_WORKERS',
+                                     str(workers)))
+        self.queue = int(os.getenv(f'JARVICE_LANE_{name.upper()}_QUEUE',
+                                   str(queue)))
+        if self.workers < 1 or self.queue < 0:
+            raise ValueError(f'Invalid size for lane {name}')
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='lane-' + name)
+
+        self.lock = threading.Lock()
+        # Calls accepted and not finished, running or queued
+        self.pending = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self):
+        return self.workers + self.queue
+
+    def set_queue(self, queue):
+        """ changes number of calls queued when all workers are busy """
+        if queue < 0:
+            raise ValueError(f'Invalid queue size for lane {self.name}')
+        with self.lock:
+            self.queue = queue
+
+    def run(self, function, args, timing=None):
+        with self.lock:
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            if timing is not None:
+                timing['seconds'] = time.perf_counter() - start
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.running -= 1
+            self.pending -= 1
+            self.completed += 1
+
+    def hold(self, chunks):
+        """
+        returns streamed chunks, counted as a running call of lane until
+        exhausted or closed. To be called from a call running in lane, so
+        that lane is never seen with a free slot in between.
+        """
+        with self.lock:
+            self.pending += 1
+            self.running += 1
+        return held_stream(self, chunks)
+
+    def submit(self, function, *args, reject=True, timing=None):
+        """
+        returns future of function call, raises lane_full if full, unless
+        reject is False (for calls that cannot be refused, like reading the
+        rest of an accepted streamed response).
+        If timing is a dict, seconds spent running function, without
+        waiting in queue, are set as its seconds key.
+        """
+        with self.lock:
+            if reject and self.pending >= self.capacity:
+                self.rejected += 1
+                rejected = self.rejected
+            else:
+                rejected = None
+                self.pending += 1
+                self.max_queued = max(self.max_queued,
+                                      self.pending - self.workers)
+        if rejected is not None:
+            if rejected == 1 or rejected % 100 == 0:
+                log.warning(f'Lane {self.name} full, {rejected} calls '
+                            'rejected so far')
+            raise lane_full(self.name)
+        try:
+            return self.executor.submit(self.run, function, args, timing)
+        except Exception:
+            with self.lock:
+                self.pending -= 1
+            raise
+
+    def call(self, function, *args):
+        """ runs function in lane and returns its result """
+        timing = {}
+        try:
+            return self.submit(function, *args, timing=timing).result()
+        finally:
+            calling.seconds = getattr(calling, 'seconds', 0.0) + \
+                timing.get('seconds', 0.0)
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.workers, 'queue': self.queue,
+                    'running': self.running,
+                    'queued': self.pending - self.running,
+                    'max_queued': self.max_queued,
+                    'completed': self.completed, 'rejected': self.rejected}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class held_stream(object):
+    """ streamed chunks held in a lane, see lane.hold() """
+
+    def __init__(self, lane, chunks):
+        self.lane = lane
+        self.closed = False
+        self.chunks = chunks
+        self.iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            if self.iterator is None:
+                self.iterator = iter(self.chunks)
+            return next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.chunks, 'close'):
+                self.chunks.close()
+        finally:
+            self.lane.finish()
+
+    def __del__(self):
+        # Stream dropped without being closed
+        self.close()
+
+
+# /live, /nodes and /online do not use a lane, they are answered directly
+health = lane('health', 2, 2)           # /gc
+status = lane('status', 8, 16)          # running, queued, runstatus, events
+logs = lane('log', 4, 8)                # exitstatus, request (tail, etc.)
+mutation = lane('mutation', 4, 8)       # submit, terminate, release
+
+lanes = [health, status, logs, mutation]
+
+
+def capacity():
+    """ returns number of calls all lanes can accept at once """
+    return sum(i.capacity for i in lanes)
+
+
+def call_seconds(reset=False):
+    """
+    returns seconds spent running functions of call() made by current
+    thread, since last reset
+    """
+    seconds = getattr(calling, 'seconds', 0.0)
+    if reset:
+        calling.seconds = 0.0
+    return seconds
+
+
+def stats():
+    return dict((i.name, i.stats()) for i in lanes)
+
+
+def gauges():
+    """ returns state of lanes as metrics gauges """
+    descriptions = {
+        'workers': 'Calls a lane runs at once',
+        'queue': 'Calls a lane queues when its workers are busy',
+        'running': 'Calls running in lane',
+        'queued': 'Calls waiting for a worker of lane',
+        'max_queued': 'Highest number of calls waiting in lane',
+        'completed': 'Calls completed by lane',
+        'rejected': 'Calls rejected because lane was full'}
+    return [('jarvice_lane_' + key, description, {'lane': i.name},
+             i.stats()[key])
+            for key, description in descriptions.items() for i in lanes]
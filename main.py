@@ -6,11 +6,18 @@
 # Copyright (c) 2024 Nimbix, Inc.
 #
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 import json
+import gzip
 import importlib
 import os
 import sys
+import time
+import zlib
+
+import lanes
+import tracing
+from connectors.metrics import metrics, content_type as metrics_content_type
 
 app = Flask(__name__)
 
@@ -19,6 +26,65 @@ app = Flask(__name__)
 baremetal = importlib.import_module(os.getenv('JARVICE_BAREMETAL_CONNECTOR'))
 baremetal_connector = baremetal.baremetal_connector()
 
+# Optional compression of responses, negotiated with Accept-Encoding
+http_compression = os.getenv('JARVICE_HTTP_COMPRESSION', 'false').lower() == 'true'
+http_compression_min_size = int(os.getenv('JARVICE_HTTP_COMPRESSION_MIN_SIZE', '1024'))
+http_compression_level = int(os.getenv('JARVICE_HTTP_COMPRESSION_LEVEL', '6'))
+
+# Optional Server-Timing header on /submit, with time spent in each stage
+http_server_timing = os.getenv('JARVICE_HTTP_SERVER_TIMING', 'false').lower() == 'true'
+
+# Optional recording of legacy calls, to replay them offline (see tracing.py)
+trace_file = os.getenv('JARVICE_TRACE_FILE')
+trace_recorder = tracing.recorder(trace_file) if trace_file else None
+# Downstream end points are not recorded
+trace_excluded = ['/lanes', '/debug/submit_timings', '/metrics']
+
+
+# Requests metrics, see /metrics
+http_requests = metrics.counter(
+    'jarvice_http_requests_total', 'HTTP requests answered', ['route', 'method', 'status'])
+http_request_seconds = metrics.histogram(
+    'jarvice_http_request_seconds',
+    'Time to answer HTTP requests, until first chunk for streamed ones', ['route', 'method'])
+metrics.collector(lanes.gauges)
+
+
+@app.before_request
+def request_start():
+    g.request_start = time.monotonic()
+    lanes.call_seconds(reset=True)
+
+
+@app.after_request
+def request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_requests.inc(route=route, method=request.method, status=response.status_code)
+    if 'request_start' in g:
+        http_request_seconds.observe(time.monotonic() - g.request_start,
+                                     route=route, method=request.method)
+        if trace_recorder and request.url_rule and route not in trace_excluded:
+            record_call(route, response.status_code)
+    return response
+
+
+def record_call(route, status):
+    """ appends current call to trace file """
+    try:
+        args = json.loads(request.form['args']) if 'args' in request.form else None
+    except ValueError:
+        args = None
+    duration = time.monotonic() - g.request_start
+    trace_recorder.record(time.time() - duration, request.method, route, request.path, args,
+                          status, duration, lanes.call_seconds())
+
+
+# Connector calls run in the lane of their request class (see lanes.py),
+# a full lane is answered right away with 503
+@app.errorhandler(lanes.lane_full)
+def lane_full(e):
+    return jsonify({"status": "BUSY", "lane": e.lane}), 503, {'Retry-After': '1'}
+
 # ################## END POINTS - LEGACY
 
 # /live
@@ -37,7 +103,7 @@ def live():
 # - {"status": "BAD"}, 500 if cluster is not available
 @app.route("/gc", methods=['GET'])
 def gc():
-    return_code = baremetal_connector.gc()
+    return_code = lanes.health.call(baremetal_connector.gc)
     if int(return_code) == 200:
         return jsonify({"status": "OK"}), 200
     else:
@@ -58,8 +124,16 @@ def submit():
     number = args["number"]
     nodes = args["nodes"]
     bearer = args["bearer"]
-    return jsonify(
-        baremetal_connector.submit(name, number, nodes, hpc_script, bearer)), 200
+    return jsonify(lanes.mutation.call(
+        baremetal_connector.submit, name, number, nodes, hpc_script, bearer)), 200, \
+        submit_server_timing(name)
+
+
+def submit_server_timing(name):
+    """ returns Server-Timing header of last submission of job name, if enabled """
+    timings = getattr(baremetal_connector, 'submit_timings', None)
+    timer = timings.find(name) if http_server_timing and timings else None
+    return {'Server-Timing': timer.server_timing()} if timer else {}
 
 
 # /nodes
@@ -76,7 +150,7 @@ def nodes():
 # - 500 if something failed
 @app.route("/running", methods=['GET'])
 def running():
-    return jsonify(baremetal_connector.running()), 200
+    return jsonify(lanes.status.call(baremetal_connector.running)), 200
 
 
 # /queued
@@ -87,7 +161,7 @@ def running():
 # - 500 if something failed
 @app.route("/queued", methods=['GET'])
 def queued():
-    return jsonify(baremetal_connector.queued()), 200
+    return jsonify(lanes.status.call(baremetal_connector.queued)), 200
 
 
 # /exitstatus
@@ -112,7 +186,27 @@ def exitstatus():
     name = args["name"]
     number = args["number"]
     jobid = args["jobid"]
-    return jsonify(baremetal_connector.exitstatus(name, number, jobid)), 200
+    if getattr(baremetal_connector, 'stream_logs', False):
+        # Same content, but logs are streamed instead of buffered
+        # Only the first chunk is read in lane, the rest by server thread,
+        # still counted in lane until sent
+        return Response(lanes.logs.call(held_exitstatus_stream, name, number, jobid),
+                        status=200, mimetype='application/json')
+    return jsonify(lanes.logs.call(baremetal_connector.exitstatus, name, number, jobid)), 200
+
+
+# /batch/exitstatus
+# returns exit status of multiple completed jobs at once, and garbage collect them
+# We receive a list of jobs, each with name, number and jobid.
+# returns a list if ok, with for each job, in the same order, the same content than /exitstatus:
+# - [(exitcode, totaltime, logs), ...], 200 if ok
+# - 500 if something failed
+# A job that could not be processed is returned as null, and should be asked again later.
+@app.route("/batch/exitstatus", methods=['POST'])
+def exitstatus_batch():
+    args = json.loads(request.form.get("args"))
+    jobs = [(job["name"], job["number"], job["jobid"]) for job in args["jobs"]]
+    return jsonify(lanes.logs.call(baremetal_connector.exitstatus_batch, jobs)), 200
 
 
 # /runstatus
@@ -132,7 +226,20 @@ def runstatus():
     name = args["name"]
     number = args["number"]
     jobid = args["jobid"]
-    return jsonify(baremetal_connector.runstatus(name, number, jobid)), 200
+    return jsonify(lanes.status.call(baremetal_connector.runstatus, name, number, jobid)), 200
+
+
+# /batch/runstatus
+# returns running status of multiple jobs at once
+# We receive a list of jobs, each with name, number and jobid.
+# returns a list if ok, with for each job, in the same order, the same tupple than /runstatus:
+# - [(nodes, elapsed, name + '/' + str(number) + '/' + jobid, None), ...], 200 if ok
+# - 500 if not ok
+@app.route("/batch/runstatus", methods=['POST'])
+def runstatus_batch():
+    args = json.loads(request.form.get("args"))
+    jobs = [(job["name"], job["number"], job["jobid"]) for job in args["jobs"]]
+    return jsonify(lanes.status.call(baremetal_connector.runstatus_batch, jobs)), 200
 
 
 # /terminate
@@ -145,7 +252,7 @@ def terminate():
     name = args["name"]
     number = args["number"]
     jobid = args["jobid"]
-    return jsonify(baremetal_connector.terminate(name, number, jobid)), 200
+    return jsonify(lanes.mutation.call(baremetal_connector.terminate, name, number, jobid)), 200
 
 
 # /online
@@ -165,7 +272,7 @@ def release():
     name = args["name"]
     number = args["number"]
     jobid = args["jobid"]
-    return jsonify(baremetal_connector.release(name, number, jobid)), 200
+    return jsonify(lanes.mutation.call(baremetal_connector.release, name, number, jobid)), 200
 
 
 # /events
@@ -177,7 +284,7 @@ def events():
     name = args["name"]
     number = args["number"]
     jobid = args["jobid"]
-    return jsonify(baremetal_connector.events(name, number, jobid)), 200
+    return jsonify(lanes.status.call(baremetal_connector.events, name, number, jobid)), 200
 
 
 # /request/XXXX
@@ -186,6 +293,8 @@ def events():
 # /request/name/number/jobid/method with method being the actual request
 # method can be ping, shutdown, abort, info, tail, etc.
 # Answer depends of method requested. All should answer in json, expect tail that answer in plaintext format
+# tail accepts "lines" in qs, or "offset" (and optional "max_bytes") to get only bytes written since offset,
+# in which case answer is json: {"offset": next offset, "size": file size, "content": text, "more": true/false}
 
 @app.route('/request/<path:path>', methods=['POST'])
 def requests(path):
@@ -193,17 +302,110 @@ def requests(path):
         qs = args["qs"]
         # This method is not "standard"
         # as it can return raw content or json based content
-        code, content_type, content = baremetal_connector.request(path, qs)
+        code, content_type, content = lanes.logs.call(held_request, path, qs)
         if content_type == 'application/json':
             ret = json.loads(content)
             return jsonify(ret)
         else:
             if content is None:
                 return "", code
+            elif not isinstance(content, (str, bytes)):
+                # Streamed content, sent chunk by chunk
+                return Response(content, status=code, mimetype=content_type)
             else:
                 return content, code
 
 
+# Streamed content is read by the server thread once the lane call returned:
+# it is held in the lane until sent, so that lanes capacity also bounds the
+# server threads used by connector calls
+
+def held_exitstatus_stream(name, number, jobid):
+    return lanes.logs.hold(baremetal_connector.exitstatus_stream(name, number, jobid))
+
+
+def held_request(path, qs):
+    code, content_type, content = baremetal_connector.request(path, qs)
+    if content is not None and not isinstance(content, (str, bytes)):
+        content = lanes.logs.hold(content)
+    return code, content_type, content
+
+
+# ################## END POINTS - DOWNSTREAM
+
+# /lanes
+# Returns as json the state of each worker lane, to monitor queue depths:
+# - {lane: {"workers", "queue", "running", "queued", "max_queued", "completed", "rejected"}, ...}, 200
+@app.route("/lanes", methods=['GET'])
+def lanes_stats():
+    return jsonify(lanes.stats()), 200
+
+
+# /debug/submit_timings
+# Returns as json time spent in each stage of last submissions, oldest first, if connector records them:
+# - [{"name", "started" (epoch), "total", "stages": {stage: seconds, ...}, "error"}, ...], 200
+@app.route("/debug/submit_timings", methods=['GET'])
+def submit_timings():
+    timings = getattr(baremetal_connector, 'submit_timings', None)
+    return jsonify(timings.entries() if timings else []), 200
+
+
+# /metrics
+# Returns metrics in Prometheus text format: requests counts and latencies per route,
+# and whatever the connector exposes (remote commands latencies, pools and caches)
+@app.route("/metrics", methods=['GET'])
+def metrics_text():
+    return Response(metrics.render(), status=200, content_type=metrics_content_type)
+
+
+# ## HTTP COMPRESSION
+
+def compress_stream(chunks, compressor):
+    """ generator compressing a streamed response """
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+            # Flush so that client receives data as it is produced
+            yield compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+# Compress responses with gzip or deflate if client accepts it,
+# mainly for jobs logs (exitstatus and tail)
+@app.after_request
+def compress_response(response):
+    if not http_compression or response.status_code < 200 or \
+            response.status_code in [204, 304] or \
+            'Content-Encoding' in response.headers:
+        return response
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        # gzip container for gzip, zlib container for deflate
+        wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+        compressor = zlib.compressobj(http_compression_level, zlib.DEFLATED, wbits)
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < http_compression_min_size:
+            return response
+        if encoding == 'gzip':
+            data = gzip.compress(data, compresslevel=http_compression_level)
+        else:
+            data = zlib.compress(data, http_compression_level)
+        response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 # ## RUNNING SERVER
 
 if __name__ == "__main__":
@@ -216,7 +418,15 @@ if __name__ == "__main__":
         from waitress import serve
         waitress_port = int(os.getenv('WAITRESS_PORT', "5000"))
         waitress_bind_address = os.getenv('WAITRESS_BIND_ADDRESS', "0.0.0.0")
-        serve(app, host=waitress_bind_address, port=waitress_port)
+        # Connectors are safe to use from many threads at once.
+        # Enough threads for every call lanes accept, plus spare threads so
+        # that /live is answered even when all lanes are full
+        waitress_threads = int(os.getenv('WAITRESS_THREADS', str(lanes.capacity() + 4)))
+        if waitress_threads <= lanes.capacity():
+            print("Warning: WAITRESS_THREADS is not above lanes capacity (" +
+                  str(lanes.capacity()) + "), /live may wait behind other requests")
+        serve(app, host=waitress_bind_address, port=waitress_port,
+              threads=waitress_threads)
     else:
         app.run(host="0.0.0.0", port=5000, debug=True)
     quit()
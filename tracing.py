@@ -0,0 +1,94 @@
+#
+# NIMBIX OSS
+# ----------
+#
+# Copyright (c) 2024 Nimbix, Inc.
+#
+
+# Recording of upstream calls to an append only trace file, one JSON record
+# per line, so that real traffic can be replayed offline against any
+# connector (see benchmarks/replay.py).
+# Secrets of calls arguments (bearer tokens, job scripts, passwords, etc.)
+# are never written: they are replaced by their size.
+#
+# Each record holds:
+# - t: call start, epoch seconds
+# - method, route (rule as in main.py) and path of the call
+# - args: decoded args payload, scrubbed, null if none
+# - status: HTTP status answered
+# - duration: seconds to answer, until first chunk for streamed answers
+# - connector: seconds spent running connector calls
+
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Arguments never recorded, matched on lower case key names
+secret_keys = ('bearer', 'hpc_script', 'password', 'secret', 'token')
+
+
+def scrub(value):
+    """ returns a copy of value, with secrets replaced by their size """
+    if isinstance(value, dict):
+        return dict((key, {'scrubbed': len(json.dumps(item))}
+                     if any(i in str(key).lower() for i in secret_keys)
+                     else scrub(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+class recorder(object):
+    """ appends calls records to a trace file """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Line buffered, so that records are complete if the server dies
+        self.file = open(path, 'a', buffering=1)
+        self.records = 0
+        self.failures = 0
+        log.info(f'Recording calls to {path}')
+
+    def record(self, started, method, route, path, args, status, duration,
+               connector):
+        """ appends a call record, args being the decoded payload """
+        try:
+            line = json.dumps({
+                't': round(started, 6), 'method': method, 'route': route,
+                'path': path, 'args': scrub(args), 'status': status,
+                'duration': round(duration, 6),
+                'connector': round(connector, 6)},
+                separators=(',', ':'))
+            with self.lock:
+                self.file.write(line + '\n')
+                self.records += 1
+        except Exception as e:
+            # Recording must never fail a call
+            with self.lock:
+                self.failures += 1
+                failures = self.failures
+            if failures == 1 or failures % 100 == 0:
+                log.warning(f'Could not record call to {self.path}: {e}')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load(path):
+    """ returns records of a trace file, ordered by start time """
+    records = []
+    with open(path, 'r') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Last line may be truncated if server was killed
+                log.warning(f'Skipping invalid record {path}:{number}')
+    return sorted(records, key=lambda i: i['t'])